@@ -1,6 +1,15 @@
-from epics import caget, caput, cainfo, ca
-import time
-import math
+from pv_backend import EpicsBackend
+from measurement_channel import MeasurementChannel
+from settle_times import SettleTimes
+from bayesian_optimizer import GaussianProcessOptimizer
+from joint_steering import nelderMead, spsa, extremumSeeking
+from scan_history import ScanHistory
+from scan_analysis import findFlatTopCenter
+from instrumentation import tracer
+from run_recorder import recorder
+from move_planner import MovePlanner
+from channel_manager import channels
+from tuning_jobs import variations, joint_modes, magnetName, injectionJob
 import sys
 
 stage_2_injection_efficiency_pv = "ICT1400-01:PCT1402-01:InjEff:fbk"
@@ -22,120 +31,175 @@ sth3_increment = 50000
 magnet_to_increment = {stv1: stv1_increment, stv2: stv2_increment, stv3: stv3_increment,
                        sth1: sth1_increment, sth2: sth2_increment, sth3: sth3_increment}
 
-latest_injection_efficiency = 0
+#a scan turns around once the injection efficiency drops to this fraction of the best it has seen
+switch_back_fraction = 0.8
 
-#whether we've gotten a new injection efficiency value
-got_new_injection_efficiency = False
+#where the PVs are read and written, swap in a pv_backend.SimulatedBackend to run the optimizers offline
+backend = EpicsBackend()
 
-#function to be called on injection efficiency PV change
-def onChange(pvname=stage_2_injection_efficiency_pv, value=None, **kw):
-    global latest_injection_efficiency
-    global got_new_injection_efficiency
+#injection efficiencies from the monitor callback are queued here until the optimizer reads them. Those taken
+#before a magnet has settled after a put are dropped, with how long each magnet takes learned as it goes
+injection_efficiency_samples = MeasurementChannel(settle_times=SettleTimes())
+
+#the most a magnet may move in one put, in increments. Longer moves are made in several puts
+max_slew_increments = 20
+
+#single magnet moves go through here, so a scan's jump back to where it started and its first step
+#the other way become one put, see move_planner.py
+moves = MovePlanner(injection_efficiency_samples, {pv_name: max_slew_increments * increment for pv_name, increment in magnet_to_increment.items()})
 
-    latest_injection_efficiency = value
-    got_new_injection_efficiency = True
+#every point measured while tuning a single magnet is saved here
+scan_history = ScanHistory()
+
+'''
+    Forgets what earlier runs in this process left behind: the settle times and clock offset the
+    channel learned and the setpoints the move planner knows. Handing the optimizers a different
+    backend forgets them by itself, this is for callers such as the parameter sweep whose results
+    mustn't depend on what ran before them. The scan history is kept, it is meant to outlast a run
+'''
+def reset():
+    injection_efficiency_samples.reset()
+    moves.use(None)
+
+#function to be called on injection efficiency PV change
+def onChange(pvname=stage_2_injection_efficiency_pv, value=None, timestamp=None, **kw):
+    recorder.sample(pvname, value, timestamp, backend.time())
+    injection_efficiency_samples.push(value, timestamp, backend.timestamp())
 
 
 ''' 
     This function determines the desirability of our output. Since we are just trying
     to maximize the injection efficiency, we just return it without modification
+    timeout - how many seconds to wait for the next value before raising TimeoutError, None waits forever
 '''
-def objectiveFunction():
-    global got_new_injection_efficiency
-    global latest_injection_efficiency
+def objectiveFunction(timeout=None):
+
+    #make the put the last moves asked for, then block until we get a new injection efficiency after it.
+    #each value is handed out exactly once
+    moves.flush(backend)
+    with tracer.span("wait for sample"):
+        injection_efficiency = injection_efficiency_samples.waitForSample(timeout, backend.pend).value
+    tracer.count("shots")
+    return injection_efficiency
 
-    #wait until we get a new injection efficiency
-    while not got_new_injection_efficiency:
-        time.sleep(0.01)
-    
-    got_new_injection_efficiency = False #since we just used it, this value becomes stale
-    return latest_injection_efficiency
+
+#moves one magnet. The put is made when the next injection efficiency is needed, or at the end of the run
+def setMagnet(pv_name, magnet_val):
+    moves.move(pv_name, magnet_val)
 
 
 '''
-    This simple algorithm more or less follows the instructions on the wiki page for storage
-    ring injection tuning.
-    pv_name - the PV name of the steering magnet to tune
+    Measures the injection efficiency with one magnet at magnet_val and saves the point to the
+    scan history, so later runs can warm start from it
+'''
+def measureAndRecord(pv_name, magnet_val):
+    injection_efficiency = objectiveFunction()
+    scan_history.record(pv_name, magnet_val, injection_efficiency)
+    return injection_efficiency
+
+
+'''
+    Scans a steering magnet to the right of its current value until injection efficiency drops to
+    80% of the best seen, then to the left of it until it drops again, tracing out the flat top
+    pv_name - the PV name of the steering magnet to scan
     step - how large of a step to take for each adjustment
-    max_iterations - the maximum number of iterations before terminating the algorithm
+    max_iterations - the maximum number of iterations before giving up
+    returns (magnet values, injection efficiencies) in the order they were measured, or None if it
+    reached max iterations
 '''
-def optimizeSteeringMagnetVariation1(pv_name, step, max_iterations):
+def scanSteeringMagnet(pv_name, step, max_iterations):
 
-    #subscribe to the injection efficiency PV. every time it changes we call the above OnChange() function
-    injection_efficiency_channel = ca.create_channel(stage_2_injection_efficiency_pv)
-    eventID = ca.create_subscription(injection_efficiency_channel, callback=onChange)
-    
-    global latest_injection_efficiency
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
 
-    done = False
+        done = False
 
-    magnet_val = caget(pv_name)
-    initial_magnet_val = magnet_val
+        magnet_val = backend.get(pv_name)
+        initial_magnet_val = magnet_val
+        moves.startFrom(backend, pv_name, magnet_val)
+        recorder.setting(pv_name, magnet_val, backend.time())
 
-    magnet_val_and_inj_eff = []
+        # appended in scan order, the analysis sorts them by magnet value
+        magnet_vals = []
+        injection_efficiencies = []
 
-    iteration = 0
-    direction = 1
+        iteration = 0
+        direction = 1
 
-    injection_efficiency = objectiveFunction()
-    max_injection_efficiency = injection_efficiency
+        injection_efficiency = measureAndRecord(pv_name, magnet_val)
+        max_injection_efficiency = injection_efficiency
 
-    while not done:
+        while not done:
 
-        magnet_val = magnet_val + step * direction
-        caput(pv_name, magnet_val, wait=True)
+            magnet_val = magnet_val + step * direction
+            setMagnet(pv_name, magnet_val)
 
-        injection_efficiency = objectiveFunction()
-        if injection_efficiency > max_injection_efficiency:
-            max_injection_efficiency = injection_efficiency
+            injection_efficiency = measureAndRecord(pv_name, magnet_val)
+            if injection_efficiency > max_injection_efficiency:
+                max_injection_efficiency = injection_efficiency
 
-        if direction == 1:          # if we are going to the right
-            magnet_val_and_inj_eff.append((magnet_val, injection_efficiency))
-        elif direction == -1:       # if we are going to the left
-            magnet_val_and_inj_eff.insert(0, (magnet_val, injection_efficiency))
+            magnet_vals.append(magnet_val)
+            injection_efficiencies.append(injection_efficiency)
 
-        # if the injection efficiency is 80% of the max, we switch directions
-        if injection_efficiency <= max_injection_efficiency * 0.8:
-            if direction == 1:
-                direction = -1
-                magnet_val = initial_magnet_val
-                caput(pv_name, initial_magnet_val, wait=True)
-            else:
-                done = True
+            # if the injection efficiency is 80% (switch_back_fraction) of the max, we switch directions
+            if injection_efficiency <= max_injection_efficiency * switch_back_fraction:
+                if direction == 1:
+                    direction = -1
+                    magnet_val = initial_magnet_val
+                    tracer.count("reversals")
+                    recorder.decision("reversals", initial_magnet_val, backend.time())
+                    setMagnet(pv_name, initial_magnet_val)
+                else:
+                    done = True
+
+            iteration += 1
+            if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
+                print("Reached max iteration - terminating algorithm")
+                moves.finish(backend)
+                return None
+
+        moves.finish(backend)
+    return magnet_vals, injection_efficiencies
+
+
+'''
+    Scans the flat top, finds its center with one of the scan_analysis estimators and moves the
+    magnet there
+    estimator - which estimator to use, one of the names in scan_analysis.ESTIMATORS
+    returns the magnet value it was set to, or None if the scan hit max_iterations
+'''
+def tuneSteeringMagnet(pv_name, step, max_iterations, estimator):
+
+    scan = scanSteeringMagnet(pv_name, step, max_iterations)
+    if scan is None:
+        return None
+
+    # the estimators work in floats, so take the scanned value itself rather than the float copy of it
+    with tracer.span("compute"):
+        center = findFlatTopCenter(scan[0], scan[1], estimator)
+        best_magnet_val = min(scan[0], key=lambda magnet_val: abs(magnet_val - center))
+    setMagnet(pv_name, best_magnet_val)
+    moves.finish(backend)
 
-        iteration += 1
-        if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
-            print("Reached max iteration - terminating algorithm")
-            return
-        
-    
-    # here we clip the 'tail' so to speak so that we can find the approximate center of the flat top
-    done_clipping = False
-    worst_magnet = "left"
-    if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-        worst_magnet = "right"
-
-    while not done_clipping:
-
-        if worst_magnet == "left":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[1:]
-        elif worst_magnet == "right":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[0:len(magnet_val_and_inj_eff) - 1]
-
-        new_worst_magnet = "left"
-        if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-            new_worst_magnet = "right"
-        
-        if new_worst_magnet != worst_magnet:
-            done_clipping = True
-  
-
-    best_magnet_val = magnet_val_and_inj_eff[math.floor(len(magnet_val_and_inj_eff)/2)][0]
-    caput(pv_name, best_magnet_val, wait=True)
-        
-    
-    ca.clear_subscription(injection_efficiency_channel) #unsubscribe from pv
     print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
+    return best_magnet_val
+
+
+
+'''
+    This simple algorithm more or less follows the instructions on the wiki page for storage
+    ring injection tuning. After clipping the tail, the middle point of the scan is the center
+    pv_name - the PV name of the steering magnet to tune
+    step - how large of a step to take for each adjustment
+    max_iterations - the maximum number of iterations before terminating the algorithm
+    estimator - how to find the center of the flat top, see scan_analysis.ESTIMATORS
+'''
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetVariation1(pv_name, step, max_iterations, estimator="midpoint"):
+    return tuneSteeringMagnet(pv_name, step, max_iterations, estimator)
 
 
 
@@ -145,213 +209,355 @@ def optimizeSteeringMagnetVariation1(pv_name, step, max_iterations):
     pv_name - the PV name of the steering magnet to tune
     step - how large of a step to take for each adjustment
     max_iterations - the maximum number of iterations before terminating the algorithm
+    estimator - how to find the center of the flat top, see scan_analysis.ESTIMATORS
 '''
-def optimizeSteeringMagnetVariation2(pv_name, step, max_iterations):
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetVariation2(pv_name, step, max_iterations, estimator="centroid"):
+    return tuneSteeringMagnet(pv_name, step, max_iterations, estimator)
 
-    #subscribe to the injection efficiency PV. every time it changes we call the above OnChange() function
-    injection_efficiency_channel = ca.create_channel(stage_2_injection_efficiency_pv)
-    eventID = ca.create_subscription(injection_efficiency_channel, callback=onChange)
-    
-    global latest_injection_efficiency
 
-    done = False
 
-    magnet_val = caget(pv_name)
-    initial_magnet_val = magnet_val
+'''
+    This simple algorithm..... TODO: finish description
+    pv_name - the PV name of the steering magnet to tune
+    step - how large of a step to take for each adjustment
+    max_iterations - the maximum number of iterations before terminating the algorithm
+    estimator - how to find the center of the flat top, see scan_analysis.ESTIMATORS
+'''
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetVariation3(pv_name, step, max_iterations, estimator="midpoint"):
+    return tuneSteeringMagnet(pv_name, step, max_iterations, estimator)
 
-    magnet_val_and_inj_eff = []
 
-    iteration = 0
-    direction = 1
+'''
+    Bayesian optimization of one steering magnet. A Gaussian process models injection efficiency
+    against the magnet value and the next value to try is the one with the highest expected
+    improvement, so we don't have to walk both edges of the flat top to find its center
+    pv_name - the PV name of the steering magnet to tune
+    step - the spacing of the magnet values the optimizer may try
+    max_iterations - the maximum number of iterations before terminating the algorithm
+    span - how many steps either side of the current value to search
+    min_improvement - stop once the expected improvement anywhere drops below this much injection efficiency
+    returns the final magnet value, on the grid of steps from where the magnet started
+'''
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetBayesian(pv_name, step, max_iterations, span=10, min_improvement=0.5):
+
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
+
+        initial_magnet_val = backend.get(pv_name)
+        moves.startFrom(backend, pv_name, initial_magnet_val)
+        recorder.setting(pv_name, initial_magnet_val, backend.time())
+        candidates = [initial_magnet_val + step * i for i in range(-span, span + 1)]
+        optimizer = GaussianProcessOptimizer(candidates[0], candidates[-1], candidates=candidates)
+
+        #the model hands back floats, the magnet takes whole steps from where it started
+        def onGrid(value):
+            return initial_magnet_val + step * round((value - initial_magnet_val) / step)
+
+        magnet_val = initial_magnet_val
+        for iteration in range(max_iterations):
+
+            setMagnet(pv_name, magnet_val)
+            injection_efficiency = measureAndRecord(pv_name, magnet_val)
+
+            with tracer.span("compute"):
+                optimizer.observe(magnet_val, injection_efficiency)
+                magnet_val, expected_improvement = optimizer.suggest()
+                magnet_val = onGrid(magnet_val)
+
+            # a handful of points are needed before the model's expected improvement means anything
+            if iteration >= 4 and expected_improvement < min_improvement:
+                break
+        else:
+            print("Reached max iteration - using the best value so far")
+
+        with tracer.span("compute"):
+            best_magnet_val = onGrid(optimizer.bestPredicted()[0])
+        setMagnet(pv_name, best_magnet_val)
+        moves.finish(backend)
 
-    injection_efficiency = objectiveFunction()
-    max_injection_efficiency = injection_efficiency
+    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
+    return best_magnet_val
 
-    while not done:
 
-        magnet_val = magnet_val + step * direction
-        caput(pv_name, magnet_val, wait=True)
+'''
+    Tunes all six steering magnets together with a Nelder-Mead simplex search, so coupled STV and
+    STH pairs move together and there is one injection efficiency subscription for the whole run
+    instead of six separate scans. Each magnet's increment sets its scale in the search
+    max_iterations - the maximum number of injection efficiency measurements to spend
+    initial_size - the size of the starting simplex, in increments
+    tolerance - stop once the simplex is within this many increments of its best point
+    max_offset - the furthest any magnet may move from where it started, in increments
+    returns a dictionary of each magnet to its final value
+'''
+@recorder.run
+@tracer.run
+def optimizeAllSteeringMagnets(max_iterations, initial_size=2.0, tolerance=1.0, max_offset=10.0):
 
-        injection_efficiency = objectiveFunction()
-        if injection_efficiency > max_injection_efficiency:
-            max_injection_efficiency = injection_efficiency
+    start_time = backend.time()
 
-        if direction == 1:          # if we are going to the right
-            magnet_val_and_inj_eff.append([magnet_val, injection_efficiency])
-        elif direction == -1:       # if we are going to the left
-            magnet_val_and_inj_eff.insert(0, [magnet_val, injection_efficiency])
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
 
-        # if the injection efficiency is less than 80% of the max, we switch directions
-        if injection_efficiency <= max_injection_efficiency * 0.8:
-            if direction == 1:
-                direction = -1
-                magnet_val = initial_magnet_val
-                caput(pv_name, initial_magnet_val, wait=True)
-            else:
-                done = True
+        magnets = list(magnet_to_increment)
+        initial_magnet_vals = []
+        for pv_name in magnets:
+            initial_magnet_vals.append(backend.get(pv_name))
+            moves.startFrom(backend, pv_name, initial_magnet_vals[-1])
+            recorder.setting(pv_name, initial_magnet_vals[-1], backend.time())
 
-        iteration += 1
-        if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
-            print("Reached max iteration - terminating algorithm")
-            return
-        
-    
-    # here we clip the 'tail' so to speak so that we can find the approximate center of the flat top
-    done_clipping = False
-    worst_magnet = "left"
-    if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-        worst_magnet = "right"
-
-    while not done_clipping:
-
-        if worst_magnet == "left":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[1:]
-        elif worst_magnet == "right":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[0:len(magnet_val_and_inj_eff) - 1]
-
-        new_worst_magnet = "left"
-        if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-            new_worst_magnet = "right"
-        
-        if new_worst_magnet != worst_magnet:
-            done_clipping = True
-
-    # here we equalize the leftmost and rightmost injection efficiencies
-    leftmost_inj_eff = magnet_val_and_inj_eff[0][1]
-    rightmost_inj_eff = magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1]
-
-    if leftmost_inj_eff < rightmost_inj_eff:
-        magnet_val_and_inj_eff[0][1] = rightmost_inj_eff
-    elif rightmost_inj_eff < leftmost_inj_eff:
-        magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] = leftmost_inj_eff
-
-    
-    # duplicate the edges before applying moving average
-    magnet_val_and_inj_eff.insert(0, magnet_val_and_inj_eff[0])
-    magnet_val_and_inj_eff.append(magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1])
-
-    # apply moving average to smooth out noise
-    for i in range(1, len(magnet_val_and_inj_eff) - 2):
-        
-        avg = (magnet_val_and_inj_eff[i-1][1] + magnet_val_and_inj_eff[i][1] + magnet_val_and_inj_eff[i+1][1])/3
-        magnet_val_and_inj_eff[i][1] = avg
-
-    # find the weighted mean center
-    sum_weights = 0             # sum of all values (weights)
-    prod_xweights = 0           # product of all corresponding weights and positions
-    weighted_mean_center = 0    # weighted mean center
-
-    for i, val in enumerate(magnet_val_and_inj_eff):
-        sum_weights += val[1]
-        prod_xweights += (i + 1) * val[1]
-    
-    weighted_mean_center =  int(round(prod_xweights / sum_weights - 1))
-    if weighted_mean_center < 0:
-        weighted_mean_center = 0
-    
-    best_magnet_val = magnet_val_and_inj_eff[weighted_mean_center][0]
-
-    caput(pv_name, best_magnet_val, wait=True)
-        
-    
-    ca.clear_subscription(injection_efficiency_channel) #unsubscribe from pv
-    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
+        #through the move planner, so only the magnets that move get a put, longer moves are slewed, and no
+        #shot from before the puts or before the magnets have settled is used
+        def setMagnets(new_magnet_vals):
+            for pv_name, magnet_val in zip(magnets, new_magnet_vals):
+                setMagnet(pv_name, int(round(magnet_val)))
+
+        def evaluate(new_magnet_vals):
+            setMagnets(new_magnet_vals)
+            return objectiveFunction()
+
+        best_magnet_vals, best_injection_efficiency, shots = nelderMead(evaluate, initial_magnet_vals, [magnet_to_increment[pv_name] for pv_name in magnets],
+                                                                       initial_size, tolerance, max_iterations, max_offset=max_offset)
+        if shots >= max_iterations:
+            print("Reached max iteration - using the best values so far")
 
+        final_magnet_vals = [int(round(magnet_val)) for magnet_val in best_magnet_vals]
+        setMagnets(final_magnet_vals)
+        moves.finish(backend)
+
+    for pv_name, magnet_val in zip(magnets, final_magnet_vals):
+        print("Done tuning " + str(pv_name) + ", final magnet value: " + str(magnet_val))
+    print("Shots used: " + str(shots) + ", wall time: " + str(round(backend.time() - start_time, 1)) + " s")
+    return dict(zip(magnets, final_magnet_vals))
 
 
 '''
-    This simple algorithm..... TODO: finish description
-    pv_name - the PV name of the steering magnet to tune
-    step - how large of a step to take for each adjustment
-    max_iterations - the maximum number of iterations before terminating the algorithm
+    Tunes every magnet in magnet_to_increment at once with SPSA. Each iteration perturbs all the
+    magnets together with random signs and takes two injection efficiency measurements, so the
+    shots per iteration stay the same as more correctors are added to the table
+    iterations - how many iterations to run (two shots each)
+    perturbation - how many increments to perturb each magnet by on the first iteration
+    max_change - the most any magnet may move in one iteration, in increments
+    max_offset - the furthest any magnet may move from where it started, in increments
+    seed - seed for the random perturbation signs, so a run can be repeated
+    returns a dictionary of each magnet to its final value
 '''
-def optimizeSteeringMagnetVariation3(pv_name, step, max_iterations):
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetsSPSA(iterations, perturbation=1.0, max_change=1.0, max_offset=10.0, seed=None):
 
-    #subscribe to the injection efficiency PV. every time it changes we call the above OnChange() function
-    injection_efficiency_channel = ca.create_channel(stage_2_injection_efficiency_pv)
-    eventID = ca.create_subscription(injection_efficiency_channel, callback=onChange)
-    
-    global latest_injection_efficiency
+    start_time = backend.time()
 
-    done = False
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
 
-    magnet_val = caget(pv_name)
-    initial_magnet_val = magnet_val
+        magnets = list(magnet_to_increment)
+        magnet_vals = []
+        for pv_name in magnets:
+            magnet_vals.append(backend.get(pv_name))
+            moves.startFrom(backend, pv_name, magnet_vals[-1])
+            recorder.setting(pv_name, magnet_vals[-1], backend.time())
 
-    magnet_val_and_inj_eff = []
+        #through the move planner, so both shots of an iteration are taken after the perturbation has been put
+        def setMagnets(new_magnet_vals):
+            for pv_name, magnet_val in zip(magnets, new_magnet_vals):
+                setMagnet(pv_name, int(round(magnet_val)))
 
-    iteration = 0
-    direction = 1
+        def evaluate(new_magnet_vals):
+            setMagnets(new_magnet_vals)
+            return objectiveFunction()
 
-    injection_efficiency = objectiveFunction()
-    max_injection_efficiency = injection_efficiency
+        final_magnet_vals, shots = spsa(evaluate, magnet_vals, [magnet_to_increment[pv_name] for pv_name in magnets], iterations,
+                                        perturbation, max_change=max_change, max_offset=max_offset, seed=seed)
+        final_magnet_vals = [int(round(magnet_val)) for magnet_val in final_magnet_vals]
+        setMagnets(final_magnet_vals)
+        moves.finish(backend)
+
+    for pv_name, magnet_val in zip(magnets, final_magnet_vals):
+        print("Done tuning " + str(pv_name) + ", final magnet value: " + str(magnet_val))
+    print("Shots used: " + str(shots) + ", wall time: " + str(round(backend.time() - start_time, 1)) + " s")
+    return dict(zip(magnets, final_magnet_vals))
 
-    while not done:
 
-        magnet_val = magnet_val + step * direction
-        caput(pv_name, magnet_val, wait=True)
+'''
+    Tunes steering magnets together by extremum seeking, see joint_steering.extremumSeeking. Each
+    magnet is dithered around its setpoint with its own period and climbs the slope a lock-in
+    finds in the injection efficiency. There are no scans off the flat top, so the beam stays near
+    the best efficiency while tuning, and it can be left running during user operation
+    max_shots - the most shots to spend
+    pv_names - the magnets to tune, every magnet in magnet_to_increment if None
+    amplitude - the dither amplitude in increments
+    gain - increments moved per shot per unit of efficiency slope (percent per increment)
+    max_offset - the furthest any magnet may move from where it started, in increments
+    tolerance - stop once no magnet moves more than this many increments a shot, None runs all max_shots
+    returns a dictionary of each magnet to its final value
+'''
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetsDither(max_shots, pv_names=None, amplitude=1.0, gain=0.01, max_offset=10.0, tolerance=0.02):
+
+    start_time = backend.time()
+
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
+
+        magnets = list(pv_names) if pv_names is not None else list(magnet_to_increment)
+        magnet_vals = []
+        for pv_name in magnets:
+            magnet_vals.append(backend.get(pv_name))
+            moves.startFrom(backend, pv_name, magnet_vals[-1])
+            recorder.setting(pv_name, magnet_vals[-1], backend.time())
+
+        #the dither moves every magnet every shot, through the move planner so no shot from before the puts is used
+        def evaluate(new_magnet_vals):
+            for pv_name, magnet_val in zip(magnets, new_magnet_vals):
+                setMagnet(pv_name, int(round(magnet_val)))
+            return objectiveFunction()
+
+        final_magnet_vals, shots = extremumSeeking(evaluate, magnet_vals, [magnet_to_increment[pv_name] for pv_name in magnets], max_shots,
+                                                   amplitude, gain, max_offset=max_offset, tolerance=tolerance)
+        final_magnet_vals = [int(round(magnet_val)) for magnet_val in final_magnet_vals]
+        for pv_name, magnet_val in zip(magnets, final_magnet_vals):
+            setMagnet(pv_name, magnet_val)
+        moves.finish(backend)
+
+    for pv_name, magnet_val in zip(magnets, final_magnet_vals):
+        print("Done tuning " + str(pv_name) + ", final magnet value: " + str(magnet_val))
+    print("Shots used: " + str(shots) + ", wall time: " + str(round(backend.time() - start_time, 1)) + " s")
+    return dict(zip(magnets, final_magnet_vals))
 
-        injection_efficiency = objectiveFunction()
-        if injection_efficiency > max_injection_efficiency:
-            max_injection_efficiency = injection_efficiency
 
-        if direction == 1:          # if we are going to the right
-            magnet_val_and_inj_eff.append((magnet_val, injection_efficiency))
-        elif direction == -1:       # if we are going to the left
-            magnet_val_and_inj_eff.insert(0, (magnet_val, injection_efficiency))
+'''
+    Extremum seeking on one magnet, as variation 6 of the command line
+    pv_name - the PV name of the steering magnet to tune
+    step - the dither amplitude
+    max_iterations - the most shots to spend
+    returns the final magnet value
+'''
+def optimizeSteeringMagnetDither(pv_name, step, max_iterations):
+    return optimizeSteeringMagnetsDither(max_iterations, [pv_name], step / magnet_to_increment[pv_name])[pv_name]
 
-        # if the injection efficiency is 80% of the max, we switch directions
-        if injection_efficiency <= max_injection_efficiency * 0.8:
-            if direction == 1:
-                direction = -1
-                magnet_val = initial_magnet_val
-                caput(pv_name, initial_magnet_val, wait=True)
+'''
+    Uses the scan history to skip the full scan. The flat top measured in recent runs predicts where
+    the edges are, so we measure the predicted center and then only confirm each edge: if the edge is
+    still on the flat top we check that the next step out falls below 80% of the max, and if it isn't
+    we walk inward until we are back on the flat top. The magnet ends up halfway between the edges.
+    Falls back to a full scan with variation 2 if there isn't enough recent history
+    pv_name - the PV name of the steering magnet to tune
+    step - how large of a step to take when walking an edge
+    max_iterations - the maximum number of iterations before terminating the algorithm
+    max_age - how many seconds of history to use
+    returns the final magnet value, or None if the full scan it fell back to hit max_iterations
+'''
+@recorder.run
+@tracer.run
+def optimizeSteeringMagnetWarmStart(pv_name, step, max_iterations, max_age=3 * 24 * 3600):
+
+    prediction = scan_history.predictFlatTop(pv_name, max_age)
+    if prediction is None:
+        print("Not enough recent scan history for " + str(pv_name) + " - doing a full scan")
+        return optimizeSteeringMagnetVariation2(pv_name, step, max_iterations)
+
+    #throw away values left over from an earlier run, then subscribe to the injection efficiency PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    injection_efficiency_samples.drain()
+    with channels.monitor(backend, stage_2_injection_efficiency_pv, onChange):
+
+        initial_magnet_val = backend.get(pv_name)
+        moves.startFrom(backend, pv_name, initial_magnet_val)
+        recorder.setting(pv_name, initial_magnet_val, backend.time())
+
+        # stay on the grid of steps the edges are on
+        left_edge, center, right_edge = prediction
+        center = left_edge + round((right_edge - left_edge) / 2 / step) * step
+        injection_efficiencies = []
+
+        def measureAt(magnet_val):
+            setMagnet(pv_name, magnet_val)
+            injection_efficiencies.append(measureAndRecord(pv_name, magnet_val))
+            return injection_efficiencies[-1]
+
+        def onFlatTop(injection_efficiency):
+            return injection_efficiency > max(injection_efficiencies) * switch_back_fraction
+
+        # returns the outermost value on the flat top in the given direction, starting from the predicted edge
+        def confirmEdge(edge, direction):
+            if onFlatTop(measureAt(edge)):
+                while len(injection_efficiencies) < max_iterations:
+                    if not onFlatTop(measureAt(edge + step * direction)):
+                        return edge
+                    edge += step * direction
             else:
-                done = True
+                while len(injection_efficiencies) < max_iterations and (edge - center) * direction > step:
+                    edge -= step * direction
+                    if onFlatTop(measureAt(edge)):
+                        return edge
+            return edge
+
+        measureAt(center)
+        left_edge = confirmEdge(left_edge, -1)
+        right_edge = confirmEdge(right_edge, 1)
+
+        best_magnet_val = left_edge + round((right_edge - left_edge) / 2 / step) * step
+        setMagnet(pv_name, best_magnet_val)
+        moves.finish(backend)
 
-        iteration += 1
-        if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
-            print("Reached max iteration - terminating algorithm")
+    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val) + ", shots used: " + str(len(injection_efficiencies)))
+    return best_magnet_val
+
+
+'''
+    Runs one of the optimizers by name, the way the command line and the tuning daemon do
+    algorithm - the name of the optimizer, e.g. "optimizeSteeringMagnetVariation2"
+    pv_name - the magnet to tune for the single magnet optimizers, None for the ones that tune them all
+    params - the optimizer's arguments, the step defaults to the magnet's increment
+    returns whatever the optimizer returns
+'''
+def runOptimizer(algorithm, pv_name=None, **params):
+    if not algorithm.startswith("optimize") or algorithm not in globals():
+        raise ValueError("no optimizer called " + str(algorithm))
+    if pv_name is not None:
+        if pv_name not in magnet_to_increment:
+            raise ValueError(str(pv_name) + " is not one of " + str(list(magnet_to_increment)))
+        params["pv_name"] = pv_name
+        params.setdefault("step", magnet_to_increment[pv_name])
+    return globals()[algorithm](**params)
+
+
+'''
+    The command line: tunes one magnet with a variation, or every magnet together
+    magnet - the magnet to tune, or "all", "spsa" or "dither" to tune them all together
+    variation - the number of the variation for a single magnet, see variations
+    estimator - the flat top center estimator for variations 1 and 2, their own default if None
+    use_daemon - whether to hand the tune to the tuning daemon if one is running, its channels are already connected
+'''
+def main(magnet, variation=None, estimator=None, use_daemon=True):
+    job = injectionJob(magnet, variation, estimator)
+
+    if use_daemon:
+        #only needed to talk to the daemon, so the optimizers can be imported without it
+        import tuning_client
+        if tuning_client.handOff(job):
             return
-        
-    
-    # here we clip the 'tail' so to speak so that we can find the approximate center of the flat top
-    done_clipping = False
-    worst_magnet = "left"
-    if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-        worst_magnet = "right"
-
-    while not done_clipping:
-
-        if worst_magnet == "left":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[1:]
-        elif worst_magnet == "right":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[0:len(magnet_val_and_inj_eff) - 1]
-
-        new_worst_magnet = "left"
-        if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-            new_worst_magnet = "right"
-        
-        if new_worst_magnet != worst_magnet:
-            done_clipping = True
-  
-
-    best_magnet_val = magnet_val_and_inj_eff[math.floor(len(magnet_val_and_inj_eff)/2)][0]
-    caput(pv_name, best_magnet_val, wait=True)
-        
-    
-    ca.clear_subscription(injection_efficiency_channel) #unsubscribe from pv
-    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
 
+    tracer.enableFromEnvironment()
+    recorder.enableFromEnvironment()
 
-arg1 = str(sys.argv[1])
-arg2 = int(sys.argv[2])
+    return runOptimizer(job["algorithm"], job["pv"], **job["params"])
 
-magnet_name = arg1.upper()
-if magnet_name[:-4] != ":adc":
-    magnet_name += ":adc"
 
-if arg2 == 1:
-    optimizeSteeringMagnetVariation1(magnet_name, magnet_to_increment[magnet_name], 100)
-if arg2 == 2:
-    optimizeSteeringMagnetVariation2(magnet_name, magnet_to_increment[magnet_name], 100)
\ No newline at end of file
+if __name__ == "__main__":
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else None, sys.argv[3].lower() if len(sys.argv) > 3 else None)
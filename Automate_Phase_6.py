@@ -1,5 +1,17 @@
-from epics import caget, caput, cainfo, ca
-import time
+from pv_backend import EpicsBackend
+from measurement_channel import MeasurementChannel
+from settle_times import SettleTimes
+from line_search import brentMaximize
+from bayesian_optimizer import GaussianProcessOptimizer
+from sequential_test import SequentialComparator
+from shot_history import ShotHistory, LastInRange
+from instrumentation import tracer
+from run_recorder import recorder
+from move_planner import MovePlanner
+from channel_manager import channels
+from drift_tracker import DriftTracker
+from tuning_jobs import phase6_modes as modes, phase6Job
+import os
 import sys
 
 
@@ -13,57 +25,97 @@ knob_pv = "PHS1032-06:degree"
 outputs = {"PCT1402-01:mAChange": {"best": 0.6, "min": 0.55, "max": 0.65},
            "PCT2403-01:mABR:fbk": {"best": 1.6, "min": 1.3, "max": 2.0}}
 
-last_shot_rate = -1
-fresh_shot_rate = False
-all_shot_rates = []
+#where the PVs are read and written, swap in a pv_backend.SimulatedBackend to run the optimizers offline
+backend = EpicsBackend()
 
-#function to be called on shot rate PV change
-def onChange(pvname=shot_rate_pv, value=None, **kw):
-    global last_shot_rate
-    global fresh_shot_rate
+#positive shot rates from the monitor callback are queued here until the optimizer reads them. Those taken
+#before the knob has settled after a put are dropped, with how long it takes learned as it goes, see settle_times.py
+shot_rate_samples = MeasurementChannel(settle_times=SettleTimes())
+
+#the most the knob may move in one put, in degrees. Longer moves are made in several puts
+knob_max_slew = 10.0
+
+#the knob values the optimizers that extrapolate (Brent) may put, in degrees
+knob_limits = (0.0, 360.0)
+
+#knob moves go through here, so a revert and the step after it become one put, see move_planner.py
+moves = MovePlanner(shot_rate_samples, {knob_pv: knob_max_slew})
+
+#accept/reject decisions of the adaptive measurement modes, with the shots and confidence behind each one
+comparison_decisions = []
+
+#the DriftTracker of the feedback that is running, so it can be held and resumed from another thread
+feedback = None
 
+'''
+    Forgets what earlier runs in this process left behind: the settle times and clock offset the
+    channel learned, the setpoints the move planner knows and the decisions of the last adaptive
+    run. Handing the optimizers a different backend forgets the first two by itself, this is for
+    callers such as the parameter sweep whose results mustn't depend on what ran before them
+'''
+def reset():
+    global comparison_decisions, feedback
+    shot_rate_samples.reset()
+    moves.use(None)
+    comparison_decisions = []
+    feedback = None
+
+#function to be called on shot rate PV change
+def onChange(pvname=shot_rate_pv, value=None, timestamp=None, **kw):
+    recorder.sample(pvname, value, timestamp, backend.time())
     if value > 0:
-        last_shot_rate = value
-        fresh_shot_rate = True
-        
+        shot_rate_samples.push(value, timestamp, backend.timestamp())
+
 '''A test objective function instead of reading the shot rate from EPICS'''
 def testObjectiveFunction(solution):
-    global last_shot_rate
-    global fresh_shot_rate
 
     #a function to rather crudely simulate the shot rate
     last_shot_rate = -1.0/4 * (solution - 117.25) ** 2.0 + 0.6
 
     #shot rate is now positive
     last_positive_shot_rate = last_shot_rate
-    all_shot_rates.append(last_positive_shot_rate)
-    fresh_shot_rate = False
-    
+
     #output is just a parabola with maximum (1) at x = 0.6 ideally shot rate is 0.6 but 0.4-0.8 are acceptable
     y = -4 * (last_positive_shot_rate - 0.6) ** 2 + 1
     return y
 
 
 ''' the optimizer uses this to determine the desirability of each solution
+    history - the ShotHistory of the current run, which every shot rate is added to
+    timeout - how many seconds to wait for the next shot before raising TimeoutError, None waits forever
 '''
-def objectiveFunction():
-    global last_shot_rate
-    global fresh_shot_rate
-    global all_shot_rates
-
-    #wait until the next positive shot rate
-    while not fresh_shot_rate: 
-          time.sleep(0.01)
-
-    #got fresh shot rate
-    all_shot_rates.append(last_shot_rate)
-    fresh_shot_rate = False
-    
+def objectiveFunction(history, timeout=None):
+
+    #make the put the last moves asked for, then block until the next positive shot rate after it arrives
+    moves.flush(backend)
+    with tracer.span("wait for sample"):
+        last_shot_rate = shot_rate_samples.waitForSample(timeout, backend.pend).value
+    tracer.count("shots")
+
+    history.add(last_shot_rate)
+
     '''output is just a parabola with max (1) at x = 0.6
     ideally shot rate is 0.6 but 0.4-0.8 are acceptable'''
-    y = -4 * (last_shot_rate - outputs["shot_rate_pv"]["best"]) ** 2 + 1
+    y = -4 * (last_shot_rate - outputs[shot_rate_pv]["best"]) ** 2 + 1
     return y
 
+
+#moves the knob. The put is made when the next shot rate is needed, or at the end of the run
+def setKnob(knob_val):
+    moves.move(knob_pv, knob_val)
+
+#reads the knob at the start of a run, which is where a replay of the run starts from
+def getKnob():
+    knob_val = backend.get(knob_pv)
+    moves.startFrom(backend, knob_pv, knob_val)
+    recorder.setting(knob_pv, knob_val, backend.time())
+    return knob_val
+
+#a reversal or step size change, counted by the tracer and written to the run log
+def recordDecision(name, value):
+    tracer.count(name)
+    recorder.decision(name, value, backend.time())
+
 '''
     The first optimization method, which essentially mimics what an operator would do manually
     Parameters:
@@ -71,256 +123,508 @@ def objectiveFunction():
         goal_shot_rate_min - the minimum acceptable shot rate
         goal_shot_rate_max - the maximum acceptable shot rate
         max_iterations - the maximum number of adjustments to perform before terminating the function
+        convergence - when to stop, a criterion from shot_history such as LastInRange or RollingMeanWithin.
+                      Every optimizer takes one and returns the ShotHistory of the run
 '''
-def optimizePV_Standard(step, goal_shot_rate_min, goal_shot_rate_max, max_iterations):
+@recorder.run
+@tracer.run
+def optimizePV_Standard(step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, convergence=None):
 
-    global all_shot_rates
-    all_shot_rates = []
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
 
-    #subscribe to the shot rate PV. every time it changes we call the above OnChange() function
-    shot_rate_channel = ca.create_channel(shot_rate_pv)
-    eventID = ca.create_subscription(shot_rate_channel, callback=onChange)
-    
-    done = False
-    val = caget(knob_pv)
-    iteration = 0
-    direction = -1
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
 
+        done = False
+        val = getKnob()
+        iteration = 0
+        direction = -1
 
-    caput(knob_pv, val, wait=True)
-    fitness = objectiveFunction()
 
-    while not done:
-        
-        new_val = val + step * direction
-        caput(knob_pv, new_val, wait=True)
-        new_fitness = objectiveFunction()
+        setKnob(val)
+        fitness = objectiveFunction(history)
 
-        if new_fitness < fitness:
-            direction = direction * -1
-            caput(knob_pv, val, wait=True)
-        else:
-            val = new_val
-            fitness = new_fitness
-
-        print("iteration: ", iteration, " knob value: ", val, " output value: ", all_shot_rates[len(all_shot_rates) - 1])
-        
-        if len(all_shot_rates) >= 3:
-            last_three_in_range = True
-            for shot in all_shot_rates[-3:]:
-                if shot < goal_shot_rate_min or shot > goal_shot_rate_max:
-                    last_three_in_range = False
-            if last_three_in_range:
-                return
-        
-        iteration += 1
-        if iteration > max_iterations:
-            return
-    
-        ca.clear_subscription(shot_rate_channel)
-        print("Done tuning")
+        while not done:
+
+            new_val = val + step * direction
+            setKnob(new_val)
+            new_fitness = objectiveFunction(history)
+
+            if new_fitness < fitness:
+                direction = direction * -1
+                recordDecision("reversals", val)
+                setKnob(val)
+            else:
+                val = new_val
+                fitness = new_fitness
+
+            print("iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            iteration += 1
+            if iteration > max_iterations:
+                break
+
+        moves.finish(backend)
+    print("Done tuning")
+    return history
 
 '''
     The same as the first method, but with a relatively large step size that decreases
 '''
-def optimizePV_DecreasingStep(min_step, max_step, goal_shot_rate_min, goal_shot_rate_max, max_iterations):
+@recorder.run
+@tracer.run
+def optimizePV_DecreasingStep(min_step, max_step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, convergence=None):
 
-    global all_shot_rates
-    all_shot_rates = []
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
 
     step = max_step
 
-    #subscribe to the shot rate PV. every time it changes we call the above OnChange() function
-    shot_rate_channel = ca.create_channel(shot_rate_pv)
-    eventID = ca.create_subscription(shot_rate_channel, callback=onChange)
-    
-    done = False
-    val = caget(knob_pv)
-    iteration = 0
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
 
-    direction = -1
+        done = False
+        val = getKnob()
+        iteration = 0
 
-    caput(knob_pv, val, wait=True)
-    fitness = objectiveFunction()
+        direction = -1
 
-    while not done:
+        setKnob(val)
+        fitness = objectiveFunction(history)
 
-        new_val = val + step * direction
-        caput(knob_pv, new_val, wait=True)
-        new_fitness = objectiveFunction()
+        while not done:
 
-        if new_fitness < fitness:
-            direction = direction * -1
-            caput(knob_pv, val, wait=True)
-            if iteration != 0 and step > min_step:
-                step -= 0.5
-        else:
-            val = new_val
-            fitness = new_fitness
-
-        print("iteration: ", iteration, " knob value: ", val, " output value: ", all_shot_rates[len(all_shot_rates) - 1])
-        
-        if len(all_shot_rates) >= 3:
-            last_three_in_range = True
-            for shot in all_shot_rates[-3:]:
-                if shot < goal_shot_rate_min or shot > goal_shot_rate_max:
-                    last_three_in_range = False
-            if last_three_in_range:
-                return
-
-
-        iteration += 1
-        if iteration > max_iterations:
-            return
-        
-    ca.clear_subscription(shot_rate_channel)
+            new_val = val + step * direction
+            setKnob(new_val)
+            new_fitness = objectiveFunction(history)
+
+            if new_fitness < fitness:
+                direction = direction * -1
+                recordDecision("reversals", val)
+                setKnob(val)
+                if iteration != 0 and step > min_step:
+                    #never below min_step, or a max_step that isn't min_step plus whole half degrees would reach 0
+                    step = max(step - 0.5, min_step)
+                    recordDecision("step changes", step)
+            else:
+                val = new_val
+                fitness = new_fitness
+
+            print("iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            iteration += 1
+            if iteration > max_iterations:
+                break
+
+        moves.finish(backend)
     print("Done tuning")
+    return history
 
 
 '''
     The same as the first method, but takes average of multiple measurements of shot rate to account for fluctuations
     Parameters:
         measurements - how many measurements of the shot rate to take for each adjustment
+        adaptive_confidence - if given, measurements becomes the most shots per adjustment and each adjustment
+                              only takes shots until it is this confident (e.g. 0.95) the move was better or worse
+        convergence - the same as for optimizePV_Standard
 '''
-def optimizePV_MultipleMeasurements(step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements):
-    global all_shot_rates
-    all_shot_rates = []
-
-     #subscribe to the shot rate PV. every time it changes we call the above OnChange() function
-    shot_rate_channel = ca.create_channel(shot_rate_pv)
-    eventID = ca.create_subscription(shot_rate_channel, callback=onChange)
-    
-    done = False
-    val = caget(knob_pv)
-    iteration = 0
-    direction = -1
-
-    caput(knob_pv, val, wait=True)
-    sum = 0
-    for i in range(measurements):
-        sum += objectiveFunction()
-    fitness = sum / measurements
-
-    while not done:
-
-        new_val = val + step * direction
-        caput(knob_pv, new_val, wait=True)
-        sum = 0
-        for i in range(measurements):
-            sum += objectiveFunction()
-        new_fitness = sum / measurements
-
-        if new_fitness < fitness:
-            direction = direction * -1
-            caput(knob_pv, val, wait=True)
+@recorder.run
+@tracer.run
+def optimizePV_MultipleMeasurements(step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements, adaptive_confidence=None, convergence=None):
+
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+    global comparison_decisions
+    comparison_decisions = []
+
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
+
+        done = False
+        val = getKnob()
+        iteration = 0
+        direction = -1
+
+        setKnob(val)
+        if adaptive_confidence is None:
+            sum = 0
+            for i in range(measurements):
+                sum += objectiveFunction(history)
+            fitness = sum / measurements
         else:
-            val = new_val
-            fitness = new_fitness
-
-        print("iteration: ", iteration, " knob value: ", val, " output value: ", all_shot_rates[len(all_shot_rates) - 1])
-        
-        if len(all_shot_rates) >= 3:
-            last_three_in_range = True
-            for shot in all_shot_rates[-3:]:
-                if shot < goal_shot_rate_min or shot > goal_shot_rate_max:
-                    last_three_in_range = False
-            if last_three_in_range:
-                return
-        
-        iteration += 1
-        if iteration > max_iterations:
-            return
-    
-    ca.clear_subscription(shot_rate_channel)
+            comparator = SequentialComparator(measurements, adaptive_confidence)
+            fitness = comparator.measureIncumbent(lambda: objectiveFunction(history))
+
+        while not done:
+
+            new_val = val + step * direction
+            setKnob(new_val)
+            if adaptive_confidence is None:
+                sum = 0
+                for i in range(measurements):
+                    sum += objectiveFunction(history)
+                new_fitness = sum / measurements
+            else:
+                #only as many shots as it takes to tell whether the move was better or worse
+                decision = comparator.compare(lambda: objectiveFunction(history))
+                comparison_decisions.append(decision)
+                fitness, new_fitness = decision.incumbent_mean, decision.candidate_mean
+                print("decision: ", "accept" if decision.accepted else "reject", " shots: ", decision.samples, " confidence: ", round(decision.confidence, 3))
+
+            if new_fitness < fitness:
+                direction = direction * -1
+                recordDecision("reversals", val)
+                setKnob(val)
+            else:
+                val = new_val
+                fitness = new_fitness
+
+            print("iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            iteration += 1
+            if iteration > max_iterations:
+                break
+
+        moves.finish(backend)
     print("Done tuning")
+    return history
 
 
-def optimizePV_MultipleMeasureMentsDecreasingStep(min_step, max_step, step_decrease, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements):
-    global all_shot_rates
-    all_shot_rates = []
+'''
+    Multiple measurements with a step that shrinks by step_decrease on every reversal
+    Parameters:
+        adaptive_confidence - the same as for optimizePV_MultipleMeasurements
+        convergence - the same as for optimizePV_Standard
+'''
+@recorder.run
+@tracer.run
+def optimizePV_MultipleMeasureMentsDecreasingStep(min_step, max_step, step_decrease, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements, adaptive_confidence=None, convergence=None):
+
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+    global comparison_decisions
+    comparison_decisions = []
     step = max_step
     iteration = 0
 
-     #subscribe to the shot rate PV. every time it changes we call the above OnChange() function
-    shot_rate_channel = ca.create_channel(shot_rate_pv)
-    eventID = ca.create_subscription(shot_rate_channel, callback=onChange)
-    
-    done = False
-    val = caget(knob_pv)
-    direction = -1
-
-    caput(knob_pv, val, wait=True)
-    sum = 0
-    for i in range(measurements):
-        sum += objectiveFunction()
-    fitness = sum / measurements
-
-    while not done:
-
-        new_val = val + step * direction
-        caput(knob_pv, new_val, wait=True)
-        sum = 0
-        for i in range(measurements):
-            sum += objectiveFunction()
-        new_fitness = sum / measurements
-
-        if new_fitness < fitness:
-            direction = direction * -1
-            if step > min_step:
-                step -= step_decrease
-
-            caput(knob_pv, val, wait=True)
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
+
+        done = False
+        val = getKnob()
+        direction = -1
+
+        setKnob(val)
+        if adaptive_confidence is None:
+            sum = 0
+            for i in range(measurements):
+                sum += objectiveFunction(history)
+            fitness = sum / measurements
         else:
-            val = new_val
-            fitness = new_fitness
-
-        print("iteration: ", iteration, " knob value: ", val, " output value: ", all_shot_rates[len(all_shot_rates) - 1])
-        
-        if len(all_shot_rates) >= 3:
-            last_three_in_range = True
-            for shot in all_shot_rates[-3:]:
-                if shot < goal_shot_rate_min or shot > goal_shot_rate_max:
-                    last_three_in_range = False
-            if last_three_in_range:
-                return
-        
-        iteration += 1
-        if iteration > max_iterations:
-            return
-    
-        
-    
-    ca.clear_subscription(shot_rate_channel)
+            comparator = SequentialComparator(measurements, adaptive_confidence)
+            fitness = comparator.measureIncumbent(lambda: objectiveFunction(history))
+
+        while not done:
+
+            new_val = val + step * direction
+            setKnob(new_val)
+            if adaptive_confidence is None:
+                sum = 0
+                for i in range(measurements):
+                    sum += objectiveFunction(history)
+                new_fitness = sum / measurements
+            else:
+                #only as many shots as it takes to tell whether the move was better or worse
+                decision = comparator.compare(lambda: objectiveFunction(history))
+                comparison_decisions.append(decision)
+                fitness, new_fitness = decision.incumbent_mean, decision.candidate_mean
+                print("decision: ", "accept" if decision.accepted else "reject", " shots: ", decision.samples, " confidence: ", round(decision.confidence, 3))
+
+            if new_fitness < fitness:
+                direction = direction * -1
+                recordDecision("reversals", val)
+                if step > min_step:
+                    step = max(step - step_decrease, min_step)
+                    recordDecision("step changes", step)
+
+                setKnob(val)
+            else:
+                val = new_val
+                fitness = new_fitness
+
+            print("iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            iteration += 1
+            if iteration > max_iterations:
+                break
+
+
+
+        moves.finish(backend)
     print("Done tuning")
+    return history
+
+
+'''
+    Line search with bracketing plus Brent's method. Each new knob value comes from the vertex of the
+    parabola through the last three (knob, fitness) points, falling back to golden section steps
+    when the parabola can't be trusted, so it gets close to the optimum in a handful of shots.
+    The knob stays within max_excursion of where it started and inside knob_limits. A search that
+    closes in on a knob value without converging, e.g. on a noisy shot, starts again from the best
+    knob value it found, until the run converges or the shots run out
+    Parameters:
+        initial_step - the first step taken when bracketing the optimum
+        tolerance - a search stops once the best knob value is known to within this many degrees
+        goal_shot_rate_min - the minimum acceptable shot rate
+        goal_shot_rate_max - the maximum acceptable shot rate
+        max_iterations - the maximum number of shots to spend
+        convergence - the same as for optimizePV_Standard
+        max_excursion - the furthest in degrees the knob may be moved from where it started
+        repeats - how many shots to average at every knob value
+'''
+@recorder.run
+@tracer.run
+def optimizePV_Brent(initial_step, tolerance, goal_shot_rate_min, goal_shot_rate_max, max_iterations, convergence=None,
+                     max_excursion=40.0, repeats=1):
+
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
+
+        def evaluate(knob_val):
+            setKnob(knob_val)
+            fitness = objectiveFunction(history)
+            print("iteration: ", history.shots() - 1, " knob value: ", knob_val, " output value: ", history.last())
+            return fitness
+
+
+        val = getKnob()
+        lower = max(knob_limits[0], val - max_excursion)
+        upper = min(knob_limits[1], val + max_excursion)
+
+        best_val = val
+        in_range = False
+        while not in_range and history.shots() < max_iterations:
+            found_val, shots, in_range = brentMaximize(evaluate, best_val, initial_step, tolerance, max_iterations - history.shots(),
+                                                       history.converged, lower, upper, repeats)
+            #a search that couldn't measure anything leaves the best knob value where it was
+            if found_val is not None:
+                best_val = found_val
+            if shots == 0:
+                break
+            if not in_range:
+                recordDecision("restarts", best_val)
+
+        if not in_range:
+            setKnob(best_val)
+
+        moves.finish(backend)
+    print("Done tuning, final knob value: ", best_val)
+    return history
+
+
+'''
+    Bayesian optimization with a Gaussian process model of the fitness. Every shot goes into the
+    model and the next knob value is the one with the highest expected improvement, so noisy shots
+    are averaged by the model instead of by repeating measurements
+    Parameters:
+        search_width - how far either side of the current knob value to search
+        goal_shot_rate_min - the minimum acceptable shot rate
+        goal_shot_rate_max - the maximum acceptable shot rate
+        max_iterations - the maximum number of shots to spend
+        acquisition - "ei" for expected improvement or "ucb" for upper confidence bound
+        convergence - the same as for optimizePV_Brent
+'''
+@recorder.run
+@tracer.run
+def optimizePV_Bayesian(search_width, goal_shot_rate_min, goal_shot_rate_max, max_iterations, acquisition="ei", convergence=None):
 
+    #the shots of this run, stopping once convergence (by default the last three shots in range) is met
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+    #throw away shots left over from an earlier run, then subscribe to the shot rate PV.
+    #every time it changes we call the above OnChange() function, until the with block below ends
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
 
+        val = getKnob()
+        optimizer = GaussianProcessOptimizer(val - search_width, val + search_width, acquisition)
 
+        for iteration in range(max_iterations):
 
-arg = int(sys.argv[1])
+            setKnob(val)
+            fitness = objectiveFunction(history)
+            with tracer.span("compute"):
+                optimizer.observe(val, fitness)
 
-best = outputs[shot_rate_pv]["best"]
-minimum = outputs[shot_rate_pv]["min"]
-maximum = outputs[shot_rate_pv]["max"]
+            print("iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            with tracer.span("compute"):
+                val = optimizer.suggest()[0]
+        else:
+            #ran out of shots, so settle on the best knob value according to the model
+            val = optimizer.bestObserved()[0]
+            setKnob(val)
 
-if arg == 1:
-    print("Starting standard tuning algorithm")
-    optimizePV_Standard(0.5, minimum, maximum, 100)
-if arg == 2:
-    print("Starting tuning algorithm with multiple measurements")
-    optimizePV_MultipleMeasurements(0.5, minimum, maximum, 300, 3)
-if arg == 3:
-    print("Starting tuning algorithm with decreasing step")
-    optimizePV_DecreasingStep(0.5, 2.0, minimum, maximum, 100)
-if arg == 4:
-    optimizePV_MultipleMeasureMentsDecreasingStep(0.5, 1.5, 0.5, minimum, maximum, 200, 3)
+        moves.finish(backend)
+    print("Done tuning, final knob value: ", val)
+    return history
 
-print("Tuning complete")
-        
-        
 
 
+'''
+    Continuous feedback: instead of stopping once the shot rate is in the window, keeps it there for
+    as long as it runs, keeping it near the best shot rate as the linac phase drifts, see drift_tracker.py.
+    Only a status line is printed every report_period seconds, so it can run for weeks. Start it once
+    a tune has brought the shot rate up: shot rates below hold_below hold it rather than being chased
+    Parameters:
+        step - the size of one correction in degrees
+        goal_shot_rate_min, goal_shot_rate_max - the window the time in the window is measured against
+        max_shots - stop after this many shots, None runs until it is cancelled or stopped with Ctrl-C
+        max_rate - the most the knob may move, in degrees per second
+        hold_timeout - seconds without a shot before the feedback is held, it resumes with the next one
+        report_period - seconds between status lines and rewrites of metrics_path
+        metrics_path - a Prometheus-style file for the live metrics, None for no file
+        deadband - no correction is made while the filtered shot rate is no more than this below the best shot rate
+                   of shot_rate_pv in outputs, half way down to goal_shot_rate_min if None
+        max_offset - the furthest in degrees the knob may be moved from where it started. The feedback holds there
+        hold_below - shot rates below this hold the feedback until they are back, a tenth of the best shot rate if None
+        convergence - fed every shot like in the other optimizers, but never stops the feedback
+'''
+@recorder.run
+def optimizePV_Feedback(step, goal_shot_rate_min, goal_shot_rate_max, max_shots=None, max_rate=0.5, hold_timeout=10.0,
+                        report_period=60.0, metrics_path=None, deadband=None, max_offset=20.0, hold_below=None, convergence=None):
+    global feedback
+
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+    shot_rate_samples.drain()
+    with channels.monitor(backend, shot_rate_pv, onChange):
+
+        target = outputs[shot_rate_pv]["best"]
+        if deadband is None:
+            deadband = (target - goal_shot_rate_min) / 2
+        if hold_below is None:
+            hold_below = target / 10
+        feedback = DriftTracker(getKnob(), target, deadband, goal_shot_rate_min, goal_shot_rate_max, step, max_rate,
+                                hold_below=hold_below, max_offset=max_offset)
+        next_report = backend.time() + report_period
+        try:
+            while max_shots is None or feedback.shots < max_shots:
+                try:
+                    objectiveFunction(history, hold_timeout)
+                except TimeoutError:
+                    feedback.hold("no shots")
+                    continue
+
+                knob_val = feedback.add(history.last(), backend.time())
+                if knob_val is not None:
+                    setKnob(knob_val)
+
+                if backend.time() >= next_report:
+                    next_report = backend.time() + report_period
+                    print(feedback.report())
+                    if metrics_path is not None:
+                        feedback.writeMetrics(metrics_path)
+        except KeyboardInterrupt:
+            print("Feedback stopped")
+
+        moves.finish(backend)
+    print(feedback.report())
+    if metrics_path is not None:
+        feedback.writeMetrics(metrics_path)
+    return history
+
+
+'''
+    Runs one of the optimizers by name, the way the command line and the tuning daemon do
+    algorithm - the name of the optimizer, e.g. "optimizePV_DecreasingStep"
+    pv_name - the output PV to tune on (one of the keys of outputs), shot_rate_pv if None
+    params - the optimizer's arguments, the goal window defaults to the one in outputs
+    returns the ShotHistory of the run
+'''
+def runOptimizer(algorithm, pv_name=None, **params):
+    global shot_rate_pv
+    if not algorithm.startswith("optimizePV_") or algorithm not in globals():
+        raise ValueError("no optimizer called " + str(algorithm))
+    if pv_name is not None:
+        if pv_name not in outputs:
+            raise ValueError(str(pv_name) + " is not one of " + str(list(outputs)))
+        shot_rate_pv = pv_name
+
+    params.setdefault("goal_shot_rate_min", outputs[shot_rate_pv]["min"])
+    params.setdefault("goal_shot_rate_max", outputs[shot_rate_pv]["max"])
+    return globals()[algorithm](**params)
+
+
+'''
+    The command line: runs one of the modes on shot_rate_pv
+    mode - the number of the mode, see modes
+    use_daemon - whether to hand the tune to the tuning daemon if one is running, its channels are already connected
+'''
+def main(mode, use_daemon=True):
+    description, job = phase6Job(mode, shot_rate_pv)
+
+    if use_daemon:
+        #only needed to talk to the daemon, so the optimizers can be imported without it
+        import tuning_client
+        if tuning_client.handOff(job):
+            return
+
+    tracer.enableFromEnvironment()
+    recorder.enableFromEnvironment()
 
+    #the feedback's live metrics go to TUNING_FEEDBACK_METRICS if it is set
+    params = job["params"]
+    if job["algorithm"] == "optimizePV_Feedback":
+        params["metrics_path"] = os.environ.get("TUNING_FEEDBACK_METRICS")
 
+    print("Starting " + description)
+    history = runOptimizer(job["algorithm"], **params)
 
+    #every mode reports the shots it used so the modes can be compared on beam time
+    print("Tuning complete, shots used: ", history.shots())
 
 
+if __name__ == "__main__":
+    main(int(sys.argv[1]))
@@ -1,283 +1,416 @@
 import time
 import random
-import math
-import sys
-import matplotlib.pyplot as plt
+import io
+import contextlib
+import numpy as np
+from pv_backend import SimulatedBackend, tableResponse, flatTop, flatTopResponse
+from scan_history import ScanHistory
+from scan_analysis import ESTIMATORS, findFlatTopCenter
+import batch_simulator
+import Automate_Injection_Tuning as injection
+from instrumentation import tracer
 
-stage_2_injection_efficiency_pv = "ICT1400-01:PCT1402-01:InjEff:fbk"
+#runs the real optimizers in Automate_Injection_Tuning.py on the simulator instead of EPICS
 
-stv1 = "STV1400-01:adc"
-stv2 = "STV1400-02:adc"
-stv3 = "STV1400-03:adc"
-sth1 = "STH1400-01:adc"
-sth2 = "STH1400-02:adc"
-sth3 = "STH1400-03:adc"
+stv1 = injection.stv1
+stv1_increment = injection.stv1_increment
+injection_efficiency_pv = injection.stage_2_injection_efficiency_pv
 
-stv1_increment = 10000
-stv2_increment = 20000
-stv3_increment = 20000
-sth1_increment = 100000
-sth2_increment = 50000
-sth3_increment = 50000
-
-steering_magnets = [stv1, stv2, stv3, sth1, sth2, sth3]
-steering_magnet_increments = [stv1_increment, stv2_increment, stv3_increment, sth1_increment, sth2_increment, sth3_increment]
-
-magnet_to_increment = {stv1: stv1_increment, stv2: stv2_increment, stv3: stv3_increment,
-                       sth1: sth1_increment, sth2: sth2_increment, sth3: sth3_increment}
+steering_magnets = list(injection.magnet_to_increment)
+steering_magnet_increments = [injection.magnet_to_increment[pv_name] for pv_name in steering_magnets]
 
 pretend_steering_magnet_vals = [1250000, 200000, 300000, 2000000, 300000, 600000]
 
-current_steering_magnet = stv1
-
-
-def caget(pv):
-    global steering_magnets
-    global steering_magnet_increments
-
-    if pv in steering_magnets:
-        return pretend_steering_magnet_vals[steering_magnets.index(pv)]
+#the plots need matplotlib, the rest of the test doesn't
+try:
+    import matplotlib.pyplot as plt
+    show_plots = True
+except ImportError:
+    show_plots = False
 
+#scan history that only lasts as long as the test
+injection.scan_history = ScanHistory(":memory:")
 
-def caput(pv, val, wait=True):
-    global steering_magnets
-    global pretend_steering_magnet_vals
 
-    if pv in steering_magnets:
-        pretend_steering_magnet_vals[steering_magnets.index(pv)] = val
-
-
-''' 
+'''
     NOTE: JUST FOR TESTING STV1400-01
-    This function determines the desirability of our output. Since we are just trying
-    to maximize the injection efficiency, we just return it without modification
+    Injection efficiency against STV1400-01 only. Between the table entries it is interpolated and
+    past either end it stays at 0, so scans that leave the table no longer raise KeyError
 '''
-def objectiveFunction():
-
-    #center of flat top stv1-1400 = 1350000 with inj_eff = 97
-    #flat top extends 2 notches to left and right from the center
-    magnet_to_inj_eff = {1230000: 0, 1240000: 20, 1250000: 40, 1260000: 60, 1270000: 70, 1280000: 80, 1290000: 90,  
-                         1300000: 96, 1310000: 97, 1320000: 97, 1330000: 97, 1340000: 97, 1350000: 97, 1360000: 96, 
-                         1370000: 90, 1380000: 80, 1390000: 70, 1400000: 60, 1410000: 40, 1420000: 20, 1430000: 0  }
-    
-    return magnet_to_inj_eff[pretend_steering_magnet_vals[0]] + random.randint(0, 5)
-
+#center of flat top stv1-1400 = 1350000 with inj_eff = 97
+#flat top extends 2 notches to left and right from the center
+magnet_to_inj_eff = {1230000: 0, 1240000: 20, 1250000: 40, 1260000: 60, 1270000: 70, 1280000: 80, 1290000: 90,
+                     1300000: 96, 1310000: 97, 1320000: 97, 1330000: 97, 1340000: 97, 1350000: 97, 1360000: 96,
+                     1370000: 90, 1380000: 80, 1390000: 70, 1400000: 60, 1410000: 40, 1420000: 20, 1430000: 0  }
+stv1Response = tableResponse(stv1, magnet_to_inj_eff)
 
+def objectiveFunction(values):
+    return stv1Response(values) + random.randint(0, 5)
 
-def optimizeSteeringMagnetVariation1(pv_name, step, max_iterations):
 
-   
-    
-    global latest_injection_efficiency
 
-    done = False
+#center of the flat top of each magnet in the coupled model
+coupled_model_centers = [1330000, 260000, 240000, 2300000, 200000, 700000]
 
-    magnet_val = caget(pv_name)
-    initial_magnet_val = magnet_val
-
-    magnet_val_and_inj_eff = []
-
-
-    iteration = 0
-    direction = 1
-
-    injection_efficiency = objectiveFunction()
-    max_injection_efficiency = injection_efficiency
+'''
+    A model of all six magnets: each has a flat top like the STV1400-01 table, but STV1400-01/02
+    and STH1400-01/02 are coupled, so the best value of one depends on the other
+'''
+def coupledObjectiveFunction(values):
+    notches = [(values[pv_name] - center) / increment for pv_name, center, increment in zip(steering_magnets, coupled_model_centers, steering_magnet_increments)]
+    efficiency = flatTop(notches[0] + 0.6 * notches[1]) * flatTop(notches[1]) * flatTop(notches[2]) * \
+                 flatTop(notches[3] - 0.6 * notches[4]) * flatTop(notches[4]) * flatTop(notches[5])
+    return 97 * efficiency + random.randint(0, 5)
 
-    while not done:
 
-        magnet_val = magnet_val + step * direction
-        caput(pv_name, magnet_val, wait=True)
+'''
+    Puts a new simulator behind the optimizers. Injection shots come once a second and puts take 0.2 s
+    response - one of the objective functions above
+'''
+def simulate(response, magnet_vals):
+    injection.backend = SimulatedBackend({injection_efficiency_pv: response}, dict(zip(steering_magnets, magnet_vals)),
+                                         shot_period=1.0, put_latency=0.2)
+    return injection.backend
 
-        injection_efficiency = objectiveFunction()
-        if injection_efficiency > max_injection_efficiency:
-            max_injection_efficiency = injection_efficiency
 
-        if direction == 1:          # if we are going to the right
-            magnet_val_and_inj_eff.append((magnet_val, injection_efficiency))
-        elif direction == -1:       # if we are going to the left
-            magnet_val_and_inj_eff.insert(0, (magnet_val, injection_efficiency))
+random.seed(0)
+simulate(objectiveFunction, pretend_steering_magnet_vals)
+#the table's flat top, where every value gives 97 before the noise
+assert 1310000 <= injection.optimizeSteeringMagnetVariation1(stv1, stv1_increment, 100) <= 1350000
 
-        if injection_efficiency <= max_injection_efficiency * 0.8:
-            if direction == 1:
-                direction = -1
-                magnet_val = initial_magnet_val
-                caput(pv_name, initial_magnet_val, wait=True)
-            else:
-                done = True
-
-        iteration += 1
-        if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
-            print("Reached max iteration - terminating algorithm")
-            return
-        
-    inj_effs = [i[1] for i in magnet_val_and_inj_eff]
-    plt.plot(inj_effs)
+if show_plots:
+    plt.plot([injection_efficiency for timestamp, magnet_val, injection_efficiency in injection.scan_history.recent(stv1)])
     plt.show()
-    
-    done_clipping = False
-    worst_magnet = "left"
-    if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-        worst_magnet = "right"
-
-    while not done_clipping:
-
-        if worst_magnet == "left":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[1:]
-        elif worst_magnet == "right":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[0:len(magnet_val_and_inj_eff) - 1]
-
-        new_worst_magnet = "left"
-        if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-            new_worst_magnet = "right"
-        
-        if new_worst_magnet != worst_magnet:
-            done_clipping = True
-  
-
-    best_magnet_val = magnet_val_and_inj_eff[math.floor(len(magnet_val_and_inj_eff)/2)][0]
-    caput(pv_name, best_magnet_val, wait=True)
-
-    inj_effs = [i[1] for i in magnet_val_and_inj_eff]
-    plt.plot(inj_effs)
-    plt.show()
-        
-    
-  
-    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
 
 
 '''
-    This simple algorithm is the same as variation 1, with the caveat that we take the 
-    weighted mean center of the final 'strip chart' rather than just the center
-    pv_name - the PV name of the steering magnet to tune
-    step - how large of a step to take for each adjustment
-    max_iterations - the maximum number of iterations before terminating the algorithm
+    Compares tuning all six magnets one after another with variation 2 against tuning them together,
+    on the coupled model. Wall time is the simulator's: 1 injection shot per second and 0.2 s per put
 '''
-def optimizeSteeringMagnetVariation2(pv_name, step, max_iterations):
-
-    done = False
+show_plots = False
+runs = 20
+results = {"sequential variation 2": [], "joint nelder-mead": [], "joint spsa": []}
+
+for seed in range(runs):
+    for name in results:
+        random.seed(seed)
+        backend = simulate(coupledObjectiveFunction, [center + random.choice((-1, 1)) * random.randint(1, 3) * increment
+                                                      for center, increment in zip(coupled_model_centers, steering_magnet_increments)])
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name == "sequential variation 2":
+                for pv_name in steering_magnets:
+                    injection.optimizeSteeringMagnetVariation2(pv_name, injection.magnet_to_increment[pv_name], 100)
+            elif name == "joint nelder-mead":
+                injection.optimizeAllSteeringMagnets(300)
+            else:
+                injection.optimizeSteeringMagnetsSPSA(20, seed=seed)
 
-    magnet_val = caget(pv_name)
-    initial_magnet_val = magnet_val
+        final_injection_efficiency = backend.get(injection_efficiency_pv)
+        results[name].append((backend.shots, backend.time(), final_injection_efficiency))
 
-    magnet_val_and_inj_eff = []
+for name in results:
+    print(name + ": " + str(sum(r[0] for r in results[name]) / runs) + " shots, " +
+          str(round(sum(r[1] for r in results[name]) / runs, 1)) + " s, final injection efficiency " +
+          str(round(sum(r[2] for r in results[name]) / runs, 1)) + " on average over " + str(runs) + " runs")
+    assert sum(r[2] for r in results[name]) / runs > 97
+for name in ["joint nelder-mead", "joint spsa"]:
+    assert sum(r[0] for r in results[name]) < sum(r[0] for r in results["sequential variation 2"])
 
 
-    iteration = 0
-    direction = 1
+'''
+    The joint modes at 10 Hz injection with magnet puts that take 0.5 s. Five shots come in while a put
+    is in flight, so a search that read them would be ranking the magnet values from before the put
+'''
+def coupledModel(values):
+    notches = [(values[pv_name] - center) / increment for pv_name, center, increment in zip(steering_magnets, coupled_model_centers, steering_magnet_increments)]
+    return 97 * flatTop(notches[0] + 0.6 * notches[1]) * flatTop(notches[1]) * flatTop(notches[2]) * \
+           flatTop(notches[3] - 0.6 * notches[4]) * flatTop(notches[4]) * flatTop(notches[5])
+
+def fastInjection(seed):
+    random.seed(seed)
+    injection.backend = SimulatedBackend({injection_efficiency_pv: coupledModel},
+                                         {pv_name: center + random.choice((-1, 1)) * random.randint(1, 3) * increment
+                                          for pv_name, center, increment in zip(steering_magnets, coupled_model_centers, steering_magnet_increments)},
+                                         shot_period=0.1, put_latency=0.5, monitor_delay=0.05, noise=1.0, seed=seed)
+    return injection.backend
+
+for name, optimize in [("nelder-mead", lambda seed: injection.optimizeAllSteeringMagnets(300)),
+                       ("spsa", lambda seed: injection.optimizeSteeringMagnetsSPSA(20, seed=seed))]:
+    efficiencies = []
+    for seed in range(10):
+        backend = fastInjection(seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            final_magnet_vals = optimize(seed)
+        efficiencies.append(coupledModel(backend.values))
+        assert final_magnet_vals == {pv_name: backend.values[pv_name] for pv_name in steering_magnets}
+    print("10 Hz joint " + name + ": final injection efficiency " + str(round(sum(efficiencies) / len(efficiencies), 1)) +
+          " on average, lowest " + str(round(min(efficiencies), 1)))
+    assert min(efficiencies) > 90
+
+
+#the first STV1400-01 tune has no history and scans fully, the second warm starts from the first one's points
+injection.scan_history = ScanHistory(":memory:")
+warm_start_shots = {}
+for run in ["full scan", "warm start"]:
+    random.seed(0)
+    backend = simulate(objectiveFunction, pretend_steering_magnet_vals)
+    final_magnet_val = injection.optimizeSteeringMagnetWarmStart(stv1, stv1_increment, 100)
+    print(run + ": " + str(backend.shots) + " shots")
+    warm_start_shots[run] = backend.shots
+    assert final_magnet_val == backend.get(stv1) and 1310000 <= final_magnet_val <= 1350000
+assert warm_start_shots["warm start"] < warm_start_shots["full scan"]
+
+
+#every mode is recorded as one run that can be replayed: its optimizer, the magnet it started from and its shots and puts
+import os
+import tempfile
+from run_recorder import recorder, RunLog, ReplayBackend
+log_path = os.path.join(tempfile.mkdtemp(), "injection_runs.bin")
+recorder.open(log_path)
+recorded_modes = [("optimizeSteeringMagnetVariation2", lambda: injection.optimizeSteeringMagnetVariation2(stv1, stv1_increment, 100)),
+                  ("optimizeSteeringMagnetBayesian", lambda: injection.optimizeSteeringMagnetBayesian(stv1, stv1_increment, 30)),
+                  ("optimizeSteeringMagnetWarmStart", lambda: injection.optimizeSteeringMagnetWarmStart(stv1, stv1_increment, 100)),
+                  ("optimizeAllSteeringMagnets", lambda: injection.optimizeAllSteeringMagnets(100)),
+                  ("optimizeSteeringMagnetsSPSA", lambda: injection.optimizeSteeringMagnetsSPSA(5, seed=0)),
+                  ("optimizeSteeringMagnetsDither", lambda: injection.optimizeSteeringMagnetsDither(50))]
+#the scan history the warm start predicts from, the same for the recorded run and its replay
+history_points = injection.scan_history.recent(stv1)
+
+def restoreScanHistory():
+    injection.scan_history = ScanHistory(":memory:")
+    for timestamp, magnet_val, injection_efficiency in history_points:
+        injection.scan_history.record(stv1, magnet_val, injection_efficiency, timestamp)
+
+recorded = []
+for name, optimize in recorded_modes:
+    random.seed(0)
+    restoreScanHistory()
+    simulate(coupledObjectiveFunction, pretend_steering_magnet_vals)
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimize()
+    recorded.append([injection.backend.get(pv_name) for pv_name in steering_magnets])
+recorder.close()
+log = RunLog(log_path)
+summaries = list(log.summaries())
+print("recorded " + ", ".join(summary["optimizer"] + " (" + str(summary["samples"]) + " samples, " + str(summary["puts"]) + " puts)"
+                              for summary in summaries))
+assert [summary["optimizer"] for summary in summaries] == [name for name, optimize in recorded_modes]
+assert all(summary["finished"] and summary["samples"] > 0 and summary["puts"] > 0 and summary["knob"] is not None for summary in summaries)
+
+#replayed through the same optimizer, each run puts what it recorded and ends where it did
+replayed = 0
+for i, (name, optimize) in enumerate(recorded_modes):
+    injection.backend = ReplayBackend(log, i)
+    restoreScanHistory()
+    with contextlib.redirect_stdout(io.StringIO()):
+        optimize()
+    replayed += injection.backend.following and all(injection.backend.get(pv_name) == value for pv_name, value in zip(steering_magnets, recorded[i])
+                                                    if pv_name in injection.backend.values)
+print("replaying reproduced " + str(replayed) + " of " + str(len(recorded_modes)) + " recorded injection runs")
+assert replayed == len(recorded_modes)
+
+
+#the simulator is fast enough to run a whole scan thousands of times when trying out a change
+runs = 1000
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    for seed in range(runs):
+        random.seed(seed)
+        simulate(objectiveFunction, pretend_steering_magnet_vals)
+        injection.optimizeSteeringMagnetVariation2(stv1, stv1_increment, 100)
+print(str(runs) + " variation 2 runs on the simulator took " + str(round(time.perf_counter() - start, 2)) + " s")
 
-    injection_efficiency = objectiveFunction()
-    max_injection_efficiency = injection_efficiency
 
-    while not done:
 
-        magnet_val = magnet_val + step * direction
-        caput(pv_name, magnet_val, wait=True)
+'''
+    Seconds to tune STV1400-01 with each variation at 1 Hz and 10 Hz injection, on the simulator's
+    virtual clock. Magnet puts take 0.2 s to complete and settle with a 0.5 s time constant, and
+    monitor updates arrive 0.05 s after the shot
+'''
+variations = [("variation 1", injection.optimizeSteeringMagnetVariation1), ("variation 2", injection.optimizeSteeringMagnetVariation2),
+              ("variation 3", injection.optimizeSteeringMagnetVariation3)]
+for shot_period in (1.0, 0.1):
+    for name, optimize in variations:
+        random.seed(0)
+        backend = SimulatedBackend({injection_efficiency_pv: objectiveFunction}, dict(zip(steering_magnets, pretend_steering_magnet_vals)),
+                                   shot_period=shot_period, put_latency=0.2, settling_time=0.5, monitor_delay=0.05)
+        injection.backend = backend
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            optimize(stv1, stv1_increment, 100)
+        print(str(round(1 / shot_period)) + " Hz " + name + ": " + str(round(backend.time(), 1)) + " s, final magnet value " +
+              str(backend.get(stv1)) + ", simulated in " + str(round((time.perf_counter() - start) * 1000, 1)) + " ms")
+        assert 1310000 <= backend.get(stv1) <= 1350000
 
-        injection_efficiency = objectiveFunction()
-        if injection_efficiency > max_injection_efficiency:
-            max_injection_efficiency = injection_efficiency
 
-        if direction == 1:          # if we are going to the right
-            magnet_val_and_inj_eff.append([magnet_val, injection_efficiency])
-        elif direction == -1:       # if we are going to the left
-            magnet_val_and_inj_eff.insert(0, [magnet_val, injection_efficiency])
+'''
+    Compares the flat top center estimators on dense simulated scans of the coupled model's flat top
+    with noisy shots: how far each one's center lands from the true center, and how long it takes
+'''
+points = 2000
+runs = 50
+for estimator in ESTIMATORS:
+    errors = 0.0
+    seconds = 0.0
+    for seed in range(runs):
+        random.seed(seed)
+        magnet_vals = [1330000 + stv1_increment * (-8 + 16 * i / (points - 1)) for i in range(points)]
+        injection_efficiencies = [97 * flatTop((val - 1330000) / stv1_increment) + random.randint(0, 5) for val in magnet_vals]
+        #arrays, as a dense scan would be kept. Converting 2000 point lists takes longer than any of the estimators
+        magnet_vals = np.array(magnet_vals)
+        injection_efficiencies = np.array(injection_efficiencies)
+
+        start = time.perf_counter()
+        center = findFlatTopCenter(magnet_vals, injection_efficiencies, estimator)
+        seconds += time.perf_counter() - start
+        errors += abs(center - 1330000) / stv1_increment
+
+    print(estimator + ": center off by " + str(round(errors / runs, 3)) + " notches, " +
+          str(round(seconds / runs * 1e6)) + " us on average over " + str(runs) + " scans of " + str(points) + " points")
+    assert errors / runs < (0.5 if estimator == "midpoint" else 0.05)
 
-        if injection_efficiency <= max_injection_efficiency * 0.8:
-            if direction == 1:
-                direction = -1
-                magnet_val = initial_magnet_val
-                caput(pv_name, initial_magnet_val, wait=True)
-            else:
-                done = True
-
-        iteration += 1
-        if iteration > max_iterations:      # just terminate the algorithm if we go past max iterations
-            print("Reached max iteration - terminating algorithm")
-            return
-        
-    
-    # here we clip the 'tail' so to speak so that we can find the approximate center of the flat top
-    done_clipping = False
-    worst_magnet = "left"
-    if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-        worst_magnet = "right"
-
-    while not done_clipping:
-
-        if worst_magnet == "left":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[1:]
-        elif worst_magnet == "right":
-            magnet_val_and_inj_eff = magnet_val_and_inj_eff[0:len(magnet_val_and_inj_eff) - 1]
-
-        new_worst_magnet = "left"
-        if magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] < magnet_val_and_inj_eff[0][1]:
-            new_worst_magnet = "right"
-        
-        if new_worst_magnet != worst_magnet:
-            done_clipping = True
-
-
-
-    #here we equalize the leftmost and rightmost injection efficiencies
-    leftmost_inj_eff = magnet_val_and_inj_eff[0][1]
-    rightmost_inj_eff = magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1]
-
-    if leftmost_inj_eff < rightmost_inj_eff:
-        magnet_val_and_inj_eff[0][1] = rightmost_inj_eff
-    elif rightmost_inj_eff < leftmost_inj_eff:
-        magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1][1] = leftmost_inj_eff
-
-    
-    #duplicate the edges before applying moving average
-    magnet_val_and_inj_eff.insert(0, magnet_val_and_inj_eff[0])
-    magnet_val_and_inj_eff.append(magnet_val_and_inj_eff[len(magnet_val_and_inj_eff)-1])
-
-    #apply moving average to smooth out noise
-    for i in range(1, len(magnet_val_and_inj_eff) - 2):
-        
-        avg = (magnet_val_and_inj_eff[i-1][1] + magnet_val_and_inj_eff[i][1] + magnet_val_and_inj_eff[i+1][1])/3
-        magnet_val_and_inj_eff[i][1] = avg
-
-    #find the weighted mean center
-    sum_weights = 0             # sum of all values (weights)
-    prod_xweights = 0           # product of all corresponding weights and positions
-    weighted_mean_center = 0    # weighted mean center
-
-    for i, val in enumerate(magnet_val_and_inj_eff):
-        sum_weights += val[1]
-        prod_xweights += (i + 1) * val[1]
-    
-    weighted_mean_center = int(round(prod_xweights / sum_weights - 1))
-    if weighted_mean_center < 0:
-        weighted_mean_center = 0
-    
-    best_magnet_val = magnet_val_and_inj_eff[weighted_mean_center][0]
-
-    caput(pv_name, best_magnet_val, wait=True)
-        
-    inj_effs = [i[1] for i in magnet_val_and_inj_eff]
-
-    plt.plot(inj_effs)
-    plt.show()
-    
 
-    print("Done tuning " + str(pv_name) + ", final magnet value: " + str(best_magnet_val))
+'''
+    The batch simulator runs the same scan and centering on arrays. With gaussian shot noise from the
+    simulator on the same seeds, every variation 2 run should end on the same magnet value after the
+    same number of shots as the one in Automate_Injection_Tuning.py
+'''
+runs = 200
+starts = [1330000 + (seed % 9 - 4) * stv1_increment for seed in range(runs)]
+#the batch simulator doesn't gate on settle times, so neither may the variation it is compared with
+settle_times = injection.injection_efficiency_samples.settle_times
+injection.injection_efficiency_samples.settle_times = None
+scalar_seconds = 0.0
+agree = 0
+for seed in range(runs):
+    backend = SimulatedBackend({injection_efficiency_pv: flatTopResponse(stv1, 1330000, stv1_increment, 97)}, {stv1: starts[seed]},
+                               noise=2.0, seed=seed)
+    injection.backend = backend
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        injection.optimizeSteeringMagnetVariation2(stv1, stv1_increment, 100)
+    scalar_seconds += time.perf_counter() - start
+    batch = batch_simulator.steeringBatch([starts[seed]], stv1_increment, batch_simulator.flatTopPeak(1330000, stv1_increment, 97),
+                                          100, "centroid", noise=2.0, seeds=[seed])
+    agree += batch.final_values[0] == backend.values[stv1] and batch.shots[0] == backend.shots
+print("batch and scalar variation 2 agree on " + str(agree) + " of " + str(runs) + " seeds")
+assert agree == runs
+
+start = time.perf_counter()
+batch_simulator.steeringBatch(starts * 50, stv1_increment, batch_simulator.flatTopPeak(1330000, stv1_increment, 97),
+                              100, "centroid", noise=2.0, seed=0)
+batch_seconds = time.perf_counter() - start
+print(str(runs * 50) + " batch runs took " + str(round(batch_seconds, 3)) + " s, " +
+      str(round(scalar_seconds / runs / (batch_seconds / (runs * 50)))) + " times faster per run than the scalar variation 2")
+injection.injection_efficiency_samples.settle_times = settle_times
 
 
 '''
-arg1 = str(sys.argv[1])
-arg2 = int(sys.argv[2])
+    Instrumentation: the latency budget of one variation 2 scan on the simulator's clock, with the
+    puts and the wait for every injection efficiency. The jump back to the start of the scan is
+    merged with the first step the other way, so there is one put fewer than moves
+'''
+tracer.clock = lambda: injection.backend.time()
+tracer.enable(None, None)
+injection.backend = SimulatedBackend({injection_efficiency_pv: flatTopResponse(stv1, 1330000, stv1_increment, 97)}, {stv1: 1300000},
+                                     put_latency=0.2, settling_time=0.5, noise=1.0, seed=0)
+with contextlib.redirect_stdout(io.StringIO()) as output:
+    injection.optimizeSteeringMagnetVariation2(stv1, stv1_increment, 100)
+print(output.getvalue()[output.getvalue().index("Latency budget"):].rstrip())
+tracer.disable()
+tracer.clock = time.perf_counter
+
+
+#magnet names typed on the command line, with or without :adc and in either case, all name the same PV
+magnet_names = {name: injection.magnetName(name) for name in ["stv1400-01", "STV1400-01", "stv1400-01:adc", "STV1400-01:ADC"]}
+print("command line magnet names: " + str(magnet_names))
+assert set(magnet_names.values()) == {stv1}
+#the command line offers the estimators without importing scan_analysis
+import tuning_jobs
+assert tuning_jobs.estimators == list(ESTIMATORS)
 
-magnet_name = arg1.upper()
-if magnet_name[:-4] != ":adc":
-    magnet_name += ":adc"
 
-if arg2 == 1:
-    optimizeSteeringMagnetVariation1(magnet_name, magnet_to_increment[magnet_name], 100)
-if arg2 == 2:
-    optimizeSteeringMagnetVariation2(magnet_name, magnet_to_increment[magnet_name], 100)
 '''
+    Extremum seeking against variation 2 on STV1400-01, from the flat top and from either shoulder.
+    Variation 2 scans down both sides of the flat top, extremum seeking only dithers by one increment,
+    so the mean injection efficiency over the shots spent shows how much beam each one costs. Then
+    the lock-in on its own, which shouldn't allocate anything per shot
+'''
+import tracemalloc
+from lock_in import LockIn
+
+for start_notches in [0, -4, 4]:
+    for name, optimizer in [("variation 2", injection.optimizeSteeringMagnetVariation2), ("extremum seeking", injection.optimizeSteeringMagnetDither)]:
+        efficiencies = []
+        flat_top = flatTopResponse(stv1, 1330000, stv1_increment, 97)
+
+        def measuredFlatTop(values):
+            efficiencies.append(flat_top(values))
+            return efficiencies[-1]
+
+        injection.backend = SimulatedBackend({injection_efficiency_pv: measuredFlatTop}, {stv1: 1330000 + start_notches * stv1_increment},
+                                             put_latency=0.2, noise=1.0, seed=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            optimizer(stv1, stv1_increment, 300)
+        print(name + " from " + str(start_notches) + " notches: " + str(len(efficiencies)) + " shots at a mean efficiency of " +
+              str(round(sum(efficiencies) / len(efficiencies), 1)) + " (lowest " + str(round(min(efficiencies), 1)) + "), ended " +
+              str(round((injection.backend.values[stv1] - 1330000) / stv1_increment, 2)) + " notches from the center at " +
+              str(round(flat_top(injection.backend.values), 1)))
+        assert abs(injection.backend.values[stv1] - 1330000) <= stv1_increment and flat_top(injection.backend.values) > 96
+
+lock_in = LockIn((5, 6, 7, 9, 11, 13))
+responses = [random.gauss(97, 1) for i in range(100000)]
+start = time.perf_counter()
+for response in responses:
+    lock_in.add(response)
+seconds = time.perf_counter() - start
+tracemalloc.start()
+for response in responses:
+    lock_in.add(response)
+print("lock-in: " + str(round(1e6 * seconds / len(responses), 2)) + " us per shot for 6 magnets, " +
+      str(tracemalloc.get_traced_memory()[1]) + " bytes allocated at most over " + str(len(responses)) + " more shots")
+assert tracemalloc.get_traced_memory()[1] < 10000
+tracemalloc.stop()
+
+#more magnets than DITHER_PERIODS has periods for: the rest are dithered at the next primes
+from joint_steering import extremumSeeking
+random.seed(0)
+centers = [(-1) ** i * 2.0 for i in range(12)]
+final_offsets, shots = extremumSeeking(lambda values: 97 - 0.5 * sum((value - center) ** 2 for value, center in zip(values, centers)) +
+                                       random.gauss(0, 0.2), [0.0] * 12, [1.0] * 12, 5000)
+print("extremum seeking on 12 magnets: " + str(shots) + " shots, ended at most " +
+      str(round(max(abs(offset - center) for offset, center in zip(final_offsets, centers)), 2)) + " increments from the top")
+assert max(abs(offset - center) for offset, center in zip(final_offsets, centers)) < 1.0
+
 
-optimizeSteeringMagnetVariation1("STV1400-01:adc", magnet_to_increment["STV1400-01:adc"], 100)
\ No newline at end of file
+'''
+    Bayesian tuning of STV1400-01 ends on a whole number of increments from where it started, and
+    the value it returns is the one it left the magnet at
+'''
+for seed in range(5):
+    injection.backend = SimulatedBackend({injection_efficiency_pv: flatTopResponse(stv1, 1330000, stv1_increment, 97)},
+                                         {stv1: 1330000 + (seed - 2) * 2 * stv1_increment}, put_latency=0.2, noise=1.0, seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        final_magnet_val = injection.optimizeSteeringMagnetBayesian(stv1, stv1_increment, 30)
+    print("bayesian from " + str((seed - 2) * 2) + " notches: final magnet value " + str(final_magnet_val))
+    assert final_magnet_val == injection.backend.values[stv1]
+    assert (final_magnet_val - 1330000) % stv1_increment == 0
+    assert abs(final_magnet_val - 1330000) <= 2 * stv1_increment
+
+
+#the parameter sweep scores the same setting the same whatever its worker evaluated before it
+import parameter_sweep
+
+scan_history = injection.scan_history
+switch_back_fraction = injection.switch_back_fraction
+task = {"kind": "steering", "pv": stv1, "method": "optimizeSteeringMagnetVariation2",
+        "params": {"increment_scale": 1.0, "switch_back_fraction": 0.8}, "seeds": 2}
+first = parameter_sweep.evaluate(task)
+parameter_sweep.evaluate({"kind": "steering", "pv": stv1, "method": "optimizeSteeringMagnetVariation2",
+                          "params": {"increment_scale": 2.0, "switch_back_fraction": 0.6}, "seeds": 2})
+second = parameter_sweep.evaluate(task)
+injection.scan_history = scan_history
+injection.switch_back_fraction = switch_back_fraction
+print("parameter sweep: " + str(first["mean_shots"]) + " mean shots, then " + str(second["mean_shots"]) + " evaluated again")
+assert first == second
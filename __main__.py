@@ -0,0 +1,4 @@
+#lets the directory be run as python . <phase6|injection|daemon> ..., see tuning_cli.py
+from tuning_cli import main
+
+main()
@@ -0,0 +1,322 @@
+'''
+    Asyncio versions of the optimizePV_* hill climbs, so several knobs can be tuned at once in one
+    event loop without a thread per tune:
+
+        engine = AsyncPVEngine(backend)
+        asyncio.run(engine.run(optimizePV_Standard(engine, knob_1, output_1, ...),
+                               optimizePV_Standard(engine, knob_2, output_2, ...)))
+
+    The engine wraps the backend's puts, gets and monitor updates as awaitables on top of the same
+    pieces the blocking optimizers use: every tune reads its own MeasurementChannel, with its own
+    settle times, and puts through its own MovePlanner, so samples are gated and moves merged and
+    slewed exactly as in Automate_Phase_6.py. The hill climbs make the same decisions as the blocking
+    ones, and on the simulator a tune run on its own takes the same shots.
+
+    On EPICS the put completions and monitor updates come from the CA thread and are handed to the
+    loop with call_soon_threadsafe. On a SimulatedBackend nothing happens until the virtual clock is
+    stepped, so the engine steps it whenever every tune is waiting on the backend. The tunes should
+    then only await the engine, anything else they await the clock doesn't wait for
+'''
+
+import asyncio
+
+from measurement_channel import MeasurementChannel
+from settle_times import SettleTimes
+from move_planner import MovePlanner
+from channel_manager import ChannelManager
+from shot_history import ShotHistory, LastInRange
+
+
+'''
+    backend - a pv_backend backend, EpicsBackend or SimulatedBackend. A backend with a virtual clock
+              is run by the engine, one without is waited on in real time
+'''
+class AsyncPVEngine:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.clock = getattr(backend, "clock", None)
+        self.loop = None
+
+        #one subscription per PV, shared by every tune that reads it
+        self.channels = ChannelManager()
+
+        #tunes that haven't finished, and the futures they are waiting on the backend for with their timeouts
+        self.tunes = 0
+        self.pending = {}
+
+    '''
+        Runs the tunes together until every one has finished
+        tunes - the coroutines to run, e.g. optimizePV_Standard(engine, ...)
+        returns what each tune returned, in order
+    '''
+    async def run(self, *tunes):
+        self.loop = asyncio.get_running_loop()
+        self.tunes += len(tunes)
+        tasks = [self.tune(tune) for tune in tunes]
+        if self.clock is None:
+            return list(await asyncio.gather(*tasks))
+        return list(await asyncio.gather(self.pump(), *tasks))[1:]
+
+    async def tune(self, tune):
+        try:
+            return await tune
+        finally:
+            self.tunes -= 1
+
+    '''
+        Steps the simulator's clock whenever every tune is waiting on it. Once the events of a step
+        have resolved a future, that tune runs before the clock moves again
+    '''
+    async def pump(self):
+        while self.tunes:
+            if len(self.pending) >= self.tunes and not self.clock.step():
+                raise RuntimeError("every tune is waiting on the simulator but nothing is scheduled")
+            await asyncio.sleep(0)
+
+    #calls callback(*args) on the loop, straight away if this is the loop's thread and through call_soon_threadsafe from the CA thread
+    def call(self, callback, *args):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    #a future for something the backend will do, which counts as waiting on it until it is resolved
+    def future(self):
+        future = self.loop.create_future()
+        self.pending[future] = None
+        return future
+
+    #gives a future its result, or exception, unless it already has one. Must be called on the loop
+    def resolve(self, future, result=None, exception=None):
+        if future not in self.pending:
+            return
+        timer = self.pending.pop(future)
+        if timer is not None:
+            timer.cancel()
+        if not future.done():
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    '''
+        Waits for a future from future()
+        timeout - seconds on the backend's clock before raising TimeoutError, None waits forever
+    '''
+    async def wait(self, future, timeout=None):
+        if timeout is not None and future in self.pending:
+            error = TimeoutError("nothing from the backend within " + str(timeout) + " seconds")
+            if self.clock is not None:
+                self.pending[future] = self.clock.schedule(timeout, self.resolve, future, None, error)
+            else:
+                self.pending[future] = self.loop.call_later(timeout, self.resolve, future, None, error)
+        try:
+            return await future
+        finally:
+            #cancelled while waiting, the tune isn't waiting on the backend any more
+            if future in self.pending:
+                timer = self.pending.pop(future)
+                if timer is not None:
+                    timer.cancel()
+
+    #the value of pv_name. EPICS gets block, so they are made on the loop's default executor
+    async def get(self, pv_name):
+        if self.clock is not None:
+            return self.backend.get(pv_name)
+        return await self.loop.run_in_executor(None, self.backend.get, pv_name)
+
+    #puts value and waits for the put to complete
+    async def put(self, pv_name, value, timeout=None):
+        future = self.future()
+        self.backend.put(pv_name, value, False, lambda: self.call(self.resolve, future))
+        await self.wait(future, timeout)
+
+    #calls callback with every update of pv_name until the with block ends, see channel_manager.py
+    def monitor(self, pv_name, callback):
+        return self.channels.monitor(self.backend, pv_name, callback)
+
+    #clears every subscription the tunes made
+    def close(self):
+        self.channels.close()
+
+
+'''
+    One knob tuned against one output: its measurement channel, move planner and the future it is
+    waiting on for the next sample
+    knob_max_slew - the most the knob may move in one put, None for no limit
+    settle_times - a SettleTimes, a new one learning from scratch by default
+'''
+class AsyncTune:
+
+    def __init__(self, engine, knob_pv, output_pv, best, knob_max_slew=None, settle_times=None):
+        self.engine = engine
+        self.backend = engine.backend
+        self.knob_pv = knob_pv
+        self.output_pv = output_pv
+        self.best = best
+        self.samples = MeasurementChannel(settle_times=settle_times if settle_times is not None else SettleTimes())
+        self.moves = MovePlanner(self.samples, {knob_pv: knob_max_slew} if knob_max_slew is not None else None)
+        self.waiter = None
+
+    #the monitor callback, on the CA thread or while the engine steps the simulator
+    def onChange(self, pvname=None, value=None, timestamp=None, **kw):
+        if value > 0:
+            self.samples.push(value, timestamp, self.backend.timestamp())
+        self.engine.call(self.wake)
+
+    #the sample may have been dropped as stale, or while a put was in flight, so only a pending one ends the wait
+    def wake(self):
+        if self.waiter is not None and self.samples.pending():
+            self.engine.resolve(self.waiter)
+
+    #reads the knob at the start of a run
+    async def getKnob(self):
+        knob_val = await self.engine.get(self.knob_pv)
+        self.moves.startFrom(self.backend, self.knob_pv, knob_val)
+        return knob_val
+
+    #moves the knob. The put is made when the next shot rate is needed, or at the end of the run
+    def setKnob(self, knob_val):
+        self.moves.move(self.knob_pv, knob_val)
+
+    '''
+        Makes the puts the moves asked for. Slewed steps are waited for, the last put is only waited
+        for if wait is True, otherwise the channel is held until it completes
+    '''
+    async def flush(self, wait=False):
+        for pv_name, steps in self.moves.plan(self.backend):
+            for index, value in enumerate(steps):
+                if index == len(steps) - 1 and not wait:
+                    self.moves.put(self.backend, pv_name, value, False)
+                    continue
+                done = self.engine.future()
+                self.moves.put(self.backend, pv_name, value, False, lambda done=done: self.engine.call(self.engine.resolve, done))
+                await self.engine.wait(done)
+
+    #waits for the next sample the channel lets through
+    async def sample(self, timeout=None):
+        while True:
+            sample = self.samples.poll()
+            if sample is not None:
+                return sample
+            self.waiter = self.engine.future()
+            try:
+                await self.engine.wait(self.waiter, timeout)
+            finally:
+                self.waiter = None
+
+    #the same fitness as objectiveFunction() in Automate_Phase_6.py
+    async def objectiveFunction(self, history, timeout=None):
+        await self.flush()
+        shot_rate = (await self.sample(timeout)).value
+        history.add(shot_rate)
+        return -4 * (shot_rate - self.best) ** 2 + 1
+
+    #the mean fitness of measurements shots
+    async def measure(self, history, measurements, timeout=None):
+        sum = 0
+        for i in range(measurements):
+            sum += await self.objectiveFunction(history, timeout)
+        return sum / measurements
+
+
+'''
+    The hill climb behind every coroutine below. It steps the knob, reverses on a worse fitness and
+    stops on convergence or after max_iterations, like the optimizePV_* functions
+    shrink - function of (step, iteration) called on every reversal, returns the next step
+'''
+async def hillClimb(tune, step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements, shrink, convergence, timeout):
+    if convergence is None:
+        convergence = LastInRange(3, goal_shot_rate_min, goal_shot_rate_max)
+    history = ShotHistory(convergence)
+
+    with tune.engine.monitor(tune.output_pv, tune.onChange):
+        val = await tune.getKnob()
+        iteration = 0
+        direction = -1
+
+        tune.setKnob(val)
+        fitness = await tune.measure(history, measurements, timeout)
+
+        while True:
+
+            new_val = val + step * direction
+            tune.setKnob(new_val)
+            new_fitness = await tune.measure(history, measurements, timeout)
+
+            if new_fitness < fitness:
+                direction = direction * -1
+                step = shrink(step, iteration)
+                tune.setKnob(val)
+            else:
+                val = new_val
+                fitness = new_fitness
+
+            print(tune.knob_pv, " iteration: ", iteration, " knob value: ", val, " output value: ", history.last())
+
+            if history.converged():
+                break
+
+            iteration += 1
+            if iteration > max_iterations:
+                break
+
+        await tune.flush(wait=True)
+    print("Done tuning " + tune.knob_pv)
+    return history
+
+
+#the step never changes
+def constantStep(step, iteration):
+    return step
+
+
+'''
+    Coroutine version of optimizePV_Standard. Every coroutine below tunes knob_pv against
+    output_pv, whose best value is best, and returns the ShotHistory of the run
+    knob_max_slew - the most the knob may move in one put, None for no limit
+    timeout - seconds to wait for each shot before raising TimeoutError, None waits forever
+'''
+async def optimizePV_Standard(engine, knob_pv, output_pv, best, step, goal_shot_rate_min, goal_shot_rate_max, max_iterations,
+                              convergence=None, knob_max_slew=None, timeout=None):
+    tune = AsyncTune(engine, knob_pv, output_pv, best, knob_max_slew)
+    return await hillClimb(tune, step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, 1, constantStep, convergence, timeout)
+
+
+#coroutine version of optimizePV_DecreasingStep: the step starts at max_step and drops by 0.5 on every reversal after the first iteration
+async def optimizePV_DecreasingStep(engine, knob_pv, output_pv, best, min_step, max_step, goal_shot_rate_min, goal_shot_rate_max,
+                                    max_iterations, convergence=None, knob_max_slew=None, timeout=None):
+    def shrink(step, iteration):
+        if iteration != 0 and step > min_step:
+            return max(step - 0.5, min_step)
+        return step
+
+    tune = AsyncTune(engine, knob_pv, output_pv, best, knob_max_slew)
+    return await hillClimb(tune, max_step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, 1, shrink, convergence, timeout)
+
+
+#coroutine version of optimizePV_MultipleMeasurements with a fixed number of measurements per adjustment
+async def optimizePV_MultipleMeasurements(engine, knob_pv, output_pv, best, step, goal_shot_rate_min, goal_shot_rate_max, max_iterations,
+                                          measurements, convergence=None, knob_max_slew=None, timeout=None):
+    tune = AsyncTune(engine, knob_pv, output_pv, best, knob_max_slew)
+    return await hillClimb(tune, step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements, constantStep, convergence,
+                           timeout)
+
+
+#coroutine version of optimizePV_MultipleMeasureMentsDecreasingStep: the step drops by step_decrease on every reversal
+async def optimizePV_MultipleMeasureMentsDecreasingStep(engine, knob_pv, output_pv, best, min_step, max_step, step_decrease,
+                                                        goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements,
+                                                        convergence=None, knob_max_slew=None, timeout=None):
+    def shrink(step, iteration):
+        if step > min_step:
+            return max(step - step_decrease, min_step)
+        return step
+
+    tune = AsyncTune(engine, knob_pv, output_pv, best, knob_max_slew)
+    return await hillClimb(tune, max_step, goal_shot_rate_min, goal_shot_rate_max, max_iterations, measurements, shrink, convergence,
+                           timeout)
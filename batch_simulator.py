@@ -0,0 +1,275 @@
+'''
+    Lockstep batch simulator: the Phase 6 step methods and the steering magnet scans re-expressed
+    as array operations over a batch of independent runs. Every run has its own start point and
+    noise, and all of them advance one iteration per set of NumPy calls, with a mask for the runs
+    that have already stopped. It is meant for algorithm studies that need thousands of runs.
+
+    It models the simulator with injection shots once per shot_period, puts that complete before
+    the next shot and gaussian noise on every shot. Given the seeds, run i draws its noise from
+    default_rng(seeds[i]), the same stream SimulatedBackend(seed=seeds[i]) uses, so it takes the same
+    steps and ends on the same value as the scalar optimizer on that seed
+'''
+
+import collections
+
+import numpy as np
+
+from scan_analysis import findFlatTopCenter
+
+
+#the outcome of every run in a batch: final knob or magnet values, shots used, whether each run converged, and virtual seconds
+BatchResult = collections.namedtuple("BatchResult", ["final_values", "shots", "converged", "seconds"])
+
+
+#the same shot rate peak as pv_backend.gaussianResponse, for an array of knob values
+def gaussianPeak(center, peak, width):
+    return lambda knob_vals: peak * np.exp(-0.5 * ((knob_vals - center) / width) ** 2)
+
+
+#the same flat top as pv_backend.flatTopResponse, for an array of magnet values
+def flatTopPeak(center, increment, peak):
+    def response(magnet_vals):
+        notches = np.abs((magnet_vals - center) / increment)
+        fall_off = np.maximum(0.0, 1.0 - 0.2 * np.maximum(notches - 2.5, 0.0) ** 1.5)
+        return peak * np.where(notches <= 2.5, 1.0, fall_off)
+    return response
+
+
+'''
+    Gaussian shot noise for every run in a batch. With seeds, each run's own stream is drawn in
+    blocks of columns as the runs use it up
+    runs - how many runs
+    noise - standard deviation of the noise
+    seeds - one seed per run to reproduce SimulatedBackend's noise exactly, or None to draw all the runs'
+            noise from one generator seeded with seed, which is much faster for large batches
+'''
+class BatchNoise:
+
+    def __init__(self, runs, noise, seeds=None, seed=None, block=256):
+        self.noise = noise
+        self.block = block
+        if seeds is not None:
+            self.generators = [np.random.default_rng(seed) for seed in seeds]
+        else:
+            self.generator = np.random.default_rng(seed)
+            self.generators = None
+        # the seeded streams, as many columns of each as have been drawn, and how far each run has got through its stream
+        self.columns = np.zeros((runs, 0))
+        self.used = np.zeros(runs, dtype=int)
+
+    #one shot of noise for each run in idx
+    def draw(self, idx):
+        if self.noise == 0:
+            return np.zeros(len(idx))
+        if self.generators is None:
+            return self.noise * self.generator.standard_normal(len(idx))
+
+        if len(idx) > 0 and self.used[idx].max() >= self.columns.shape[1]:
+            new_columns = np.stack([generator.standard_normal(self.block) for generator in self.generators])
+            self.columns = np.concatenate((self.columns, new_columns), axis=1)
+
+        samples = self.columns[idx, self.used[idx]]
+        self.used[idx] += 1
+        return self.noise * samples
+
+
+'''
+    The update rules of the four Phase 6 step methods, by the name of the optimizer. Each is
+    (where the first step comes from, how much a reversal shrinks the step, whether the first
+    iteration's reversal shrinks it), with the step size parameters named as in the optimizers
+'''
+PHASE6_METHODS = {"optimizePV_Standard": ("step", None, True),
+                  "optimizePV_DecreasingStep": ("max_step", 0.5, False),
+                  "optimizePV_MultipleMeasurements": ("step", None, True),
+                  "optimizePV_MultipleMeasureMentsDecreasingStep": ("max_step", "step_decrease", True)}
+
+
+'''
+    Runs a batch of Phase 6 tuning runs in lockstep
+    method - one of the names in PHASE6_METHODS
+    params - the optimizer's parameters by name, e.g. {"min_step": 0.5, "max_step": 2.0, "max_iterations": 100},
+             the same names parameter_sweep.py uses. measurements defaults to 1
+    starts - the starting knob value of every run
+    response - shot rate as a function of an array of knob values, e.g. gaussianPeak(117.25, 1.6, 12.6)
+    best, goal_min, goal_max - the best shot rate and the goal window, as in Automate_Phase_6.outputs
+    noise, seeds, seed - the shot noise, see BatchNoise
+    shot_period - seconds between shots
+    returns a BatchResult. converged is False for runs that stopped on max_iterations
+'''
+def phase6Batch(method, params, starts, response, best, goal_min, goal_max, noise=0.0, seeds=None, seed=None, shot_period=1.0):
+    if method not in PHASE6_METHODS:
+        raise ValueError("unknown method " + str(method) + ", expected one of " + ", ".join(PHASE6_METHODS))
+    first_step, decrease, shrink_first = PHASE6_METHODS[method]
+    decrease = params[decrease] if isinstance(decrease, str) else decrease
+    min_step = params.get("min_step", 0.0)
+    measurements = params.get("measurements", 1)
+    max_iterations = params["max_iterations"]
+
+    runs = len(starts)
+    shot_noise = BatchNoise(runs, noise, seeds, seed)
+    shots = np.zeros(runs, dtype=int)
+    fired = np.zeros(runs, dtype=int)
+    in_range_streak = np.zeros(runs, dtype=int)       # how many of the last shots were all in the goal window
+
+    #the mean fitness of measurements shots of each run in idx at knob_vals. Like onChange, shots that aren't positive are skipped
+    def measure(idx, knob_vals):
+        rates = response(knob_vals)
+        total = np.zeros(len(idx))
+        for i in range(measurements):
+            shot_rates = rates + shot_noise.draw(idx)
+            fired[idx] += 1
+            skipped = np.nonzero(shot_rates <= 0)[0]
+            while len(skipped) > 0:
+                shot_rates[skipped] = rates[skipped] + shot_noise.draw(idx[skipped])
+                fired[idx[skipped]] += 1
+                skipped = skipped[shot_rates[skipped] <= 0]
+
+            shots[idx] += 1
+            in_range = (shot_rates >= goal_min) & (shot_rates <= goal_max)
+            in_range_streak[idx] = np.where(in_range, in_range_streak[idx] + 1, 0)
+            total = total + (-4 * (shot_rates - best) ** 2 + 1)
+        return total / measurements
+
+    vals = np.array(starts, dtype=float)
+    steps = np.full(runs, float(params[first_step]))
+    directions = -np.ones(runs)
+    iterations = np.zeros(runs, dtype=int)
+    converged = np.zeros(runs, dtype=bool)
+    active = np.arange(runs)
+    fitness = measure(active, vals)
+
+    while len(active) > 0:
+        new_vals = vals[active] + steps[active] * directions[active]
+        new_fitness = measure(active, new_vals)
+
+        worse = new_fitness < fitness[active]
+        reversed_runs = active[worse]
+        directions[reversed_runs] *= -1
+        if decrease is not None:
+            shrink = reversed_runs[steps[reversed_runs] > min_step]
+            if not shrink_first:
+                shrink = shrink[iterations[shrink] != 0]
+            steps[shrink] = np.maximum(steps[shrink] - decrease, min_step)
+
+        accepted = active[~worse]
+        vals[accepted] = new_vals[~worse]
+        fitness[accepted] = new_fitness[~worse]
+
+        converged[active] = in_range_streak[active] >= 3
+        iterations[active] += 1
+        active = active[~converged[active] & (iterations[active] <= max_iterations)]
+
+    return BatchResult(vals, shots, converged, fired * shot_period)
+
+
+'''
+    The flat top center of every scan in a group of scans that are all the same length, sorted by
+    magnet value. midpoint and centroid are worked out for the whole group at once, other
+    estimators one scan at a time with scan_analysis.findFlatTopCenter
+'''
+def groupCenters(magnet_vals, injection_efficiencies, estimator):
+    groups, n = magnet_vals.shape
+    if estimator not in ("midpoint", "centroid") or n < 2:
+        return np.array([findFlatTopCenter(magnet_vals[i], injection_efficiencies[i], estimator) for i in range(groups)])
+
+    # clipTail for every scan: the worse end is cut back until the other end is the worse one
+    starts = np.zeros(groups, dtype=int)
+    ends = np.full(groups, n)
+    right_worse = injection_efficiencies[:, -1] < injection_efficiencies[:, 0]
+    keep = injection_efficiencies[:, :-1] >= injection_efficiencies[:, :1]
+    ends[right_worse] = n - 1 - np.argmax(keep[right_worse, ::-1], axis=1)
+    better = injection_efficiencies[:, 1:] > injection_efficiencies[:, -1:]
+    starts[~right_worse] = np.where(better[~right_worse].any(axis=1), np.argmax(better[~right_worse], axis=1) + 1, n - 1)
+
+    # the clipped scans with the same start and end are one rectangular block, so the sums are the ones findFlatTopCenter takes
+    centers = np.zeros(groups)
+    for start, end in set(zip(starts.tolist(), ends.tolist())):
+        rows = np.nonzero((starts == start) & (ends == end))[0]
+        vals = magnet_vals[rows, start:end]
+        midpoints = vals[:, (end - start) // 2]
+        if estimator == "midpoint":
+            centers[rows] = midpoints
+            continue
+
+        weights = injection_efficiencies[rows, start:end].copy()
+        edge = np.maximum(weights[:, 0], weights[:, -1])
+        weights[:, 0] = edge
+        weights[:, -1] = edge
+        padded = np.concatenate((weights[:, :1], weights, weights[:, -1:]), axis=1)
+        third = 1 / 3
+        weights = padded[:, :-2] * third + padded[:, 1:-1] * third + padded[:, 2:] * third
+
+        total = weights.sum(axis=1)
+        centroids = (vals * weights).sum(axis=1) / np.where(total > 0, total, 1.0)
+        nearest = vals[np.arange(len(rows)), np.argmin(np.abs(vals - centroids[:, None]), axis=1)]
+        centers[rows] = np.where(total > 0, nearest, midpoints)
+    return centers
+
+
+'''
+    Runs a batch of steering magnet scans in lockstep and moves each magnet to the center of its
+    flat top, like Automate_Injection_Tuning.tuneSteeringMagnet
+    starts - the starting magnet value of every run
+    step - the scan step, positive
+    response - injection efficiency as a function of an array of magnet values, e.g. flatTopPeak(1330000, 10000, 97)
+    max_iterations - runs whose scan goes past this many steps stop where they are and count as not converged
+    estimator - the flat top center estimator, see scan_analysis.ESTIMATORS
+    switch_back_fraction - the scan turns around once the injection efficiency drops to this fraction of the best
+    noise, seeds, seed, shot_period - the same as for phase6Batch
+    returns a BatchResult
+'''
+def steeringBatch(starts, step, response, max_iterations, estimator="centroid", switch_back_fraction=0.8,
+                  noise=0.0, seeds=None, seed=None, shot_period=1.0):
+    runs = len(starts)
+    shot_noise = BatchNoise(runs, noise, seeds, seed)
+    everyone = np.arange(runs)
+
+    starts = np.array(starts, dtype=float)
+    vals = starts.copy()
+    best_efficiencies = response(vals) + shot_noise.draw(everyone)
+
+    # the scan points in the order they were measured, the ones to the right of the start first
+    magnet_vals = np.zeros((runs, max_iterations + 1))
+    injection_efficiencies = np.zeros((runs, max_iterations + 1))
+    points = np.zeros(runs, dtype=int)
+    right_points = np.zeros(runs, dtype=int)
+    directions = np.ones(runs)
+    failed = np.zeros(runs, dtype=bool)
+    active = everyone
+
+    while len(active) > 0:
+        vals[active] = vals[active] + step * directions[active]
+        efficiencies = response(vals[active]) + shot_noise.draw(active)
+        best_efficiencies[active] = np.maximum(best_efficiencies[active], efficiencies)
+
+        magnet_vals[active, points[active]] = vals[active]
+        injection_efficiencies[active, points[active]] = efficiencies
+        points[active] += 1
+
+        dropped = efficiencies <= best_efficiencies[active] * switch_back_fraction
+        turning = active[dropped & (directions[active] == 1)]
+        finished = active[dropped & (directions[active] == -1)]
+        right_points[turning] = points[turning]
+        directions[turning] = -1
+        vals[turning] = starts[turning]
+
+        # like the scalar scan, a scan that finishes on the step after max_iterations still counts as hitting it
+        failed[active] = points[active] > max_iterations
+        done = np.zeros(runs, dtype=bool)
+        done[finished] = True
+        done[active[failed[active]]] = True
+        active = active[~done[active]]
+
+    # sort each scan by magnet value (the left points in reverse, then the right ones) and find the centers,
+    # grouping scans of the same length
+    finished = np.nonzero(~failed)[0]
+    for n in np.unique(points[finished]).tolist():
+        rows = finished[points[finished] == n]
+        left = n - right_points[rows]
+        positions = np.arange(n)[None, :]
+        order = np.where(positions < left[:, None], right_points[rows, None] + left[:, None] - 1 - positions, positions - left[:, None])
+        sorted_vals = magnet_vals[rows[:, None], order]
+        sorted_efficiencies = injection_efficiencies[rows[:, None], order]
+        vals[rows] = groupCenters(sorted_vals, sorted_efficiencies, estimator)
+
+    return BatchResult(vals, points + 1, ~failed, (points + 1) * shot_period)
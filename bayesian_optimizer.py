@@ -0,0 +1,158 @@
+import math
+
+import numpy as np
+
+
+#length scales (as a fraction of the search range) and noise-to-signal variance ratios the model chooses between
+LENGTH_SCALES = (0.05, 0.1, 0.2, 0.4, 0.8)
+NOISE_RATIOS = (0.001, 0.01, 0.1)
+
+
+'''
+    One Gaussian process hypothesis: a squared exponential kernel plus white noise with fixed
+    hyperparameters. Points are added one at a time by extending the Cholesky factor by a row
+    instead of refactoring the whole covariance matrix. The new row is a triangular solve, which
+    np.linalg.solve does as a general O(n^3) one, but with at most a few hundred points that is
+    still quicker than an O(n^2) forward substitution looped in Python
+'''
+class GaussianProcess:
+
+    def __init__(self, length_scale, noise_ratio):
+        self.length_scale = length_scale
+        self.noise_ratio = noise_ratio
+        self.x = np.empty(0)
+        self.cholesky = np.empty((0, 0))
+
+    def kernel(self, a, b):
+        return np.exp(-0.5 * ((a[:, None] - b[None, :]) / self.length_scale) ** 2)
+
+    def add(self, x):
+        k = self.kernel(self.x, np.array([x]))[:, 0]
+        c = 1.0 + self.noise_ratio
+        n = len(self.x)
+
+        cholesky = np.zeros((n + 1, n + 1))
+        cholesky[:n, :n] = self.cholesky
+        if n > 0:
+            row = np.linalg.solve(self.cholesky, k)
+            cholesky[n, :n] = row
+            c -= row @ row
+        cholesky[n, n] = math.sqrt(max(c, 1e-12))
+
+        self.cholesky = cholesky
+        self.x = np.append(self.x, x)
+
+    #K^-1 y from the two triangular solves
+    def weights(self, y):
+        return np.linalg.solve(self.cholesky.T, np.linalg.solve(self.cholesky, y))
+
+    def logMarginalLikelihood(self, y):
+        alpha = self.weights(y)
+        return -0.5 * y @ alpha - np.log(np.diag(self.cholesky)).sum() - 0.5 * len(y) * math.log(2 * math.pi)
+
+    #posterior mean and standard deviation of the noise-free response at the points x
+    def predict(self, x, y):
+        k = self.kernel(x, self.x)
+        mean = k @ self.weights(y)
+        v = np.linalg.solve(self.cholesky, k.T)
+        variance = np.maximum(1.0 - (v * v).sum(axis=0), 1e-12)
+        return mean, np.sqrt(variance)
+
+
+'''
+    Bayesian optimizer for one knob. Every measurement is expensive (at least one injection shot),
+    so it keeps a Gaussian process model of the response and picks the next setting by expected
+    improvement or an upper confidence bound. The kernel includes a white noise term, and the
+    hyperparameters are picked by marginal likelihood from a small set of hypotheses that are all
+    updated incrementally, so each iteration costs milliseconds
+    lower, upper - the search range
+    acquisition - "ei" for expected improvement or "ucb" for upper confidence bound
+    kappa - how many standard deviations of optimism the UCB acquisition uses
+    candidates - the settings the optimizer may suggest, by default an evenly spaced grid of 201 points
+'''
+class GaussianProcessOptimizer:
+
+    def __init__(self, lower, upper, acquisition="ei", kappa=2.0, candidates=None):
+        if acquisition not in ("ei", "ucb"):
+            raise ValueError("acquisition must be 'ei' or 'ucb', got " + str(acquisition))
+
+        self.lower = lower
+        self.upper = upper
+        self.acquisition = acquisition
+        self.kappa = kappa
+
+        if candidates is None:
+            candidates = np.linspace(lower, upper, 201)
+        self.candidates = np.asarray(candidates, dtype=float)
+        self.scaled_candidates = self.scale(self.candidates)
+
+        self.models = [GaussianProcess(length_scale, noise_ratio) for length_scale in LENGTH_SCALES for noise_ratio in NOISE_RATIOS]
+        self.model = self.models[0]
+        self.x = []
+        self.y = []
+
+    def scale(self, x):
+        return (np.asarray(x, dtype=float) - self.lower) / (self.upper - self.lower)
+
+    #measurements standardized to zero mean and unit variance, which is what the models are fit to
+    def standardized(self):
+        y = np.array(self.y)
+        spread = y.std() if len(y) > 1 and y.std() > 0 else 1.0
+        return (y - y.mean()) / spread, y.mean(), spread
+
+    '''
+        Adds a measurement and refits the hyperparameters
+    '''
+    def observe(self, x, y):
+        self.x.append(x)
+        self.y.append(y)
+        scaled_x = float(self.scale(x))
+        for model in self.models:
+            model.add(scaled_x)
+
+        standardized_y = self.standardized()[0]
+        self.model = max(self.models, key=lambda model: model.logMarginalLikelihood(standardized_y))
+
+    #posterior mean and standard deviation at the candidate settings, in measurement units
+    def posterior(self):
+        standardized_y, mean, spread = self.standardized()
+        posterior_mean, posterior_std = self.model.predict(self.scaled_candidates, standardized_y)
+        return posterior_mean * spread + mean, posterior_std * spread
+
+    '''
+        Returns the next setting to measure and the acquisition value there. For expected improvement
+        the value is in measurement units, so it can be used to stop once nothing more is expected
+    '''
+    def suggest(self):
+        if len(self.y) == 0:
+            return float(self.candidates[len(self.candidates) // 2]), math.inf
+
+        posterior_mean, posterior_std = self.posterior()
+
+        if self.acquisition == "ucb":
+            scores = posterior_mean + self.kappa * posterior_std
+        else:
+            # improve on the best posterior mean at a measured point rather than the best raw measurement,
+            # otherwise one lucky noisy shot makes everything else look hopeless
+            incumbent = self.bestObserved()[1]
+            improvement = posterior_mean - incumbent
+            z = improvement / posterior_std
+            cdf = 0.5 * (1.0 + np.vectorize(math.erf)(z / math.sqrt(2)))
+            pdf = np.exp(-0.5 * z * z) / math.sqrt(2 * math.pi)
+            scores = improvement * cdf + posterior_std * pdf
+
+        i = int(np.argmax(scores))
+        return float(self.candidates[i]), float(scores[i])
+
+    #the measured setting with the highest posterior mean, and that mean
+    def bestObserved(self):
+        standardized_y, mean, spread = self.standardized()
+        posterior_mean = self.model.predict(self.scale(self.x), standardized_y)[0] * spread + mean
+        i = int(np.argmax(posterior_mean))
+        return self.x[i], float(posterior_mean[i])
+
+    #the candidate setting with the highest posterior mean
+    def bestPredicted(self):
+        posterior_mean = self.posterior()[0]
+        i = int(np.argmax(posterior_mean))
+        return float(self.candidates[i]), float(posterior_mean[i])
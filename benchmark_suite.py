@@ -0,0 +1,184 @@
+'''
+    Monte-Carlo benchmark of every tuning algorithm on the simulator. Each algorithm is run over
+    many seeds, noise levels and starting offsets, and for every algorithm and noise level we
+    report percentiles of the shots it used, the (virtual) seconds it took, how far from the best
+    it finished and how often it ran out of iterations. The results are written to a JSON file so
+    that two versions of the code can be compared
+
+    usage: python benchmark_suite.py [seeds] [output file] [earlier output file to compare against]
+'''
+
+import contextlib
+import datetime
+import io
+import json
+import subprocess
+import sys
+
+import numpy as np
+
+from pv_backend import SimulatedBackend, gaussianResponse, flatTopResponse
+from scan_history import ScanHistory
+import Automate_Phase_6 as phase6
+import Automate_Injection_Tuning as injection
+
+#injection shots once a second and puts that take 0.1 s, like the machine
+shot_period = 1.0
+put_latency = 0.1
+
+#the Phase 6 shot rate peaks at the best shot rate at 117.25 degrees, as in Test_Phase_6.py
+shot_rate_pv = "PCT2403-01:mABR:fbk"
+knob_center = 117.25
+best = phase6.outputs[shot_rate_pv]["best"]
+minimum = phase6.outputs[shot_rate_pv]["min"]
+maximum = phase6.outputs[shot_rate_pv]["max"]
+shot_rate_noises = [0.0, 0.01, 0.03]
+knob_offsets = [-25.0, -12.5, 12.5, 25.0]
+
+#STV1400-01's flat top is centered on 1330000 with 97% injection efficiency
+magnet_center = 1330000
+peak_injection_efficiency = 97.0
+injection_efficiency_noises = [0.0, 1.0, 3.0]
+magnet_offsets = [-4, -2, 2, 4]       # in increments
+
+'''
+    Phase 6 algorithms, the settings are the ones the command line uses.
+    Each returns (shots, whether it stopped on max_iterations)
+'''
+def phase6Run(optimize):
+    def run():
+        history = optimize()
+        return history.shots(), not history.converged()
+    return run
+
+phase6_algorithms = {
+    "optimizePV_Standard": phase6Run(lambda: phase6.optimizePV_Standard(0.5, minimum, maximum, 100)),
+    "optimizePV_DecreasingStep": phase6Run(lambda: phase6.optimizePV_DecreasingStep(0.5, 2.0, minimum, maximum, 100)),
+    "optimizePV_MultipleMeasurements": phase6Run(lambda: phase6.optimizePV_MultipleMeasurements(0.5, minimum, maximum, 300, 3)),
+    "optimizePV_MultipleMeasureMentsDecreasingStep":
+        phase6Run(lambda: phase6.optimizePV_MultipleMeasureMentsDecreasingStep(0.5, 1.5, 0.5, minimum, maximum, 200, 3)),
+}
+
+
+#steering magnet algorithms, each returns whether it stopped on max_iterations (the shots are counted by the simulator)
+steering_algorithms = {
+    "optimizeSteeringMagnetVariation1":
+        lambda: injection.optimizeSteeringMagnetVariation1(injection.stv1, injection.stv1_increment, 100) is None,
+    "optimizeSteeringMagnetVariation2":
+        lambda: injection.optimizeSteeringMagnetVariation2(injection.stv1, injection.stv1_increment, 100) is None,
+    "optimizeSteeringMagnetVariation3":
+        lambda: injection.optimizeSteeringMagnetVariation3(injection.stv1, injection.stv1_increment, 100) is None,
+}
+
+
+def percentiles(values):
+    p10, p50, p90 = np.percentile(values, [10, 50, 90])
+    return {"p10": float(p10), "p50": float(p50), "p90": float(p90), "max": float(np.max(values)), "mean": float(np.mean(values))}
+
+
+def summarize(algorithm, noise, runs, error_unit):
+    shots, seconds, errors, hit_max = zip(*runs)
+    return {"algorithm": algorithm, "noise": noise, "runs": len(runs),
+            "shots": percentiles(shots), "seconds": percentiles(seconds),
+            "final_error": percentiles(errors), "final_error_unit": error_unit,
+            "max_iterations_rate": sum(hit_max) / len(runs)}
+
+
+'''
+    Runs every Phase 6 algorithm from every knob offset with every seed at each noise level
+    returns one summary per algorithm and noise level
+'''
+def benchmarkPhase6(seeds):
+    phase6.shot_rate_pv = shot_rate_pv
+    response = gaussianResponse(phase6.knob_pv, knob_center, best, (100 * best) ** 0.5)
+
+    summaries = []
+    for algorithm, run in phase6_algorithms.items():
+        for noise in shot_rate_noises:
+            runs = []
+            for offset in knob_offsets:
+                for seed in range(seeds):
+                    backend = SimulatedBackend({shot_rate_pv: response}, {phase6.knob_pv: knob_center + offset},
+                                               shot_period=shot_period, put_latency=put_latency, noise=noise, seed=seed)
+                    phase6.backend = backend
+                    #no run may start from what the one before it learned
+                    phase6.reset()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        shots, hit_max = run()
+                    runs.append((shots, backend.time(), abs(response(backend.values) - best), hit_max))
+            summaries.append(summarize(algorithm, noise, runs, "shot rate"))
+    return summaries
+
+
+'''
+    Runs every steering variation on STV1400-01 from every offset with every seed at each noise level
+    returns one summary per algorithm and noise level
+'''
+def benchmarkSteering(seeds):
+    injection.scan_history = ScanHistory(":memory:")
+    response = flatTopResponse(injection.stv1, magnet_center, injection.stv1_increment, peak_injection_efficiency)
+
+    summaries = []
+    for algorithm, run in steering_algorithms.items():
+        for noise in injection_efficiency_noises:
+            runs = []
+            for offset in magnet_offsets:
+                for seed in range(seeds):
+                    backend = SimulatedBackend({injection.stage_2_injection_efficiency_pv: response},
+                                               {injection.stv1: magnet_center + offset * injection.stv1_increment},
+                                               shot_period=shot_period, put_latency=put_latency, noise=noise, seed=seed)
+                    injection.backend = backend
+                    injection.reset()
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        hit_max = run()
+                    error = abs(backend.values[injection.stv1] - magnet_center) / injection.stv1_increment
+                    runs.append((backend.shots, backend.time(), error, hit_max))
+            summaries.append(summarize(algorithm, noise, runs, "increments from the flat top center"))
+    return summaries
+
+
+#the git commit the results came from, so result files from different versions can be told apart
+def version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(summaries, baseline=None):
+    earlier = {}
+    if baseline is not None:
+        earlier = {(summary["algorithm"], summary["noise"]): summary for summary in baseline["results"]}
+
+    for summary in summaries:
+        line = (summary["algorithm"] + " noise " + str(summary["noise"]) + ": shots p50 " + str(round(summary["shots"]["p50"], 1)) +
+                " p90 " + str(round(summary["shots"]["p90"], 1)) + ", " + str(round(summary["seconds"]["p50"], 1)) + " s, final error p50 " +
+                str(round(summary["final_error"]["p50"], 4)) + " p90 " + str(round(summary["final_error"]["p90"], 4)) +
+                ", max iterations hit " + str(round(100 * summary["max_iterations_rate"], 1)) + "%")
+
+        before = earlier.get((summary["algorithm"], summary["noise"]))
+        if before is not None:
+            line += (" (was shots p50 " + str(round(before["shots"]["p50"], 1)) + ", final error p50 " +
+                     str(round(before["final_error"]["p50"], 4)) + ", max iterations hit " +
+                     str(round(100 * before["max_iterations_rate"], 1)) + "%)")
+        print(line)
+
+
+if __name__ == "__main__":
+    seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    output_file = sys.argv[2] if len(sys.argv) > 2 else "benchmark_results.json"
+
+    baseline = None
+    if len(sys.argv) > 3:
+        with open(sys.argv[3]) as file:
+            baseline = json.load(file)
+
+    results = {"version": version(), "created": datetime.datetime.now().isoformat(timespec="seconds"),
+               "seeds": seeds, "shot_period": shot_period, "put_latency": put_latency,
+               "results": benchmarkPhase6(seeds) + benchmarkSteering(seeds)}
+
+    with open(output_file, "w") as file:
+        json.dump(results, file, indent=2)
+
+    report(results["results"], baseline)
+    print("Results written to " + output_file)
@@ -0,0 +1,160 @@
+'''
+    Runs the tuning scripts against soft_ioc.py over real Channel Access and reports how long the
+    CA side of every iteration takes: creating the channel and subscription, caget, caput(wait=True)
+    and how late monitor updates arrive after their shot. The optimizers are the unmodified ones in
+    Automate_Phase_6.py and Automate_Injection_Tuning.py, only their EpicsBackend is wrapped in a timer.
+    Needs pyepics and caproto
+
+    usage: python ca_benchmark.py [shot period in s] [runs] [put latency in s]
+'''
+
+import collections
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+#the soft IOC only listens on loopback, so point pyepics there before it is first imported
+os.environ["EPICS_CA_ADDR_LIST"] = "127.0.0.1"
+os.environ["EPICS_CA_AUTO_ADDR_LIST"] = "NO"
+
+from pv_backend import EpicsBackend
+from scan_history import ScanHistory
+import Automate_Phase_6 as phase6
+import Automate_Injection_Tuning as injection
+import soft_ioc
+
+
+'''
+    Passes every call through to backend and records how long each CA operation took, plus one
+    entry per iteration (from one put to the next): how long it took altogether and how much of
+    that was spent in CA calls rather than waiting for the next shot
+'''
+class TimedBackend:
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.latencies = collections.defaultdict(list)
+        self.iterations = []
+        self.last_put = None
+        self.ca_seconds = 0.0
+
+    def timed(self, operation, call, *args):
+        start = time.perf_counter()
+        result = call(*args)
+        seconds = time.perf_counter() - start
+        self.latencies[operation].append(seconds)
+        self.ca_seconds += seconds
+        return result
+
+    #an iteration ends where the next put starts
+    def startIteration(self):
+        now = time.perf_counter()
+        if self.last_put is not None:
+            self.iterations.append((now - self.last_put, self.ca_seconds))
+        self.last_put = now
+        self.ca_seconds = 0.0
+
+    def get(self, pv_name):
+        return self.timed("caget", self.backend.get, pv_name)
+
+    def put(self, pv_name, value, wait=True, callback=None):
+        self.startIteration()
+        self.timed("caput", self.backend.put, pv_name, value, wait, callback)
+
+    def subscribe(self, pv_name, callback):
+        self.last_put = None
+
+        #called on the CA thread, the timestamp is the IOC's time of the shot
+        def timedCallback(**kw):
+            self.latencies["monitor delivery"].append(time.time() - kw["timestamp"])
+            callback(**kw)
+
+        return self.timed("create_channel + create_subscription", self.backend.subscribe, pv_name, timedCallback)
+
+    def unsubscribe(self, handle):
+        self.timed("clear_subscription", self.backend.unsubscribe, handle)
+
+    def pend(self):
+        return self.backend.pend()
+
+    def time(self):
+        return self.backend.time()
+
+    def timestamp(self):
+        return self.backend.timestamp()
+
+    def sleep(self, seconds):
+        self.backend.sleep(seconds)
+
+
+#median, 90th and 99th percentile and maximum of seconds, in milliseconds
+def percentiles(seconds):
+    p50, p90, p99 = np.percentile(seconds, [50, 90, 99]) * 1000
+    return ("p50 " + str(round(p50, 2)) + " ms, p90 " + str(round(p90, 2)) + " ms, p99 " + str(round(p99, 2)) +
+            " ms, max " + str(round(max(seconds) * 1000, 2)) + " ms")
+
+
+def report(name, backend):
+    print(name)
+    for operation, seconds in backend.latencies.items():
+        print("    " + operation + " (" + str(len(seconds)) + "): " + percentiles(seconds))
+    if backend.iterations:
+        print("    iteration (" + str(len(backend.iterations)) + "): " + percentiles([i[0] for i in backend.iterations]))
+        print("    CA calls per iteration: " + percentiles([i[1] for i in backend.iterations]))
+
+
+'''
+    Starts the soft IOC in its own process and waits until its PVs answer
+    returns the process, which the caller has to terminate
+'''
+def startIOC(shot_period, put_latency):
+    ioc = subprocess.Popen([sys.executable, "soft_ioc.py", str(shot_period), "0", str(put_latency)],
+                           cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    epics = EpicsBackend().library()
+    deadline = time.monotonic() + 10
+    while epics.caget(soft_ioc.knob_pv, timeout=0.5) is None:
+        if time.monotonic() > deadline:
+            ioc.terminate()
+            raise TimeoutError("the soft IOC did not come up within 10 seconds")
+    return ioc
+
+
+if __name__ == "__main__":
+    shot_period = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    put_latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+
+    phase6.shot_rate_pv = "PCT2403-01:mABR:fbk"
+    minimum = phase6.outputs[phase6.shot_rate_pv]["min"]
+    maximum = phase6.outputs[phase6.shot_rate_pv]["max"]
+    injection.scan_history = ScanHistory(":memory:")
+
+    #(name, the optimizer, the knob it moves and where the knob starts)
+    modes = [("phase 6 decreasing step", lambda: phase6.optimizePV_DecreasingStep(0.5, 2.0, minimum, maximum, 100),
+              soft_ioc.knob_pv, soft_ioc.knob_start),
+             ("phase 6 brent line search", lambda: phase6.optimizePV_Brent(0.5, 0.05, minimum, maximum, 100),
+              soft_ioc.knob_pv, soft_ioc.knob_start),
+             ("injection variation 2", lambda: injection.optimizeSteeringMagnetVariation2(injection.stv1, injection.stv1_increment, 100),
+              injection.stv1, soft_ioc.magnet_starts[injection.stv1])]
+
+    ioc = startIOC(shot_period, put_latency)
+    try:
+        for name, optimize, knob_pv, start_val in modes:
+            backend = TimedBackend(EpicsBackend())
+            phase6.backend = backend
+            injection.backend = backend
+
+            start = time.perf_counter()
+            for run in range(runs):
+                backend.backend.put(knob_pv, start_val)
+                with contextlib.redirect_stdout(io.StringIO()):
+                    optimize()
+            report(name + ", " + str(runs) + " runs in " + str(round(time.perf_counter() - start, 1)) + " s", backend)
+    finally:
+        ioc.terminate()
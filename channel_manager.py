@@ -0,0 +1,90 @@
+'''
+    Keeps one monitor subscription per PV for the whole process and shares it among everything that
+    wants the PV's updates. An optimizer takes the updates for as long as its with block lasts:
+
+        with channels.monitor(backend, pv_name, onChange):
+            ...
+
+    Leaving the block, by returning, breaking out or raising, always stops the callbacks, so chained
+    tunes never pile up duplicate monitors. The subscription itself stays open while nobody is
+    listening, so the next tune on the same PV starts without connecting or subscribing again.
+    close(), or using the manager itself as a context manager, clears every subscription.
+'''
+
+import contextlib
+import threading
+
+
+#one subscription and the callbacks currently listening to it
+class SharedSubscription:
+
+    def __init__(self):
+        self.handle = None
+        self.consumers = []
+
+    #the callback the backend calls, handing every update to whoever is listening right now
+    def onChange(self, **kw):
+        for callback in list(self.consumers):
+            callback(**kw)
+
+
+class ChannelManager:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backend = None
+        self.subscriptions = {}
+
+    #the subscriptions belong to one backend, so they are forgotten when the optimizers are handed another
+    def use(self, backend):
+        if backend is not self.backend:
+            self.close()
+            self.backend = backend
+
+    #the shared subscription to pv_name, made the first time it is asked for
+    def subscription(self, pv_name):
+        with self.lock:
+            subscription = self.subscriptions.get(pv_name)
+            if subscription is None:
+                subscription = SharedSubscription()
+                subscription.handle = self.backend.subscribe(pv_name, subscription.onChange)
+                self.subscriptions[pv_name] = subscription
+            return subscription
+
+    '''
+        Calls callback with every update of pv_name until the with block ends
+        backend - the backend to subscribe on, the optimizer's current one
+    '''
+    @contextlib.contextmanager
+    def monitor(self, backend, pv_name, callback):
+        self.use(backend)
+        subscription = self.subscription(pv_name)
+        subscription.consumers.append(callback)
+        try:
+            yield subscription
+        finally:
+            subscription.consumers.remove(callback)
+
+    #how many callbacks are listening to pv_name right now
+    def consumers(self, pv_name):
+        subscription = self.subscriptions.get(pv_name)
+        return len(subscription.consumers) if subscription is not None else 0
+
+    #clears every subscription, the next monitor() subscribes again
+    def close(self):
+        with self.lock:
+            subscriptions = self.subscriptions
+            self.subscriptions = {}
+        for subscription in subscriptions.values():
+            self.backend.unsubscribe(subscription.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+#the manager both scripts use
+channels = ChannelManager()
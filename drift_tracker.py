@@ -0,0 +1,287 @@
+'''
+    Continuous feedback for the Phase 6 knob. The optimizePV_* methods stop once the shot rate is in
+    the window, so the linac phase drifts out of it again. The tracker instead takes every shot for
+    as long as it runs and keeps the knob near the top of the shot rate curve.
+
+    Each shot goes through a scalar Kalman filter, so the tracker judges the shot rate rather than
+    single noisy shots. The noise it filters with is learned from the shots as they come. While
+    the filtered shot rate is within deadband of the target nothing is moved. Below that, the
+    knob is stepped one way. If the shot rate comes out significantly worse than at the best
+    setpoint so far, the knob goes back there and steps the other way. Two reversals in a row mean the top has been bracketed, so the knob goes back
+    and the tracker waits, longer each time, before probing again. Corrections are limited to
+    max_rate degrees per second.
+
+    Everything is kept in a fixed number of attributes, so each shot takes O(1) time and memory no
+    matter how long it runs.
+'''
+
+import math
+
+
+'''
+    A scalar Kalman filter of the shot rate at the current knob value, modelled as a random walk
+    drift_ratio - how far the shot rate may wander between shots, as a fraction of the noise variance.
+                  Smaller averages over more shots, 0.01 averages over about 10
+'''
+class ShotRateFilter:
+
+    def __init__(self, drift_ratio=0.01):
+        self.drift_ratio = drift_ratio
+        self.estimate = None
+        self.variance = 0.0
+        self.shots = 0
+
+    #forgets the shot rate, e.g. once the knob has moved
+    def reset(self):
+        self.estimate = None
+        self.variance = 0.0
+        self.shots = 0
+
+    #noise_variance - the variance of a single shot
+    def add(self, shot_rate, noise_variance):
+        self.shots += 1
+        if self.estimate is None:
+            self.estimate = shot_rate
+            self.variance = noise_variance
+            return self.estimate
+
+        self.variance += self.drift_ratio * noise_variance
+        gain = self.variance / (self.variance + noise_variance)
+        self.estimate += gain * (shot_rate - self.estimate)
+        self.variance *= 1.0 - gain
+        return self.estimate
+
+
+'''
+    Decides knob corrections one shot at a time
+    knob_val - where the knob is when the feedback starts
+    target - the shot rate to keep, the top of the curve
+    deadband - no correction is made while the filtered shot rate is no more than this below target
+    goal_shot_rate_min, goal_shot_rate_max - the window, for the time in the window metric
+    step - the size of one correction in degrees
+    max_rate - the most the knob may move, in degrees per second
+    settle_shots - shots ignored after every correction, until the shot rate belongs to the new setpoint
+    average_shots - shots filtered after that before the correction is judged or the next one is made
+    hold_below - shot rates below this hold the feedback, e.g. while the beam is down. It resumes once they are back
+    max_offset - the furthest the knob may be moved from knob_val. The feedback holds there until resume() is called
+    max_backoff - the most shots to wait after bracketing the top before probing again
+'''
+class DriftTracker:
+
+    def __init__(self, knob_val, target, deadband, goal_shot_rate_min, goal_shot_rate_max, step, max_rate=0.5, settle_shots=1,
+                 average_shots=5, hold_below=0.0, max_offset=20.0, max_backoff=1000, drift_ratio=0.01):
+        self.knob = knob_val
+        self.start = knob_val
+        self.target = target
+        self.deadband = deadband
+        self.low = goal_shot_rate_min
+        self.high = goal_shot_rate_max
+        self.step = step
+        self.max_rate = max_rate
+        self.settle_shots = settle_shots
+        self.average_shots = average_shots
+        self.hold_below = hold_below
+        self.max_offset = max_offset
+        self.max_backoff = max_backoff
+
+        self.filter = ShotRateFilter(drift_ratio)
+        self.noise_variance = None
+        self.previous = None
+
+        self.direction = 1
+        # (filtered shot rate, its variance, knob value) at the best setpoint since the shot rate fell
+        # out of the deadband, which every correction is judged against so a slow slide down the
+        # curve is noticed even when no single step is significantly worse. None while in the deadband
+        self.reference = None
+        # whether the last correction hasn't been judged yet
+        self.probing = False
+        self.reversals_in_row = 0
+        self.skip = settle_shots
+        self.wait = 0
+        self.backoff = average_shots
+        self.last_move_time = None
+
+        # why the feedback is held, None while it is running. hold() and resume() may be called from
+        # another thread, so they only set these and add() does the rest
+        self.held = None
+        self.restart = False
+        self.good_shots = 0
+
+        # metrics
+        self.shots = 0
+        self.corrections = 0
+        self.reversals = 0
+        self.backoffs = 0
+        self.holds = 0
+        self.travel = 0.0
+        self.seconds = 0.0
+        self.seconds_in_window = 0.0
+        self.seconds_held = 0.0
+        self.last_time = None
+
+    #stops correcting until resume(), e.g. for an operator. Holds for no shots or a low shot rate resume by themselves
+    def hold(self, reason="held by operator"):
+        if self.held is None:
+            self.holds += 1
+        self.held = reason
+        self.restart = True
+
+    def resume(self):
+        self.held = None
+        self.restart = True
+
+    '''
+        Takes one shot
+        time - when it was taken, for the correction rate limit and the time in the window
+        returns the knob value to move to, or None to leave the knob where it is
+    '''
+    def add(self, shot_rate, time):
+        self.shots += 1
+        if self.last_time is not None:
+            seconds = time - self.last_time
+            self.seconds += seconds
+            if self.held is not None:
+                self.seconds_held += seconds
+            shown = self.filter.estimate if self.filter.estimate is not None else shot_rate
+            if self.low <= shown <= self.high:
+                self.seconds_in_window += seconds
+        self.last_time = time
+
+        if shot_rate < self.hold_below:
+            self.good_shots = 0
+            if self.held is None:
+                self.hold("low shot rate")
+            return None
+        self.good_shots += 1
+
+        #held for a low shot rate until average_shots good shots in a row, so a noisy beam doesn't toggle it every shot
+        if self.held == "no shots" or (self.held == "low shot rate" and self.good_shots >= self.average_shots):
+            self.resume()
+        if self.restart:
+            self.restart = False
+            self.forget()
+            self.reference = None
+            self.probing = False
+            self.skip = self.settle_shots
+        if self.held is not None:
+            return None
+
+        if self.skip > 0:
+            self.skip -= 1
+            return None
+
+        self.learnNoise(shot_rate)
+        estimate = self.filter.add(shot_rate, self.noise_variance)
+        if self.filter.shots < self.average_shots:
+            return None
+
+        if self.probing:
+            self.probing = False
+            reference_estimate, reference_variance, reference_knob = self.reference
+            if estimate < reference_estimate - 2.0 * math.sqrt(reference_variance + self.filter.variance):
+                self.reversals += 1
+                self.reversals_in_row += 1
+                self.direction = -self.direction
+
+                #bracketed the top: go back to the best setpoint and leave it there for a while
+                if self.reversals_in_row >= 2:
+                    self.reversals_in_row = 0
+                    self.backoffs += 1
+                    self.wait = self.backoff
+                    self.backoff = min(2 * self.backoff, self.max_backoff)
+                    self.reference = None
+                    return self.moveTo(reference_knob, time)
+
+                #the other way from the best setpoint, still judged against it
+                return self.correct(reference_knob + self.direction * self.step, time)
+            if estimate > reference_estimate:
+                self.reference = (estimate, self.filter.variance, self.knob)
+                self.reversals_in_row = 0
+
+        if self.wait > 0:
+            self.wait -= 1
+            return None
+        if estimate >= self.target - self.deadband:
+            self.reference = None
+            self.backoff = self.average_shots
+            return None
+        if self.reference is None:
+            self.reference = (estimate, self.filter.variance, self.knob)
+        return self.correct(self.knob + self.direction * self.step, time)
+
+    #how noisy single shots are, from the differences between consecutive shots at the same setpoint
+    def learnNoise(self, shot_rate):
+        if self.previous is not None:
+            variance = max((shot_rate - self.previous) ** 2 / 2.0, 1e-12)
+            if self.noise_variance is None:
+                self.noise_variance = variance
+            else:
+                self.noise_variance += 0.05 * (variance - self.noise_variance)
+        elif self.noise_variance is None:
+            self.noise_variance = 1e-12
+        self.previous = shot_rate
+
+    def forget(self):
+        self.filter.reset()
+        self.previous = None
+
+    #a correction towards target, no further than max_rate allows since the last one
+    def correct(self, target, time):
+        if abs(target - self.start) > self.max_offset:
+            self.hold("reached max_offset")
+            return None
+        if self.last_move_time is not None:
+            allowed = self.max_rate * (time - self.last_move_time)
+            if allowed <= 0:
+                return None
+            target = min(max(target, self.knob - allowed), self.knob + allowed)
+        self.probing = True
+        return self.moveTo(target, time)
+
+    def moveTo(self, target, time):
+        self.corrections += 1
+        self.travel += abs(target - self.knob)
+        self.knob = target
+        self.last_move_time = time
+        self.skip = self.settle_shots
+        self.forget()
+        return target
+
+    #the live metrics, as a dictionary of name to number
+    def metrics(self):
+        return {"shots": self.shots, "corrections": self.corrections, "reversals": self.reversals, "backoffs": self.backoffs,
+                "holds": self.holds, "held": self.held is not None, "knob": self.knob, "travel": self.travel,
+                "shot_rate": self.filter.estimate, "noise": math.sqrt(self.noise_variance) if self.noise_variance is not None else None,
+                "seconds": self.seconds, "seconds_in_window": self.seconds_in_window, "seconds_held": self.seconds_held,
+                "fraction_in_window": self.seconds_in_window / self.seconds if self.seconds > 0 else None}
+
+    def report(self):
+        metrics = self.metrics()
+        line = "Feedback: knob " + str(round(self.knob, 3)) + ", shot rate " + \
+               (str(round(metrics["shot_rate"], 4)) if metrics["shot_rate"] is not None else "-") + ", " + \
+               str(round(100 * (metrics["fraction_in_window"] or 0.0), 1)) + "% of " + str(round(self.seconds)) + " s in the window, " + \
+               str(self.corrections) + " corrections, " + str(self.reversals) + " reversals"
+        if self.held is not None:
+            line += ", held: " + self.held
+        return line
+
+    #rewrites a Prometheus-style text file with the live metrics
+    def writeMetrics(self, path):
+        metrics = self.metrics()
+        lines = []
+        for name, help in [("shots", "Shots taken by the feedback"), ("corrections", "Knob corrections made"),
+                           ("reversals", "Corrections that made the shot rate worse and were turned around"),
+                           ("backoffs", "Times the top was bracketed and probing paused"), ("holds", "Times the feedback was held"),
+                           ("travel", "Degrees the knob has been moved"), ("seconds", "Seconds of feedback"),
+                           ("seconds_in_window", "Seconds the filtered shot rate was inside the window"),
+                           ("seconds_held", "Seconds the feedback was held")]:
+            lines += ["# HELP tuning_feedback_" + name + "_total " + help, "# TYPE tuning_feedback_" + name + "_total counter",
+                      "tuning_feedback_" + name + "_total " + repr(metrics[name])]
+        for name, help in [("knob", "Where the feedback has put the knob"), ("shot_rate", "The filtered shot rate"),
+                           ("noise", "The standard deviation of a single shot"), ("held", "1 while the feedback is held")]:
+            if metrics[name] is not None:
+                lines += ["# HELP tuning_feedback_" + name + " " + help, "# TYPE tuning_feedback_" + name + " gauge",
+                          "tuning_feedback_" + name + " " + repr(float(metrics[name]))]
+
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
@@ -0,0 +1,186 @@
+'''
+    Lightweight instrumentation for the tuning scripts. The optimizers wrap what they wait on in
+    spans (put, wait for sample, compute) and count shots, reversals and step size changes, and the
+    move planner counts the moves asked for and the puts actually made.
+    At the end of each run the spans are written to a JSON-lines trace, the totals over every run
+    to a Prometheus-style text file, and a latency budget is printed showing where the time went.
+
+    It is off by default. While it is off span() hands back one shared do-nothing context manager
+    and count() returns straight away, so the optimizers pay a function call per put or shot.
+    Set TUNING_TRACE to a file prefix to turn it on from the command line, e.g.
+    TUNING_TRACE=trace python Automate_Phase_6.py 2 writes trace.jsonl and trace.prom
+'''
+
+import contextlib
+import functools
+import json
+import os
+import time
+
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+#times one span of a run, from entering the with block to leaving it
+class Span:
+
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.tracer.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.spans.append((self.name, self.start, self.tracer.clock() - self.start))
+        return False
+
+
+'''
+    Collects the spans and counters of one run at a time
+    clock - what spans are timed with, time.perf_counter by default. On the simulator this is real
+            time, so the budget shows the Python overhead rather than the simulated wait for beam
+'''
+class Tracer:
+
+    def __init__(self, clock=time.perf_counter):
+        self.enabled = False
+        self.clock = clock
+        self.trace_path = None
+        self.metrics_path = None
+
+        # the run in progress
+        self.run_name = None
+        self.run_start = 0.0
+        self.spans = []
+        self.counters = {}
+
+        # totals over every run, for the metrics file
+        self.runs = 0
+        self.run_counts = {}
+        self.run_seconds = 0.0
+        self.span_seconds = {}
+        self.span_counts = {}
+        self.counter_totals = {}
+
+    '''
+        trace_path - the JSON-lines trace every run is appended to, None for no trace
+        metrics_path - the Prometheus-style text file rewritten after every run, None for no file
+    '''
+    def enable(self, trace_path="tuning_trace.jsonl", metrics_path="tuning_metrics.prom"):
+        self.enabled = True
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+
+    def disable(self):
+        self.enabled = False
+
+    #turns tracing on if TUNING_TRACE is set, writing <prefix>.jsonl and <prefix>.prom
+    def enableFromEnvironment(self):
+        prefix = os.environ.get("TUNING_TRACE")
+        if prefix:
+            self.enable(prefix + ".jsonl", prefix + ".prom")
+
+    #a context manager timing name, or a shared one that does nothing when no run is being traced
+    def span(self, name):
+        if self.run_name is None:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def count(self, name, n=1):
+        if self.run_name is not None:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def startRun(self, name):
+        self.run_name = name
+        self.spans = []
+        self.counters = {}
+        self.run_start = self.clock()
+
+    '''
+        Ends the run: prints the latency budget, appends the spans to the trace and rewrites the metrics file
+        returns the budget, a dictionary of span name to seconds plus "other" for time outside every span
+    '''
+    def endRun(self):
+        seconds = self.clock() - self.run_start
+        budget = {}
+        span_counts = {}
+        for name, start, duration in self.spans:
+            budget[name] = budget.get(name, 0.0) + duration
+            span_counts[name] = span_counts.get(name, 0) + 1
+        budget["other"] = max(seconds - sum(budget.values()), 0.0)
+
+        self.runs += 1
+        self.run_counts[self.run_name] = self.run_counts.get(self.run_name, 0) + 1
+        self.run_seconds += seconds
+        for name in span_counts:
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + budget[name]
+            self.span_counts[name] = self.span_counts.get(name, 0) + span_counts[name]
+        for name, n in self.counters.items():
+            self.counter_totals[name] = self.counter_totals.get(name, 0) + n
+
+        self.printBudget(seconds, budget, span_counts)
+        if self.trace_path is not None:
+            self.writeTrace(seconds, budget)
+        if self.metrics_path is not None:
+            self.writeMetrics()
+
+        self.run_name = None
+        return budget
+
+    def printBudget(self, seconds, budget, span_counts):
+        print("Latency budget for " + self.run_name + ": " + str(round(seconds, 3)) + " s")
+        for name in sorted(budget, key=budget.get, reverse=True):
+            line = "    " + name.ljust(16) + str(round(budget[name], 3)).rjust(10) + " s " + \
+                   str(round(100 * budget[name] / seconds if seconds > 0 else 0.0, 1)).rjust(5) + "%"
+            if name in span_counts:
+                line += "  (" + str(span_counts[name]) + " spans, mean " + str(round(1000 * budget[name] / span_counts[name], 2)) + " ms)"
+            print(line)
+        if self.counters:
+            print("    " + ", ".join(name + ": " + str(n) for name, n in self.counters.items()))
+
+    def writeTrace(self, seconds, budget):
+        with open(self.trace_path, "a") as trace:
+            for name, start, duration in self.spans:
+                trace.write(json.dumps({"run": self.runs, "optimizer": self.run_name, "span": name,
+                                        "start": start - self.run_start, "seconds": duration}) + "\n")
+            trace.write(json.dumps({"run": self.runs, "optimizer": self.run_name, "seconds": seconds,
+                                    "budget": budget, "counters": self.counters}) + "\n")
+
+    def writeMetrics(self):
+        lines = ["# HELP tuning_runs_total Tuning runs traced, by optimizer", "# TYPE tuning_runs_total counter"]
+        lines += ['tuning_runs_total{optimizer="' + name + '"} ' + str(n) for name, n in self.run_counts.items()]
+        lines += ["# HELP tuning_run_seconds_total Seconds spent in traced runs", "# TYPE tuning_run_seconds_total counter",
+                  "tuning_run_seconds_total " + repr(self.run_seconds)]
+        lines += ["# HELP tuning_span_seconds_total Seconds spent in each kind of span", "# TYPE tuning_span_seconds_total counter"]
+        lines += ['tuning_span_seconds_total{span="' + name + '"} ' + repr(seconds) for name, seconds in self.span_seconds.items()]
+        lines += ["# HELP tuning_spans_total Spans of each kind", "# TYPE tuning_spans_total counter"]
+        lines += ['tuning_spans_total{span="' + name + '"} ' + str(n) for name, n in self.span_counts.items()]
+        lines += ["# HELP tuning_events_total Shots, reversals and step size changes", "# TYPE tuning_events_total counter"]
+        lines += ['tuning_events_total{counter="' + name + '"} ' + str(n) for name, n in self.counter_totals.items()]
+
+        with open(self.metrics_path, "w") as metrics:
+            metrics.write("\n".join(lines) + "\n")
+
+    '''
+        Decorator for an optimizer: while tracing is on, every call is one run. Calls made from
+        inside a run that is already being traced (e.g. a fallback to another optimizer) are part of it
+    '''
+    def run(self, function):
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            if not self.enabled or self.run_name is not None:
+                return function(*args, **kwargs)
+            self.startRun(function.__name__)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.endRun()
+        return traced
+
+
+#the tracer both scripts use
+tracer = Tracer()
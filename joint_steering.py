@@ -0,0 +1,246 @@
+'''
+    Optimizers that move several steering magnets at once. They work in units of each magnet's
+    increment, so a step of 1 along any axis is one notch of that magnet, and they only need a
+    function that sets all the magnets and returns one injection efficiency measurement
+'''
+
+import random
+
+import numpy as np
+
+from lock_in import LockIn, ditherPeriods
+
+
+#raised from inside the search once the evaluation budget is spent
+class EvaluationBudgetSpent(Exception):
+    pass
+
+
+'''
+    Turns points in increment units into magnet values, counts evaluations and keeps the
+    best point measured so far
+'''
+class ScaledObjective:
+
+    def __init__(self, evaluate, x0, scales, max_evaluations):
+        self.evaluate = evaluate
+        self.x0 = list(x0)
+        self.scales = list(scales)
+        self.max_evaluations = max_evaluations
+        self.evaluations = 0
+
+    def values(self, u):
+        return [x + scale * ui for x, scale, ui in zip(self.x0, self.scales, u)]
+
+    #returns the cost (-efficiency) so the searches below can minimize
+    def __call__(self, u):
+        if self.evaluations >= self.max_evaluations:
+            raise EvaluationBudgetSpent()
+        self.evaluations += 1
+        return -self.evaluate(self.values(u))
+
+
+'''
+    Nelder-Mead simplex search over all the magnets together, so coupled magnets move together
+    instead of being scanned one at a time. Injection efficiency is noisy, so every few iterations
+    the best vertex is measured again and its value averaged, which stops one lucky shot from
+    holding the simplex in place
+    evaluate - sets every magnet to the given list of values and returns the injection efficiency
+    x0 - the starting magnet values
+    scales - the increment of each magnet
+    initial_size - the size of the starting simplex, in increments
+    tolerance - stop once every vertex is within this many increments of the best one
+    max_evaluations - the most measurements (shots) to spend
+    reevaluate_every - how many iterations between re-measurements of the best vertex, 0 never re-measures
+    max_offset - how far from x0 any magnet may go, in increments. Points past it are pulled back onto the edge
+    returns (best magnet values, best efficiency, evaluations)
+'''
+def nelderMead(evaluate, x0, scales, initial_size=2.0, tolerance=1.0, max_evaluations=200, reevaluate_every=5, max_offset=10.0):
+    f = ScaledObjective(evaluate, x0, scales, max_evaluations)
+    n = len(x0)
+
+    def bounded(u):
+        return [max(-max_offset, min(max_offset, ui)) for ui in u]
+
+    # each vertex is [point, summed cost, times measured], so re-measurements can be averaged in
+    simplex = []
+    try:
+        for i in range(n + 1):
+            u = [0.0] * n
+            if i > 0:
+                u[i - 1] = initial_size
+            u = bounded(u)
+            simplex.append([u, f(u), 1])
+
+        iteration = 0
+        while True:
+            simplex.sort(key=lambda vertex: vertex[1] / vertex[2])
+            best = simplex[0][0]
+            size = max(max(abs(a - b) for a, b in zip(vertex[0], best)) for vertex in simplex[1:])
+            if size <= tolerance:
+                break
+
+            iteration += 1
+            if reevaluate_every > 0 and iteration % reevaluate_every == 0:
+                simplex[0][1] += f(best)
+                simplex[0][2] += 1
+                continue
+
+            worst = simplex[-1]
+            worst_cost = worst[1] / worst[2]
+            second_worst_cost = simplex[-2][1] / simplex[-2][2]
+            best_cost = simplex[0][1] / simplex[0][2]
+            centroid = [sum(vertex[0][j] for vertex in simplex[:-1]) / n for j in range(n)]
+
+            def along(t):
+                return bounded([c + t * (c - w) for c, w in zip(centroid, worst[0])])
+
+            reflected = along(1.0)
+            reflected_cost = f(reflected)
+
+            if reflected_cost < best_cost:
+                expanded = along(2.0)
+                expanded_cost = f(expanded)
+                if expanded_cost < reflected_cost:
+                    simplex[-1] = [expanded, expanded_cost, 1]
+                else:
+                    simplex[-1] = [reflected, reflected_cost, 1]
+            elif reflected_cost < second_worst_cost:
+                simplex[-1] = [reflected, reflected_cost, 1]
+            else:
+                # contract towards the better of the worst and reflected points
+                if reflected_cost < worst_cost:
+                    contracted = along(0.5)
+                else:
+                    contracted = along(-0.5)
+                contracted_cost = f(contracted)
+
+                if contracted_cost < min(worst_cost, reflected_cost):
+                    simplex[-1] = [contracted, contracted_cost, 1]
+                else:
+                    # shrink everything towards the best vertex
+                    for vertex in simplex[1:]:
+                        shrunk = [b + 0.5 * (v - b) for b, v in zip(best, vertex[0])]
+                        vertex[:] = [shrunk, f(shrunk), 1]
+
+    except EvaluationBudgetSpent:
+        pass
+
+    if not simplex:
+        return list(x0), None, f.evaluations
+
+    best_vertex = min(simplex, key=lambda vertex: vertex[1] / vertex[2])
+    return f.values(best_vertex[0]), -best_vertex[1] / best_vertex[2], f.evaluations
+
+
+'''
+    Simultaneous perturbation stochastic approximation (SPSA). Every iteration perturbs all the
+    magnets at once by +-c_k notches with random signs, measures injection efficiency on both
+    sides and steps every magnet along the resulting gradient estimate. That is two shots per
+    iteration however many magnets there are
+    evaluate - sets every magnet to the given list of values and returns the injection efficiency
+    x0 - the starting magnet values
+    scales - the increment of each magnet
+    iterations - how many iterations (two shots each) to run
+    perturbation - c, the size of the perturbation on the first iteration, in increments
+    initial_step - the gain a is picked so no step along the largest gradient seen so far is more than about this many increments
+    max_change - the most any one magnet may move in one iteration, in increments
+    max_offset - how far from x0 any magnet may end up, in increments
+    stability, alpha, gamma - the gain schedules a_k = a / (k + 1 + stability)^alpha and c_k = c / (k + 1)^gamma,
+                              with Spall's recommended exponents by default
+    seed - seed for the random perturbation signs
+    returns (final magnet values, evaluations)
+'''
+def spsa(evaluate, x0, scales, iterations, perturbation=1.0, initial_step=1.0, max_change=1.0, max_offset=10.0,
+         stability=None, alpha=0.602, gamma=0.101, seed=None):
+    f = ScaledObjective(evaluate, x0, scales, 2 * iterations)
+    n = len(x0)
+    random_signs = random.Random(seed)
+
+    if stability is None:
+        stability = 0.1 * iterations
+
+    u = [0.0] * n
+    largest = 0.0
+
+    for k in range(iterations):
+        c_k = perturbation / (k + 1) ** gamma
+        delta = [random_signs.choice((-1, 1)) for i in range(n)]
+
+        # f gives the cost, so the efficiency gradient is the negative of this
+        cost_plus = f([ui + c_k * di for ui, di in zip(u, delta)])
+        cost_minus = f([ui - c_k * di for ui, di in zip(u, delta)])
+        gradient = [(cost_minus - cost_plus) / (2 * c_k * di) for di in delta]
+
+        # pick the gain from the largest gradient so far. The first one alone may be nothing but noise, and a gain
+        # picked from that would throw every magnet max_change further every iteration once a real slope shows up
+        largest = max(largest, max(abs(g) for g in gradient))
+        if largest == 0:
+            continue
+        a = initial_step * (1 + stability) ** alpha / largest
+
+        a_k = a / (k + 1 + stability) ** alpha
+        for i in range(n):
+            step = max(-max_change, min(max_change, a_k * gradient[i]))
+            u[i] = max(-max_offset, min(max_offset, u[i] + step))
+
+    return f.values(u), f.evaluations
+
+
+'''
+    Extremum seeking. Every magnet is dithered around its setpoint by a small sinusoid with its own
+    period, one shot per dither step, and a lock-in picks the slope of the efficiency along each
+    magnet out of the shots. Each setpoint then moves a little up its slope every shot. Nothing is
+    scanned off the flat top, so the efficiency stays near its maximum while tuning: on the flat
+    top the slopes are zero and the magnets stay put, on a shoulder they climb back. It needs a
+    slope to follow, so it won't find a magnet so far off that the efficiency doesn't change with it
+    evaluate - sets every magnet to the given list of values and returns the injection efficiency
+    x0 - the starting magnet values
+    scales - the increment of each magnet
+    max_shots - the most shots to spend
+    amplitude - the dither amplitude in increments
+    gain - increments moved per shot per unit of efficiency slope (efficiency per increment)
+    time_constant - how many shots the lock-in averages the slopes over
+    max_step - the most any one magnet's setpoint may move in one shot, in increments
+    max_offset - how far from x0 any setpoint may end up, in increments
+    tolerance - stop once no setpoint has moved more than this many increments a shot for two of the
+                longest dither periods, after the lock-in has settled. None runs all max_shots
+    returns (final magnet setpoints without the dither, shots)
+'''
+def extremumSeeking(evaluate, x0, scales, max_shots, amplitude=1.0, gain=0.01, time_constant=10.0, max_step=0.5, max_offset=10.0,
+                    tolerance=0.02):
+    n = len(x0)
+    periods = ditherPeriods(n)
+    lock_in = LockIn(periods, time_constant)
+    x0 = np.array(x0, dtype=float)
+    scales = np.array(scales, dtype=float)
+
+    # the setpoints in increments from x0, and the dithered point measured each shot
+    u = np.zeros(n)
+    point = np.zeros(n)
+    step = np.zeros(n)
+    moved = np.zeros(n)
+    patience = 2 * max(periods)
+    quiet = 0
+
+    shots = 0
+    while shots < max_shots:
+        np.multiply(lock_in.dither(), amplitude, out=point)
+        point += u
+        point *= scales
+        point += x0
+        slopes = lock_in.add(evaluate(point.tolist()), amplitude)
+        shots += 1
+
+        np.multiply(slopes, gain, out=step)
+        np.clip(step, -max_step, max_step, out=step)
+        u += step
+        np.clip(u, -max_offset, max_offset, out=u)
+
+        if tolerance is not None and shots > time_constant:
+            quiet = quiet + 1 if np.abs(step, out=moved).max() < tolerance else 0
+            if quiet >= patience:
+                break
+
+    return (x0 + scales * u).tolist(), shots
+
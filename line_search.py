@@ -0,0 +1,208 @@
+import math
+
+
+GOLDEN_RATIO = 1.618034         # how much the bracket grows by when the parabola can't be trusted
+GOLDEN_SECTION = 0.381966       # fraction of the bracket to step into on a golden section step
+MAX_JUMP = 10.0                 # a parabolic jump may go at most this many bracket widths past the bracket
+TINY = 1e-20
+
+
+#raised from inside the search to stop it as soon as the caller is happy with the last point
+class LineSearchDone(Exception):
+    pass
+
+
+'''
+    Keeps count of the evaluations, remembers the best point seen and stops the search when the
+    caller's done() check passes or we run out of evaluations. Works in terms of cost = -fitness
+    so the bracketing and Brent steps below can be written as a minimization.
+    A point outside [lower, upper] isn't measured. It costs more than anything measured so far, so
+    the search turns back at the bound instead of extrapolating past it. A point is measured
+    repeats times and the costs averaged
+'''
+class CountedObjective:
+
+    def __init__(self, evaluate, max_evaluations, done, lower=-math.inf, upper=math.inf, repeats=1):
+        self.evaluate = evaluate
+        self.max_evaluations = max_evaluations
+        self.done = done
+        self.lower = lower
+        self.upper = upper
+        self.repeats = repeats
+        self.evaluations = 0
+        self.best_x = None
+        self.best_cost = math.inf
+        self.worst_cost = -math.inf
+        self.last_x = None
+        # calls without a measurement don't use up evaluations, so they are limited separately
+        self.unmeasured = 0
+
+    def __call__(self, x):
+        if x < self.lower or x > self.upper:
+            self.unmeasured += 1
+            if self.unmeasured > self.max_evaluations + 100:
+                raise LineSearchDone()
+            return self.worst_cost + abs(self.worst_cost) + 1.0 + abs(x - min(max(x, self.lower), self.upper))
+
+        cost = 0.0
+        for repeat in range(self.repeats):
+            if self.evaluations >= self.max_evaluations:
+                raise LineSearchDone()
+            cost -= self.evaluate(x)
+            self.evaluations += 1
+            self.last_x = x
+            if self.done is not None and self.done():
+                raise LineSearchDone()
+        cost /= self.repeats
+
+        if cost < self.best_cost:
+            self.best_x = x
+            self.best_cost = cost
+        self.worst_cost = max(self.worst_cost, cost)
+        return cost
+
+
+'''
+    Walks downhill from the first two points, growing the step and jumping to the vertex of the
+    parabola through the last three points, until the minimum is bracketed by a < b < c (or c < b < a)
+    with f(b) below both ends
+'''
+def bracketMinimum(f, ax, bx):
+    fa = f(ax)
+    fb = f(bx)
+    if fb > fa:
+        ax, bx = bx, ax
+        fa, fb = fb, fa
+
+    cx = bx + GOLDEN_RATIO * (bx - ax)
+    fc = f(cx)
+
+    while fb > fc:
+        # vertex of the parabola through a, b and c
+        r = (bx - ax) * (fb - fc)
+        q = (bx - cx) * (fb - fa)
+        u = bx - ((bx - cx) * q - (bx - ax) * r) / (2.0 * math.copysign(max(abs(q - r), TINY), q - r))
+        ulim = bx + MAX_JUMP * (cx - bx)
+
+        if (bx - u) * (u - cx) > 0.0:
+            # the vertex lies between b and c
+            fu = f(u)
+            if fu < fc:
+                return bx, u, cx, fb, fu, fc
+            elif fu > fb:
+                return ax, bx, u, fa, fb, fu
+            u = cx + GOLDEN_RATIO * (cx - bx)
+            fu = f(u)
+        elif (cx - u) * (u - ulim) > 0.0:
+            # the vertex is past c but within the allowed jump
+            fu = f(u)
+            if fu < fc:
+                bx, cx, u = cx, u, u + GOLDEN_RATIO * (u - cx)
+                fb, fc, fu = fc, fu, f(u)
+        elif (u - ulim) * (ulim - cx) >= 0.0:
+            u = ulim
+            fu = f(u)
+        else:
+            u = cx + GOLDEN_RATIO * (cx - bx)
+            fu = f(u)
+
+        ax, bx, cx = bx, cx, u
+        fa, fb, fc = fb, fc, fu
+
+    return ax, bx, cx, fa, fb, fc
+
+
+'''
+    Brent's method on a bracketed minimum: a parabolic step through the best three points so far
+    whenever it behaves, and a golden section step whenever it doesn't. The parabola is tried on
+    the very first step, since the phase response is close to parabolic
+'''
+def brentMinimize(f, ax, bx, cx, fa, fb, fc, tolerance):
+    a = min(ax, cx)
+    b = max(ax, cx)
+
+    x, fx = bx, fb
+    (w, fw), (v, fv) = sorted([(ax, fa), (cx, fc)], key=lambda point: point[1])
+    d = 0.0
+    e = b - a
+
+    while True:
+        xm = 0.5 * (a + b)
+        tol1 = tolerance
+        tol2 = 2.0 * tol1
+        if abs(x - xm) <= tol2 - 0.5 * (b - a):
+            return x, fx
+
+        use_golden_section = True
+        if abs(e) > tol1:
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2.0 * (q - r)
+            if q > 0.0:
+                p = -p
+            q = abs(q)
+            previous_e = e
+            e = d
+            # only take the parabolic step if it lands inside the bracket and is shrinking
+            if abs(p) < abs(0.5 * q * previous_e) and p > q * (a - x) and p < q * (b - x):
+                d = p / q
+                use_golden_section = False
+                if (x + d) - a < tol2 or b - (x + d) < tol2:
+                    d = math.copysign(tol1, xm - x)
+
+        if use_golden_section:
+            e = a - x if x >= xm else b - x
+            d = GOLDEN_SECTION * e
+
+        u = x + d if abs(d) >= tol1 else x + math.copysign(tol1, d)
+        fu = f(u)
+
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, w, x = w, x, u
+            fv, fw, fx = fw, fx, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, w = w, u
+                fv, fw = fw, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+
+
+'''
+    Finds the maximum of evaluate(x) along one knob with as few evaluations as possible
+    evaluate - sets the knob to x, measures and returns the fitness (bigger is better)
+    x0 - where to start
+    initial_step - the first step taken when bracketing the maximum
+    tolerance - stop once the maximum is known to within this distance
+    max_evaluations - the most evaluations (shots) to spend
+    done - optional function checked after every evaluation, the search stops at the last point as soon as it returns True
+    lower, upper - the search never measures outside these
+    repeats - how many shots to average at every point, more than 1 when single shots are noisier than the
+              differences the parabola steps are taken from
+    returns (x, evaluations, stopped_by_done). x is the last point if done() stopped the search, otherwise the best point seen,
+            or x0 if the evaluations ran out before any point had been measured repeats times
+'''
+def brentMaximize(evaluate, x0, initial_step, tolerance, max_evaluations, done=None, lower=-math.inf, upper=math.inf, repeats=1):
+    f = CountedObjective(evaluate, max_evaluations, done, lower, upper, repeats)
+    if x0 + initial_step > upper:
+        initial_step = -initial_step
+
+    try:
+        ax, bx, cx, fa, fb, fc = bracketMinimum(f, x0, x0 + initial_step)
+        brentMinimize(f, ax, bx, cx, fa, fb, fc, tolerance)
+    except LineSearchDone:
+        if done is not None and f.evaluations > 0 and done():
+            return f.last_x, f.evaluations, True
+
+    if f.best_x is None:
+        return x0, f.evaluations, False
+    return f.best_x, f.evaluations, False
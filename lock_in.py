@@ -0,0 +1,82 @@
+'''
+    Streaming lock-in detection for extremum seeking. Each magnet is dithered by a small sinusoid
+    with its own period, and the injection efficiency is multiplied by each dither and averaged.
+    That picks out how much of the efficiency moves with that magnet's dither, which is the slope
+    of the efficiency along that magnet, for every magnet at once from the same shots.
+'''
+
+import numpy as np
+
+
+#dither periods in shots. All different and none twice another, so the harmonics of one magnet's
+#dither don't land on another's
+DITHER_PERIODS = (5, 6, 7, 9, 11, 13, 17, 19)
+
+
+#the dither periods of n channels: DITHER_PERIODS, carried on with the primes after 19 for more than eight magnets
+def ditherPeriods(n):
+    periods = list(DITHER_PERIODS[:n])
+    period = DITHER_PERIODS[-1]
+    while len(periods) < n:
+        period += 1
+        if all(period % divisor for divisor in range(2, int(period ** 0.5) + 1)):
+            periods.append(period)
+    return tuple(periods)
+
+
+'''
+    One response demodulated against several dithers at once, one channel per dither. Everything
+    is allocated up front, so add() does the same few in-place numpy operations on every shot and
+    allocates no arrays, however long it runs
+    periods - the period of each channel's dither in shots, see ditherPeriods
+    time_constant - how many shots the slopes are averaged over. The response's slowly changing mean
+                    is taken out over the same number of shots
+'''
+class LockIn:
+
+    def __init__(self, periods, time_constant=10.0):
+        self.periods = np.array(periods, dtype=np.intp)
+        self.alpha = 1.0 / time_constant
+
+        # one period of each dither, the rows padded to the longest
+        longest = int(self.periods.max())
+        self.table = np.zeros(len(periods) * longest)
+        for i, period in enumerate(periods):
+            self.table[i * longest:i * longest + period] = np.sin(2 * np.pi * np.arange(period) / period)
+        self.row_starts = np.arange(len(periods), dtype=np.intp) * longest
+
+        self.shots = 0
+        self.mean = 0.0
+        self.phases = np.zeros(len(periods), dtype=np.intp)
+        self.indices = self.row_starts.copy()
+        self.reference = np.zeros(len(periods))
+        self.product = np.zeros(len(periods))
+        self.demodulated = np.zeros(len(periods))
+        self.slopes = np.zeros(len(periods))
+
+    #each channel's dither for the next shot, between -1 and 1. The same array every time, updated by add()
+    def dither(self):
+        return self.reference
+
+    '''
+        Takes the response to the shot taken with dither()
+        amplitude - the dither amplitude, the same for every channel, in the units the slopes should be per
+        returns the slope of the response along each channel. The same array every time, updated in place
+    '''
+    def add(self, response, amplitude=1.0):
+        if self.shots == 0:
+            self.mean = response
+        highpassed = response - self.mean
+        self.mean += self.alpha * highpassed
+
+        # averaged highpassed * sin, which is amplitude * slope / 2 for a response that is locally linear
+        np.multiply(self.reference, self.alpha * highpassed, out=self.product)
+        self.demodulated *= 1.0 - self.alpha
+        self.demodulated += self.product
+        np.multiply(self.demodulated, 2.0 / amplitude, out=self.slopes)
+
+        self.shots += 1
+        np.remainder(self.shots, self.periods, out=self.phases)
+        np.add(self.row_starts, self.phases, out=self.indices)
+        np.take(self.table, self.indices, out=self.reference)
+        return self.slopes
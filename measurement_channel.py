@@ -0,0 +1,195 @@
+import collections
+import math
+import threading
+import time
+
+
+#a single monitor update: the value and when it was taken
+Sample = collections.namedtuple("Sample", ["value", "timestamp"])
+
+
+#raised by waitForSample once cancel() has been called, to stop an optimizer from another thread
+class Cancelled(Exception):
+    pass
+
+
+'''
+    A thread-safe channel that carries measurements from the CA callback thread to the optimizers.
+    onChange() pushes every new value into the channel and the optimizer blocks on it until a
+    sample arrives, instead of polling a global flag. Samples are kept in arrival order so none
+    of them get lost or counted twice.
+    max_pending - how many unread samples to keep before the oldest ones get dropped
+    settle_times - a settle_times.SettleTimes. Samples timestamped before the last put completion
+                   plus the settle time of the PV that was put are then dropped as stale, and the
+                   settle times are learned from the samples that come after each put
+    max_latency - put completions are timed on our clock and the samples on the IOC's. If the samples
+                  keep arriving more than this many seconds from when they say they were taken, the
+                  clocks disagree and the sample timestamps are moved onto our clock by the difference.
+                  Otherwise a clock behind ours would make every sample look stale
+'''
+class MeasurementChannel:
+
+    def __init__(self, max_pending=1000, settle_times=None, max_latency=1.0):
+        self.condition = threading.Condition()
+        self.samples = collections.deque(maxlen=max_pending)
+        self.holds = 0
+        self.dropped = 0
+        self.cancelled = False
+
+        self.settle_times = settle_times
+        self.max_latency = max_latency
+        # samples timestamped (moved onto our clock) before this belong to an earlier setpoint, unless they
+        # arrived after gate_arrival, which bounds the wait if the clocks are off by more than we have noticed
+        self.gate = -math.inf
+        self.gate_arrival = -math.inf
+        self.stale = 0
+        # arrival time minus timestamp of the latest samples
+        self.delays = collections.deque(maxlen=20)
+        # the backend the clock offset and settle times were learned on
+        self.backend = None
+
+    '''
+        Called from the monitor callback. timestamp should be the EPICS timestamp of the update if
+        we have one, otherwise we use the time it arrived
+        arrived - when it arrived, on the clock put completions are timed on (the backend's timestamp())
+    '''
+    def push(self, value, timestamp=None, arrived=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.condition:
+            if arrived is not None:
+                self.delays.append(arrived - timestamp)
+            if self.settle_times is not None:
+                self.settle_times.observe(value, timestamp)
+            if self.holds:
+                self.dropped += 1
+                return
+            if timestamp + self.clockOffset() < self.gate and (arrived is None or arrived < self.gate_arrival):
+                self.stale += 1
+                return
+            self.samples.append(Sample(value, timestamp))
+            self.condition.notify_all()
+
+    '''
+        Drops every pending sample and every sample pushed until release() is called, e.g. while a
+        put is in flight and the readings still belong to the old setpoint. Holds nest
+    '''
+    def hold(self):
+        with self.condition:
+            self.holds += 1
+            self.dropped += len(self.samples)
+            self.samples.clear()
+
+    '''
+        Ends a hold
+        pv_name, completed_at - the PV whose put completion ended it and when, on the backend's timestamp()
+                                clock. Samples from before then, plus its settle time, are dropped as stale
+    '''
+    def release(self, pv_name=None, completed_at=None):
+        with self.condition:
+            self.holds -= 1
+            if completed_at is not None:
+                settle_time = 0.0
+                if self.settle_times is not None:
+                    self.settle_times.stepped(pv_name, completed_at - self.clockOffset())
+                    settle_time = self.settle_times.settleTime(pv_name)
+                self.gate = max(self.gate, completed_at + settle_time)
+                self.gate_arrival = max(self.gate_arrival, completed_at + settle_time + self.max_latency)
+
+    '''
+        How far the IOC's clock is behind ours, 0 unless the samples say they are off by more than
+        max_latency. The smallest delay of the latest samples is the offset plus the quickest delivery
+    '''
+    def clockOffset(self):
+        if not self.delays:
+            return 0.0
+        offset = min(self.delays)
+        return offset if abs(offset) > self.max_latency else 0.0
+
+    '''
+        Blocks until the next sample arrives and returns it
+        timeout - how many seconds to wait before raising TimeoutError, None waits forever
+        pend - the backend's pend(). It is called while nothing is pending, for backends such as the
+               simulator that deliver updates on this thread, and only once it returns False do we wait
+    '''
+    def waitForSample(self, timeout=None, pend=None):
+        with self.condition:
+            while pend is not None and len(self.samples) == 0 and not self.cancelled:
+                if not pend():
+                    break
+            if not self.condition.wait_for(lambda: len(self.samples) > 0 or self.cancelled, timeout):
+                raise TimeoutError("no new measurement within " + str(timeout) + " seconds")
+            if self.cancelled:
+                raise Cancelled("stopped waiting for a measurement")
+            return self.samples.popleft()
+
+    '''
+        The next sample if one is pending, None otherwise. For callers that can't block, such as the
+        coroutines in async_tuning.py, which wait for the monitor callback themselves
+    '''
+    def poll(self):
+        with self.condition:
+            if self.cancelled:
+                raise Cancelled("stopped waiting for a measurement")
+            return self.samples.popleft() if self.samples else None
+
+    #makes the current and every later waitForSample raise Cancelled, until resume() is called
+    def cancel(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            self.cancelled = False
+
+    '''
+        Blocks until n samples have been read and returns them oldest first
+        timeout - the time limit for all n samples together
+        pend - the same as for waitForSample
+    '''
+    def readSamples(self, n, timeout=None, pend=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        samples = []
+        while len(samples) < n:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            samples.append(self.waitForSample(remaining, pend))
+        return samples
+
+    '''
+        Returns every pending sample without blocking and empties the channel. A run starts with
+        this, so it also forgets the put completions of the last run, which may have been on another backend
+    '''
+    def drain(self):
+        with self.condition:
+            samples = list(self.samples)
+            self.samples.clear()
+            self.gate = -math.inf
+            self.gate_arrival = -math.inf
+            return samples
+
+    #the clock offset and settle times belong to one backend, so they are forgotten when the optimizers are handed another
+    def use(self, backend):
+        if backend is not self.backend:
+            self.backend = backend
+            self.reset()
+
+    #forgets everything learned from earlier samples: the clock offset, the settle times and the put completions
+    def reset(self):
+        with self.condition:
+            self.samples.clear()
+            self.delays.clear()
+            self.gate = -math.inf
+            self.gate_arrival = -math.inf
+            if self.settle_times is not None:
+                self.settle_times.reset()
+
+    def pending(self):
+        with self.condition:
+            return len(self.samples)
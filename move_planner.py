@@ -0,0 +1,144 @@
+'''
+    Sits between the optimizers and the backend and decides which puts actually get made. The
+    optimizers say where a knob should go with move() and the put only happens once they need a
+    measurement (flush) or the run ends (finish). So a revert followed straight away by the next
+    step becomes one put to the step, and a move to where the knob already is costs nothing.
+
+    Puts are made with wait=False. The measurement channel is held from the start of the put
+    until its completion callback, dropping the readings taken at the old setpoint, so waiting for
+    the next measurement overlaps the put instead of coming after it. Readings that arrive after the
+    completion but were taken before it, or before the PV has settled, are dropped by their timestamp. A PV with a maximum slew is
+    walked there in puts no bigger than that, each waited for, with the last one left to overlap.
+'''
+
+import math
+
+from instrumentation import tracer
+from run_recorder import recorder
+
+
+'''
+    channel - the MeasurementChannel the optimizer reads, which is held while a put is in flight
+    max_slew - dictionary of PV name to the most it may change in one put, PVs that aren't in it aren't limited
+'''
+class MovePlanner:
+
+    def __init__(self, channel, max_slew=None):
+        self.channel = channel
+        self.max_slew = max_slew if max_slew is not None else {}
+
+        # PV name to where it should go, for moves that haven't been put yet
+        self.targets = {}
+
+        # PV name to its setpoint as far as we know, on self.backend
+        self.setpoints = {}
+        self.backend = None
+
+        # puts made with wait=False whose completion callback hasn't come yet
+        self.in_flight = 0
+
+    #forgets the setpoints when the optimizer is handed a different backend, and the channel what it learned on the old one
+    def use(self, backend):
+        self.channel.use(backend)
+        if backend is not self.backend:
+            self.backend = backend
+            self.setpoints = {}
+            self.targets = {}
+
+    #the optimizer read pv_name at value, so a move there needs no put
+    def startFrom(self, backend, pv_name, value):
+        self.use(backend)
+        self.setpoints[pv_name] = value
+
+    #where pv_name should be the next time a measurement is taken. Replaces a move that hasn't been put yet
+    def move(self, pv_name, value):
+        tracer.count("moves")
+        if pv_name in self.targets:
+            tracer.count("merged moves")
+        self.targets[pv_name] = value
+
+    '''
+        Puts every move that is still waiting
+        wait - whether to wait for the last put to complete, otherwise the channel is held until it has
+    '''
+    def flush(self, backend, wait=False):
+        for pv_name, steps in self.plan(backend):
+            for value in steps[:-1]:
+                self.put(backend, pv_name, value, True)
+            self.put(backend, pv_name, steps[-1], wait)
+
+    '''
+        Takes every move that is still waiting, for flush() or a caller that makes the puts itself
+        such as async_tuning.py, which can't block on the slewed steps
+        returns a list of (PV name, the setpoints to put in turn)
+    '''
+    def plan(self, backend):
+        if not self.targets:
+            return []
+        self.use(backend)
+        targets = self.targets
+        self.targets = {}
+        return [(pv_name, self.slew(backend, pv_name, target)) for pv_name, target in targets.items()
+                if self.setpoints.get(pv_name) != target]
+
+    '''
+        For a run that stopped part way: forgets the moves that haven't been put and waits for the
+        puts still in flight, so their completions release the channel before the next run reads it
+        timeout - the most seconds to wait, on the backend's clock
+    '''
+    def discard(self, backend, timeout=10.0):
+        self.targets = {}
+        deadline = backend.time() + timeout
+        while self.in_flight > 0 and backend.time() < deadline:
+            backend.sleep(0.01)
+
+    #puts every move that is still waiting and waits for them, for the end of a run
+    def finish(self, backend):
+        self.flush(backend, wait=True)
+
+    #the setpoints to put on the way to target, no further apart than the maximum slew of the PV
+    def slew(self, backend, pv_name, target):
+        max_slew = self.max_slew.get(pv_name)
+        if max_slew is None:
+            return [target]
+
+        start = self.setpoints.get(pv_name)
+        if start is None:
+            start = backend.get(pv_name)
+        puts = max(math.ceil(abs(target - start) / max_slew), 1)
+        steps = [start + (target - start) * i / puts for i in range(1, puts)]
+        if isinstance(target, int):
+            steps = [int(round(step)) for step in steps]
+        return steps + [target]
+
+    '''
+        Puts one setpoint, holding the channel until it completes
+        done - called once the put has completed, after the channel is released
+    '''
+    def put(self, backend, pv_name, value, wait, done=None):
+        with self.channel.condition:
+            self.channel.hold()
+            self.in_flight += 1
+
+        # called from the CA thread on the machine
+        def completed():
+            completed_at = backend.timestamp()
+            recorder.put(pv_name, value, backend.time(), completed_at)
+            with self.channel.condition:
+                self.in_flight -= 1
+                self.channel.release(pv_name, completed_at)
+            if done is not None:
+                done()
+
+        try:
+            with tracer.span("put"):
+                backend.put(pv_name, value, wait, completed)
+        except Exception:
+            #a put that failed (a CA timeout or disconnect) never completes, so nothing else would end its hold
+            with self.channel.condition:
+                self.in_flight -= 1
+                self.channel.release()
+            self.setpoints.pop(pv_name, None)
+            raise
+        tracer.count("puts")
+        self.setpoints[pv_name] = value
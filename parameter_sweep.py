@@ -0,0 +1,258 @@
+'''
+    Hyperparameter sweep for the tuning constants: the step sizes, step_decrease, measurements and
+    max_iterations of the Phase 6 methods for each PV in outputs, and the increment and switch back
+    fraction of the steering scans for each magnet. Every setting is run on the simulator over a
+    number of seeds and starting offsets, spread over all cores with a ProcessPoolExecutor, and
+    scored on the expected shots to converge: the mean shots of a run divided by the fraction of
+    runs that converged (what it costs on average if failed runs are started over).
+
+    Every finished setting is appended to a checkpoint file, so an interrupted sweep picks up
+    where it stopped when run again. The best setting for each PV and magnet is written to a
+    recommended configuration file
+
+    usage: python parameter_sweep.py [seeds] [random samples per method, 0 for the whole grid]
+'''
+
+import concurrent.futures
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sys
+
+from pv_backend import SimulatedBackend, gaussianResponse, flatTopResponse
+from scan_history import ScanHistory
+from shot_history import LastInRange
+import Automate_Phase_6 as phase6
+import Automate_Injection_Tuning as injection
+from benchmark_suite import shot_period, put_latency, knob_center, knob_offsets, magnet_offsets, peak_injection_efficiency
+
+checkpoint_file = "sweep_checkpoint.jsonl"
+config_file = "tuning_config.json"
+
+#shot noise as a fraction of each PV's goal window, and on the injection efficiency in percent
+shot_rate_noise_fraction = 0.1
+injection_efficiency_noise = 1.0
+
+#center of each magnet's flat top in the simulated machine, the same as in soft_ioc.py
+magnet_centers = {injection.stv1: 1330000, injection.stv2: 260000, injection.stv3: 240000,
+                  injection.sth1: 2300000, injection.sth2: 200000, injection.sth3: 700000}
+
+#the values each parameter is swept over
+phase6_grids = {
+    "optimizePV_Standard": {"step": [0.25, 0.5, 1.0, 2.0], "max_iterations": [100, 200]},
+    "optimizePV_DecreasingStep": {"min_step": [0.1, 0.25, 0.5, 1.0], "max_step": [1.0, 1.5, 2.0, 3.0, 4.0],
+                                  "max_iterations": [100, 200]},
+    "optimizePV_MultipleMeasurements": {"step": [0.25, 0.5, 1.0, 2.0], "measurements": [1, 2, 3, 5],
+                                        "max_iterations": [300]},
+    "optimizePV_MultipleMeasureMentsDecreasingStep": {"min_step": [0.1, 0.25, 0.5, 1.0], "max_step": [1.0, 1.5, 2.0, 3.0],
+                                                      "step_decrease": [0.25, 0.5, 0.75], "measurements": [1, 2, 3, 5],
+                                                      "max_iterations": [200]},
+}
+
+#the increment as a multiple of the one in Automate_Injection_Tuning.py
+steering_grid = {"increment_scale": [0.5, 0.75, 1.0, 1.5, 2.0], "switch_back_fraction": [0.6, 0.7, 0.8, 0.9]}
+
+
+'''
+    Every combination of the values in grid, or samples combinations picked at random
+    returns a list of dictionaries of parameter name to value
+'''
+def sweepPoints(grid, samples=0, seed=0):
+    names = sorted(grid)
+    points = [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+    if samples and samples < len(points):
+        points = random.Random(seed).sample(points, samples)
+    return points
+
+
+#calls the Phase 6 method with the swept parameters and the goal window of the PV being tuned
+def runPhase6(method, params, minimum, maximum):
+    if method == "optimizePV_Standard":
+        return phase6.optimizePV_Standard(params["step"], minimum, maximum, params["max_iterations"])
+    if method == "optimizePV_DecreasingStep":
+        return phase6.optimizePV_DecreasingStep(params["min_step"], params["max_step"], minimum, maximum, params["max_iterations"])
+    if method == "optimizePV_MultipleMeasurements":
+        return phase6.optimizePV_MultipleMeasurements(params["step"], minimum, maximum, params["max_iterations"],
+                                                      params["measurements"], convergence=LastInRange(3, minimum, maximum))
+    return phase6.optimizePV_MultipleMeasureMentsDecreasingStep(params["min_step"], params["max_step"], params["step_decrease"],
+                                                                minimum, maximum, params["max_iterations"], params["measurements"])
+
+
+'''
+    Runs one setting of one Phase 6 method on one PV over every seed and starting offset
+    returns (total shots, runs that converged, runs)
+'''
+def evaluatePhase6(pv_name, method, params, seeds):
+    #a worker evaluates many settings, and none of them may depend on what it evaluated before
+    phase6.reset()
+    phase6.shot_rate_pv = pv_name
+    best = phase6.outputs[pv_name]["best"]
+    minimum = phase6.outputs[pv_name]["min"]
+    maximum = phase6.outputs[pv_name]["max"]
+    response = gaussianResponse(phase6.knob_pv, knob_center, best, (100 * best) ** 0.5)
+    noise = shot_rate_noise_fraction * (maximum - minimum)
+
+    shots = 0
+    converged = 0
+    runs = 0
+    for offset in knob_offsets:
+        for seed in range(seeds):
+            phase6.backend = SimulatedBackend({pv_name: response}, {phase6.knob_pv: knob_center + offset},
+                                              shot_period=shot_period, put_latency=put_latency, noise=noise, seed=seed)
+            with contextlib.redirect_stdout(io.StringIO()):
+                history = runPhase6(method, params, minimum, maximum)
+            shots += history.shots()
+            converged += history.converged()
+            runs += 1
+    return shots, converged, runs
+
+
+'''
+    Runs one setting of variation 2 on one magnet over every seed and starting offset. A run
+    converged if the scan finished and left the magnet on the flat top
+    returns (total shots, runs that converged, runs)
+'''
+def evaluateSteering(pv_name, params, seeds):
+    injection.reset()
+    injection.scan_history = ScanHistory(":memory:")
+    injection.switch_back_fraction = params["switch_back_fraction"]
+    nominal_increment = injection.magnet_to_increment[pv_name]
+    increment = nominal_increment * params["increment_scale"]
+    center = magnet_centers[pv_name]
+    response = flatTopResponse(pv_name, center, nominal_increment, peak_injection_efficiency)
+
+    shots = 0
+    converged = 0
+    runs = 0
+    for offset in magnet_offsets:
+        for seed in range(seeds):
+            backend = SimulatedBackend({injection.stage_2_injection_efficiency_pv: response}, {pv_name: center + offset * nominal_increment},
+                                       shot_period=shot_period, put_latency=put_latency, noise=injection_efficiency_noise, seed=seed)
+            injection.backend = backend
+            with contextlib.redirect_stdout(io.StringIO()):
+                final_val = injection.optimizeSteeringMagnetVariation2(pv_name, increment, 100)
+            shots += backend.shots
+            converged += final_val is not None and abs(final_val - center) <= 2.5 * nominal_increment
+            runs += 1
+    return shots, converged, runs
+
+
+'''
+    Evaluates one task in a worker process. A task is a dictionary with the kind ("phase6" or
+    "steering"), the PV, the method, the parameters and how many seeds to run
+    returns the task with the results added
+'''
+def evaluate(task):
+    if task["kind"] == "phase6":
+        shots, converged, runs = evaluatePhase6(task["pv"], task["method"], task["params"], task["seeds"])
+    else:
+        shots, converged, runs = evaluateSteering(task["pv"], task["params"], task["seeds"])
+
+    result = dict(task)
+    result["mean_shots"] = shots / runs
+    result["success_rate"] = converged / runs
+    result["expected_shots"] = shots / converged if converged else None
+    return result
+
+
+#what identifies a task in the checkpoint file
+def taskKey(task):
+    return json.dumps([task["kind"], task["pv"], task["method"], task["params"], task["seeds"]], sort_keys=True)
+
+
+def makeTasks(seeds, samples):
+    tasks = []
+    for pv_name in phase6.outputs:
+        for method, grid in phase6_grids.items():
+            for params in sweepPoints(grid, samples):
+                tasks.append({"kind": "phase6", "pv": pv_name, "method": method, "params": params, "seeds": seeds})
+    for pv_name in injection.magnet_to_increment:
+        for params in sweepPoints(steering_grid, samples):
+            tasks.append({"kind": "steering", "pv": pv_name, "method": "optimizeSteeringMagnetVariation2", "params": params,
+                          "seeds": seeds})
+    return tasks
+
+
+#results already in the checkpoint file, by task key
+def loadCheckpoint(path):
+    results = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            for line in file:
+                if line.strip():
+                    result = json.loads(line)
+                    results[taskKey(result)] = result
+    return results
+
+
+'''
+    Runs every task that isn't in the checkpoint yet on a process pool, appending each result to
+    the checkpoint as it finishes
+    returns every result, the earlier ones included
+'''
+def sweep(tasks, path=checkpoint_file, workers=None):
+    results = loadCheckpoint(path)
+    remaining = [task for task in tasks if taskKey(task) not in results]
+    print(str(len(tasks) - len(remaining)) + " of " + str(len(tasks)) + " settings already in " + path)
+
+    with open(path, "a") as checkpoint, concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(evaluate, task) for task in remaining]
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            result = future.result()
+            results[taskKey(result)] = result
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            if done % 50 == 0 or done == len(futures):
+                print(str(done) + " of " + str(len(futures)) + " settings done")
+
+    return [results[taskKey(task)] for task in tasks]
+
+
+#the setting with the fewest expected shots, settings that never converged lose to any that did
+def bestResult(results):
+    return min(results, key=lambda result: (result["expected_shots"] is None, result["expected_shots"] or 0.0, -result["success_rate"]))
+
+
+'''
+    The recommended configuration: for each Phase 6 PV the best method and its parameters (and the
+    best parameters of every other method), and for each magnet the best increment and switch back fraction
+'''
+def recommend(results):
+    config = {"phase6": {}, "steering": {}}
+
+    for pv_name in phase6.outputs:
+        by_method = {}
+        for method in phase6_grids:
+            best = bestResult([r for r in results if r["kind"] == "phase6" and r["pv"] == pv_name and r["method"] == method])
+            by_method[method] = {"params": best["params"], "expected_shots": best["expected_shots"], "success_rate": best["success_rate"]}
+        method = min(by_method, key=lambda m: (by_method[m]["expected_shots"] is None, by_method[m]["expected_shots"] or 0.0))
+        config["phase6"][pv_name] = {"method": method, "params": by_method[method]["params"],
+                                     "expected_shots": by_method[method]["expected_shots"], "by_method": by_method}
+
+    for pv_name in injection.magnet_to_increment:
+        best = bestResult([r for r in results if r["kind"] == "steering" and r["pv"] == pv_name])
+        config["steering"][pv_name] = {"increment": injection.magnet_to_increment[pv_name] * best["params"]["increment_scale"],
+                                       "switch_back_fraction": best["params"]["switch_back_fraction"],
+                                       "expected_shots": best["expected_shots"], "success_rate": best["success_rate"]}
+    return config
+
+
+if __name__ == "__main__":
+    seeds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+
+    results = sweep(makeTasks(seeds, samples))
+    config = recommend(results)
+    with open(config_file, "w") as file:
+        json.dump(config, file, indent=2)
+
+    for pv_name, recommended in config["phase6"].items():
+        print(pv_name + ": " + recommended["method"] + " " + str(recommended["params"]) + ", " +
+              str(round(recommended["expected_shots"] or float("nan"), 1)) + " expected shots")
+    for pv_name, recommended in config["steering"].items():
+        print(pv_name + ": increment " + str(recommended["increment"]) + ", switch back at " +
+              str(recommended["switch_back_fraction"]) + ", " + str(round(recommended["expected_shots"] or float("nan"), 1)) + " expected shots")
+    print("Recommended configuration written to " + config_file)
@@ -0,0 +1,287 @@
+'''
+    The tuning scripts only talk to the machine through a backend with get, put and subscribe, so
+    the same optimizers can run on EPICS or on the simulator below. Monitor callbacks are called
+    with pyepics-style keyword arguments: callback(pvname=..., value=..., timestamp=...)
+'''
+
+import math
+import time
+
+import numpy as np
+
+from virtual_clock import VirtualClock
+
+
+'''
+    The real machine through pyepics. epics is only imported the first time it is needed, so the
+    scripts can be imported and run on the simulator on machines without pyepics or libca
+'''
+class EpicsBackend:
+
+    def __init__(self):
+        self.epics = None
+        self.pvs = {}
+
+    def library(self):
+        if self.epics is None:
+            import epics
+            self.epics = epics
+        return self.epics
+
+    #connected PVs by name, so each channel is searched for and connected once per process rather than once per call.
+    #auto_monitor is off because the only monitors we want are the ones subscribe() makes
+    def pv(self, pv_name):
+        pv = self.pvs.get(pv_name)
+        if pv is None:
+            pv = self.library().get_pv(pv_name, connect=True, auto_monitor=False)
+            self.pvs[pv_name] = pv
+        return pv
+
+    def get(self, pv_name):
+        return self.pv(pv_name).get()
+
+    #with a callback, callback() is called from the CA thread once the put has completed
+    def put(self, pv_name, value, wait=True, callback=None):
+        if callback is None:
+            self.pv(pv_name).put(value, wait=wait)
+        else:
+            self.pv(pv_name).put(value, wait=wait, use_complete=True, callback=lambda **kw: callback())
+
+    def subscribe(self, pv_name, callback):
+        ca = self.library().ca
+        channel = self.pv(pv_name).chid
+        # create_subscription returns (callback reference, user argument reference, event id), which has to be
+        # kept alive for as long as the subscription is. use_time asks for DBR_TIME updates, without it the
+        # callbacks get no timestamp
+        return ca.create_subscription(channel, use_time=True, callback=callback)
+
+    def unsubscribe(self, handle):
+        self.library().ca.clear_subscription(handle[2])
+
+    #monitor updates arrive on the CA thread on their own, so there is nothing to deliver here
+    def pend(self):
+        return False
+
+    def time(self):
+        return time.monotonic()
+
+    #now on the clock of the EPICS timestamps, which unlike time() is the wall clock
+    def timestamp(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+#a response curve that is a downward parabola in one knob, like the simulated shot rate in Test_Phase_6.py
+def parabolaResponse(knob_pv, center, peak, curvature):
+    return lambda values: peak - curvature * (values[knob_pv] - center) ** 2
+
+
+'''
+    A gaussian peak in one knob. Near the top it is the same as a parabola with curvature
+    peak / (2 width^2), but it stays positive far from the peak, so the readings never drop out
+    the way a parabola's do once it goes negative
+'''
+def gaussianResponse(knob_pv, center, peak, width):
+    return lambda values: peak * math.exp(-0.5 * ((values[knob_pv] - center) / width) ** 2)
+
+
+#flat for 2.5 increments either side of the center, then falling off like the STV1400-01 table in Test_Injection_Tuning.py
+def flatTop(notches):
+    notches = abs(notches)
+    if notches <= 2.5:
+        return 1.0
+    return max(0.0, 1.0 - 0.2 * (notches - 2.5) ** 1.5)
+
+
+#an injection efficiency with a flat top of height peak around center in one steering magnet
+def flatTopResponse(knob_pv, center, increment, peak):
+    return lambda values: peak * flatTop((values[knob_pv] - center) / increment)
+
+
+'''
+    A response curve given as a table of knob value to reading, like the STV1400-01 table in
+    Test_Injection_Tuning.py. Readings between table entries are interpolated and knob values past
+    either end read the same as that end, so a scan that runs off the table doesn't raise KeyError
+'''
+def tableResponse(knob_pv, table):
+    knob_vals = np.array(sorted(table), dtype=float)
+    readings = np.array([table[knob_val] for knob_val in sorted(table)], dtype=float)
+    return lambda values: float(np.interp(values[knob_pv], knob_vals, readings))
+
+
+'''
+    An in-process stand-in for the machine, run on a discrete-event virtual clock. Injection shots
+    are events every shot_period seconds, puts complete put_latency seconds after they are made,
+    magnets then settle towards the new setpoint and monitor updates reach the subscribers
+    monitor_delay seconds after the shot. Nothing sleeps: waiting for a put or a shot runs the
+    clock forward to the next event, so a complete tuning run takes microseconds to milliseconds
+    and the virtual time it took is what it would take on the machine
+    responses - dictionary of output PV name to a function that takes the current (settled) knob values and returns the reading
+    initial_values - dictionary of knob PV name to its starting setpoint
+    shot_period - seconds between injection shots, every output PV updates once per shot
+    put_latency - seconds until a put completes, one number for every PV or a dictionary of PV name to seconds
+    settling_time - time constant in seconds of the exponential approach to a new setpoint once the put
+                    completes, one number or a dictionary like put_latency, 0 jumps straight there
+    monitor_delay - seconds from a shot to its reading reaching the subscribers
+    noise - standard deviation of gaussian noise added to every reading
+    poisson_counts - if given, every reading is also Poisson distributed with this many counts per unit,
+                     e.g. 100 for an efficiency in percent measured from counted particles
+    drift - dictionary of knob PV name to how fast (units per second) the best setpoint of that knob drifts
+    seed - seed for the noise
+    clock - the VirtualClock to schedule on, a new one by default
+'''
+class SimulatedBackend:
+
+    def __init__(self, responses, initial_values, shot_period=1.0, put_latency=0.0, settling_time=0.0, monitor_delay=0.0,
+                 noise=0.0, poisson_counts=None, drift=None, seed=None, clock=None):
+        self.responses = responses
+        self.values = dict(initial_values)
+        self.shot_period = shot_period
+        self.put_latency = put_latency
+        self.settling_time = settling_time
+        self.monitor_delay = monitor_delay
+        self.noise = noise
+        self.poisson_counts = poisson_counts
+        self.drift = drift or {}
+        # the gaussian noise is default_rng(seed).standard_normal() drawn in blocks, the same stream batch_simulator.py
+        # uses for a run with this seed. The Poisson noise has its own stream so it doesn't shift the gaussian one
+        self.noise_random = np.random.default_rng(seed)
+        self.gaussians = []
+        self.next_gaussian = 0
+        self.poisson_random = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0]) if poisson_counts is not None else None
+        self.clock = clock if clock is not None else VirtualClock()
+
+        self.settling = {}          # PV name to (value it started from, when it started) while a magnet settles
+        self.puts_in_flight = 0
+        self.subscribers = {}
+        self.next_handle = 0
+        self.deliveries = 0
+
+        #what the run has used, for comparing algorithms
+        self.puts = 0
+        self.shots = 0
+
+        self.clock.schedule(shot_period, self.shoot)
+
+    #virtual seconds since the simulation started
+    def time(self):
+        return self.clock.now()
+
+    #the readings are timestamped with the virtual time of their shot
+    def timestamp(self):
+        return self.clock.now()
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    #a per-PV setting given either as one number or as a dictionary of PV name to number
+    def setting(self, setting, pv_name):
+        if isinstance(setting, dict):
+            return setting.get(pv_name, 0.0)
+        return setting
+
+    def get(self, pv_name):
+        if pv_name in self.responses:
+            return self.read(pv_name)
+        return self.values[pv_name]
+
+    def completePut(self, pv_name, value, callback=None):
+        settling_time = self.setting(self.settling_time, pv_name)
+        if settling_time > 0:
+            self.settling[pv_name] = (self.knobValue(pv_name), self.clock.now())
+        self.values[pv_name] = value
+        self.puts_in_flight -= 1
+        if callback is not None:
+            callback()
+
+    def startPut(self, pv_name, value, callback=None):
+        self.puts_in_flight += 1
+        self.clock.schedule(self.setting(self.put_latency, pv_name), self.completePut, pv_name, value, callback)
+
+    '''
+        With wait=True the clock runs (and shots keep coming) until the put completes. callback() is
+        called when it completes, like the put completion callback on the machine
+    '''
+    def put(self, pv_name, value, wait=True, callback=None):
+        self.puts += 1
+        self.startPut(pv_name, value, callback)
+        if wait:
+            self.clock.runUntilTrue(lambda: self.puts_in_flight == 0)
+
+    def subscribe(self, pv_name, callback):
+        self.next_handle += 1
+        self.subscribers[self.next_handle] = (pv_name, callback)
+        return self.next_handle
+
+    def unsubscribe(self, handle):
+        self.subscribers.pop(handle, None)
+
+    #where a knob actually is right now, which lags its setpoint while it settles
+    def knobValue(self, pv_name):
+        value = self.values[pv_name]
+        if pv_name in self.settling:
+            start_value, start_time = self.settling[pv_name]
+            remaining = math.exp(-(self.clock.now() - start_time) / self.setting(self.settling_time, pv_name))
+            if remaining < 1e-9:
+                del self.settling[pv_name]
+            else:
+                value = value + (start_value - value) * remaining
+        return value
+
+    #the reading of an output PV right now, with settling, drift and noise
+    def read(self, pv_name):
+        values = self.values
+        if self.settling or self.drift:
+            values = {knob_pv: self.knobValue(knob_pv) for knob_pv in self.values}
+            for knob_pv, rate in self.drift.items():
+                values[knob_pv] -= rate * self.clock.now()
+
+        reading = self.responses[pv_name](values)
+        if self.poisson_counts is not None:
+            reading = self.poisson_random.poisson(max(reading, 0.0) * self.poisson_counts) / self.poisson_counts
+        if self.noise > 0:
+            reading += self.noise * self.gaussian()
+        return float(reading)
+
+    #the next standard normal from the noise stream, drawn 256 at a time because one numpy draw per shot is slow
+    def gaussian(self):
+        if self.next_gaussian == len(self.gaussians):
+            self.gaussians = self.noise_random.standard_normal(256).tolist()
+            self.next_gaussian = 0
+        self.next_gaussian += 1
+        return self.gaussians[self.next_gaussian - 1]
+
+    #one injection shot: every output PV somebody is subscribed to gets a reading, and the next shot is scheduled
+    def shoot(self):
+        self.shots += 1
+        shot_time = self.clock.now()
+
+        readings = {}
+        for pv_name, callback in list(self.subscribers.values()):
+            if pv_name in self.responses:
+                if pv_name not in readings:
+                    readings[pv_name] = self.read(pv_name)
+                if self.monitor_delay > 0:
+                    self.clock.schedule(self.monitor_delay, self.deliver, callback, pv_name, readings[pv_name], shot_time)
+                else:
+                    self.deliver(callback, pv_name, readings[pv_name], shot_time)
+
+        self.clock.schedule(self.shot_period, self.shoot)
+
+    def deliver(self, callback, pv_name, value, timestamp):
+        self.deliveries += 1
+        callback(pvname=pv_name, value=value, timestamp=timestamp)
+
+    '''
+        Runs the clock until the next monitor update has been delivered
+        returns whether anything was delivered, so a MeasurementChannel waiting on this knows whether
+        to pend again or give up
+    '''
+    def pend(self):
+        if not any(pv_name in self.responses for pv_name, callback in self.subscribers.values()):
+            return False
+
+        deliveries = self.deliveries
+        return self.clock.runUntilTrue(lambda: self.deliveries > deliveries)
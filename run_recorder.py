@@ -0,0 +1,406 @@
+'''
+    A binary log of every tuning run and a backend that replays it. While recording, each
+    optimizePV_* and optimizeSteeringMagnetVariation* run appends fixed size records to the log:
+    where it started, every setpoint it wrote, every raw monitor value onChange received and the
+    decisions it took (reversals and step size changes). The log is append-only and is read back
+    with numpy.memmap, so months of runs can be summarized without loading them into memory.
+
+    ReplayBackend feeds a recorded run back through an optimizer, the recorded one or a modified
+    one. As long as the optimizer writes the same setpoints as the recording it is handed the same
+    monitor values in the same order. Once it writes something else, every shot is a value that
+    was recorded at the nearest setpoint the recorded run visited.
+
+    Set TUNING_RECORD to the log file to record from the command line, e.g.
+    TUNING_RECORD=tuning_runs.bin python Automate_Phase_6.py 3
+    The names of the PVs, optimizers and decisions are kept in <log file>.names, one per line.
+
+    usage: python run_recorder.py [log file]
+'''
+
+import bisect
+import functools
+import math
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+#record kinds
+RUN_START = 1       # name is the optimizer, time is the wall clock time (time.time()) the run started
+SETTING = 2         # the knob the run moves and its value when the run started
+PUT = 3             # a setpoint written, recorded once the put completed, timestamp is the backend's timestamp() then
+SAMPLE = 4          # a raw monitor value, timestamp is the timestamp it came with
+DECISION = 5        # name is the decision, e.g. "reversals", value is the knob value kept or the new step
+RUN_END = 6         # time is the wall clock time the run ended
+
+KIND_NAMES = {RUN_START: "run start", SETTING: "setting", PUT: "put", SAMPLE: "sample", DECISION: "decision", RUN_END: "run end"}
+
+#one record is 32 bytes. Apart from the run start and end, times are the backend's time(),
+#which is virtual seconds on the simulator
+record_struct = struct.Struct("<BxHIddd")
+record_dtype = np.dtype([("kind", "u1"), ("pad", "u1"), ("name", "<u2"), ("run", "<u4"),
+                         ("time", "<f8"), ("value", "<f8"), ("timestamp", "<f8")])
+
+
+'''
+    Appends the records of the runs it is told about to a log file. It does nothing until open()
+    is called, and only records inside a run started by the run decorator
+'''
+class RunRecorder:
+
+    def __init__(self):
+        self.file = None
+        self.names_file = None
+        self.names = {}
+        self.lock = threading.Lock()
+        self.run_id = None
+        self.next_run = 0
+
+    #starts appending to path, carrying on with the run numbers and names already in it
+    def open(self, path):
+        self.close()
+        log = RunLog(path)
+        self.names = {name: i for i, name in enumerate(log.names)}
+        self.next_run = int(log.records["run"][-1]) + 1 if len(log.records) else 0
+        del log
+
+        self.file = open(path, "ab")
+        self.names_file = open(path + ".names", "a")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.names_file.close()
+            self.file = None
+            self.names_file = None
+
+    #starts recording if TUNING_RECORD is set
+    def enableFromEnvironment(self):
+        path = os.environ.get("TUNING_RECORD")
+        if path:
+            self.open(path)
+
+    #the index of name in the names file, which it is added to the first time it is seen
+    def nameIndex(self, name):
+        index = self.names.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names[name] = index
+            self.names_file.write(name + "\n")
+            self.names_file.flush()
+        return index
+
+    #called from the monitor callback thread as well as the optimizer's, hence the lock
+    def write(self, kind, name, time, value, timestamp=math.nan):
+        with self.lock:
+            self.file.write(record_struct.pack(kind, self.nameIndex(name), self.run_id, time, value, timestamp))
+
+    def setting(self, pv_name, value, time):
+        if self.run_id is not None:
+            self.write(SETTING, pv_name, time, float(value))
+
+    #timestamp - when it completed on the clock of the sample timestamps, the backend's timestamp()
+    def put(self, pv_name, value, time, timestamp=None):
+        if self.run_id is not None:
+            self.write(PUT, pv_name, time, float(value), math.nan if timestamp is None else timestamp)
+
+    '''
+        A monitor value exactly as onChange received it
+        timestamp - the timestamp it came with, None if it had none
+        time - the backend's time() when it arrived
+    '''
+    def sample(self, pv_name, value, timestamp, time):
+        if self.run_id is not None:
+            self.write(SAMPLE, pv_name, time, float(value), math.nan if timestamp is None else timestamp)
+
+    def decision(self, name, value, time):
+        if self.run_id is not None:
+            self.write(DECISION, name, time, float(value))
+
+    '''
+        Decorator for an optimizer: while recording, every call is one run in the log. Calls made
+        from inside a run that is already being recorded are part of it
+    '''
+    def run(self, function):
+        @functools.wraps(function)
+        def recorded(*args, **kwargs):
+            if self.file is None or self.run_id is not None:
+                return function(*args, **kwargs)
+            self.run_id = self.next_run
+            self.next_run += 1
+            self.write(RUN_START, function.__name__, time.time(), math.nan)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.write(RUN_END, function.__name__, time.time(), math.nan)
+                self.run_id = None
+                self.file.flush()
+        return recorded
+
+
+'''
+    A run log opened for reading. records is a numpy.memmap of the whole file, so only the pages
+    of the runs that are looked at are read from disk
+'''
+class RunLog:
+
+    #how many records to scan at a time when looking for the start of each run
+    chunk = 1 << 20
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        if os.path.exists(path + ".names"):
+            with open(path + ".names") as names:
+                self.names = names.read().splitlines()
+
+        # a record still being written when the file was opened is left out
+        count = os.path.getsize(path) // record_dtype.itemsize if os.path.exists(path) else 0
+        if count:
+            self.records = np.memmap(path, dtype=record_dtype, mode="r", shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=record_dtype)
+        self.starts = None
+
+    #where each run starts in records, found a chunk at a time
+    def runStarts(self):
+        if self.starts is None:
+            starts = []
+            for offset in range(0, len(self.records), self.chunk):
+                kinds = self.records["kind"][offset:offset + self.chunk]
+                starts.append(np.flatnonzero(kinds == RUN_START) + offset)
+            self.starts = np.concatenate(starts) if starts else np.zeros(0, dtype=int)
+        return self.starts
+
+    def __len__(self):
+        return len(self.runStarts())
+
+    #the records of run i, a view into the memory map
+    def run(self, i):
+        starts = self.runStarts()
+        end = starts[i + 1] if i + 1 < len(starts) else len(self.records)
+        return self.records[starts[i]:end]
+
+    def name(self, record):
+        return self.names[record["name"]]
+
+    '''
+        What happened in run i: the optimizer, when it started (wall clock), how long it took, the
+        knob it moved from where to where, and how many samples, puts and decisions it had
+    '''
+    def summary(self, i):
+        records = self.run(i)
+        kinds = records["kind"]
+        summary = {"run": int(records["run"][0]), "optimizer": self.name(records[0]), "started": float(records["time"][0]),
+                   "finished": bool(kinds[-1] == RUN_END), "seconds": None, "knob": None, "start": None, "end": None,
+                   "samples": int(np.count_nonzero(kinds == SAMPLE)), "puts": int(np.count_nonzero(kinds == PUT)), "decisions": {}}
+        if summary["finished"]:
+            summary["seconds"] = float(records["time"][-1] - records["time"][0])
+
+        settings = records[kinds == SETTING]
+        if len(settings):
+            summary["knob"] = self.name(settings[0])
+            summary["start"] = summary["end"] = float(settings[0]["value"])
+        puts = records[(kinds == PUT) & (records["name"] == settings[0]["name"])] if len(settings) else records[kinds == PUT]
+        if len(puts):
+            summary["end"] = float(puts[-1]["value"])
+
+        decisions = records["name"][kinds == DECISION]
+        for name, count in zip(*np.unique(decisions, return_counts=True)):
+            summary["decisions"][self.names[name]] = int(count)
+        return summary
+
+    #the summary of every run, one run at a time
+    def summaries(self):
+        for i in range(len(self)):
+            yield self.summary(i)
+
+
+'''
+    Replays one recorded run to whichever optimizer is run on it, in place of a SimulatedBackend
+    or EpicsBackend. It follows the recording while the optimizer writes the recorded setpoints in
+    the recorded order, handing out the monitor values in the order they arrived. After the first
+    put that differs (or once the recording runs out) every shot is the next value recorded at the
+    setpoint nearest the knob, going round again when they have all been used. A joint tune of
+    several magnets is followed the same way, the knob after it differs being the first magnet
+    log - the RunLog
+    i - which run to replay
+'''
+class ReplayBackend:
+
+    def __init__(self, log, i):
+        self.log = log
+        self.records = log.run(i)
+        self.cursor = 1                 # the record after the last one replayed
+        self.following = True
+        self.diverged_at = None         # how many puts matched the recording before the first that didn't
+
+        self.values = {}
+        self.output_pv = None
+        self.knob_pv = None
+        self.now = 0.0
+        # the recorded timestamps' clock minus the recorded times', from the last put that recorded both
+        self.clock_offset = 0.0
+        self.subscribers = {}
+        self.next_handle = 0
+
+        #what the replay has used, like SimulatedBackend
+        self.puts = 0
+        self.shots = 0
+        self.off_recording = 0          # shots handed out for a setpoint the recorded run never wrote
+
+        # the recorded values by the setpoint the knob was at when they arrived
+        self.by_setpoint = {}
+        setpoint = None
+        sample_times = []
+        for record in self.records:
+            kind = record["kind"]
+            if kind == SETTING and self.knob_pv is None:
+                self.knob_pv = log.name(record)
+                setpoint = float(record["value"])
+                self.values[self.knob_pv] = setpoint
+                self.now = float(record["time"])
+            elif kind == SETTING:
+                # the other magnets of a joint tune, which start where they were recorded
+                self.values.setdefault(log.name(record), float(record["value"]))
+            elif kind == PUT and log.name(record) == self.knob_pv:
+                setpoint = float(record["value"])
+            elif kind == SAMPLE:
+                self.output_pv = log.name(record)
+                self.by_setpoint.setdefault(setpoint, []).append(float(record["value"]))
+                sample_times.append(float(record["time"]))
+        self.setpoints = sorted(setpoint for setpoint in self.by_setpoint if setpoint is not None)
+        self.used = {setpoint: 0 for setpoint in self.by_setpoint}
+
+        #once it stops following, the shots come this far apart: the median time between recorded shots
+        self.shot_period = float(np.median(np.diff(sample_times))) if len(sample_times) > 1 else 1.0
+
+    def time(self):
+        return self.now
+
+    #on the clock the recorded samples were timestamped on, e.g. the wall clock for a run on the machine
+    def timestamp(self):
+        return self.now + self.clock_offset
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def get(self, pv_name):
+        return self.values[pv_name]
+
+    def diverge(self):
+        if self.following:
+            self.following = False
+            self.diverged_at = self.puts
+
+    #the next record of one of kinds, starting from the cursor, skipping everything else. None at the end of the run
+    def nextRecord(self, kinds):
+        for position in range(self.cursor, len(self.records)):
+            if self.records[position]["kind"] in kinds:
+                return position
+        return None
+
+    #the timestamp a recorded sample came with, or when it arrived if it had none
+    def sampleTimestamp(self, record):
+        timestamp = float(record["timestamp"])
+        return timestamp if not math.isnan(timestamp) else float(record["time"]) + self.clock_offset
+
+    def deliver(self, value, timestamp):
+        self.shots += 1
+        for pv_name, callback in list(self.subscribers.values()):
+            if pv_name == self.output_pv:
+                callback(pvname=pv_name, value=value, timestamp=timestamp)
+
+    #replayed puts complete straight away, so callback() is called before it returns
+    def put(self, pv_name, value, wait=True, callback=None):
+        self.puts += 1
+        self.values[pv_name] = value
+        if self.following:
+            self.follow(pv_name, value)
+        if callback is not None:
+            callback()
+
+    '''
+        Checks a put against the next one in the recording. The values recorded before the matching
+        put arrived while it was being made, so they are delivered before it returns
+    '''
+    def follow(self, pv_name, value):
+        position = self.nextRecord((PUT,))
+        if position is None or self.log.name(self.records[position]) != pv_name or self.records[position]["value"] != float(value):
+            self.diverge()
+            return
+
+        for record in self.records[self.cursor:position]:
+            if record["kind"] == SAMPLE:
+                self.deliver(float(record["value"]), self.sampleTimestamp(record))
+        self.cursor = position + 1
+        self.now = float(self.records[position]["time"])
+        if not math.isnan(self.records[position]["timestamp"]):
+            self.clock_offset = float(self.records[position]["timestamp"]) - self.now
+
+    def subscribe(self, pv_name, callback):
+        self.next_handle += 1
+        self.subscribers[self.next_handle] = (pv_name, callback)
+        return self.next_handle
+
+    def unsubscribe(self, handle):
+        self.subscribers.pop(handle, None)
+
+    #the next value recorded at the setpoint nearest the knob
+    def nearestValue(self):
+        knob_val = self.values.get(self.knob_pv)
+        if None in self.by_setpoint and (knob_val is None or not self.setpoints):
+            setpoint = None
+        else:
+            i = bisect.bisect_left(self.setpoints, knob_val)
+            setpoint = min(self.setpoints[max(i - 1, 0):i + 1], key=lambda s: abs(s - knob_val))
+            if setpoint != knob_val:
+                self.off_recording += 1
+
+        samples = self.by_setpoint[setpoint]
+        value = samples[self.used[setpoint] % len(samples)]
+        self.used[setpoint] += 1
+        return value
+
+    '''
+        Hands out the next monitor value
+        returns whether anything was delivered, like SimulatedBackend.pend
+    '''
+    def pend(self):
+        if self.output_pv is None or not any(pv_name == self.output_pv for pv_name, callback in self.subscribers.values()):
+            return False
+
+        if self.following:
+            position = self.nextRecord((PUT, SAMPLE))
+            if position is not None and self.records[position]["kind"] == SAMPLE:
+                self.cursor = position + 1
+                self.now = float(self.records[position]["time"])
+                self.deliver(float(self.records[position]["value"]), self.sampleTimestamp(self.records[position]))
+                return True
+            # the recorded run put something here (or stopped) where this one wants another shot
+            self.diverge()
+
+        self.now += self.shot_period
+        self.deliver(self.nearestValue(), self.timestamp())
+        return True
+
+
+#the recorder the tuning scripts use
+recorder = RunRecorder()
+
+
+if __name__ == "__main__":
+    log = RunLog(sys.argv[1] if len(sys.argv) > 1 else "tuning_runs.bin")
+
+    for summary in log.summaries():
+        line = (str(summary["run"]) + " " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["started"])) + " " +
+                summary["optimizer"] + ": " + str(summary["knob"]) + " " + str(summary["start"]) + " -> " + str(summary["end"]) +
+                ", " + str(summary["samples"]) + " samples, " + str(summary["puts"]) + " puts")
+        if summary["decisions"]:
+            line += ", " + ", ".join(name + " " + str(count) for name, count in summary["decisions"].items())
+        line += ", " + (str(round(summary["seconds"], 1)) + " s" if summary["finished"] else "did not finish")
+        print(line)
@@ -0,0 +1,196 @@
+'''
+    Analysis of a steering magnet scan: (magnet value, injection efficiency) points that trace out
+    the flat top. Everything works on NumPy arrays so large, dense scans take microseconds
+'''
+
+import functools
+
+import numpy as np
+
+
+'''
+    Sorts the scan by magnet value. The scans record the points to the right of the starting value
+    first and the ones to the left afterwards, so this replaces inserting at the front of a list.
+    Float arrays are used as they are; lists are converted, which on 2000 points costs more than
+    the whole analysis
+'''
+def sortScan(magnet_vals, injection_efficiencies):
+    magnet_vals = np.asarray(magnet_vals, dtype=float)
+    injection_efficiencies = np.asarray(injection_efficiencies, dtype=float)
+    order = np.argsort(magnet_vals, kind="stable")
+    return magnet_vals[order], injection_efficiencies[order]
+
+
+'''
+    Clips the 'tail' so to speak so that we can find the approximate center of the flat top. The
+    end with the lower efficiency is the worse end, and points are dropped from it until the other
+    end becomes the worse one. Finds the cut in one pass instead of re-slicing once per point
+'''
+def clipTail(magnet_vals, injection_efficiencies):
+    n = len(injection_efficiencies)
+    if n < 2:
+        return magnet_vals, injection_efficiencies
+
+    if injection_efficiencies[-1] < injection_efficiencies[0]:
+        # the right end is worse: keep up to the last point at least as good as the left end
+        keep = np.nonzero(injection_efficiencies[:-1] >= injection_efficiencies[0])[0][-1] + 1
+        return magnet_vals[:keep], injection_efficiencies[:keep]
+
+    # the left end is worse: drop up to the first point better than the right end
+    better = np.nonzero(injection_efficiencies[1:] > injection_efficiencies[-1])[0]
+    start = better[0] + 1 if len(better) > 0 else n - 1
+    return magnet_vals[start:], injection_efficiencies[start:]
+
+
+#values with the first and last repeated width times on each side. A third of the time np.pad takes for the same
+def padEdges(values, width):
+    return np.concatenate((np.repeat(values[:1], width), values, np.repeat(values[-1:], width)))
+
+
+#3-point moving average, with the edge points repeated so the output is the same length
+def movingAverage(injection_efficiencies, window=3):
+    padded = padEdges(injection_efficiencies, window // 2)
+    return np.convolve(padded, np.ones(window) / window, mode="valid")
+
+
+#the scanned magnet value closest to magnet_val, so the magnet always ends on a value we measured
+def nearestScanned(magnet_vals, magnet_val):
+    return magnet_vals[int(np.argmin(np.abs(magnet_vals - magnet_val)))]
+
+
+'''
+    The middle point of the clipped scan (variations 1 and 3)
+'''
+def midpointCenter(magnet_vals, injection_efficiencies):
+    return magnet_vals[len(magnet_vals) // 2]
+
+
+'''
+    Weighted mean center (variation 2): the two ends are equalized to the better of the two, the
+    efficiencies are smoothed with a moving average and each magnet value is weighted by them
+'''
+def weightedCentroidCenter(magnet_vals, injection_efficiencies):
+    weights = injection_efficiencies.copy()
+    edge = max(weights[0], weights[-1])
+    weights[0] = edge
+    weights[-1] = edge
+
+    weights = movingAverage(weights)
+    if weights.sum() <= 0:
+        return midpointCenter(magnet_vals, injection_efficiencies)
+    return nearestScanned(magnet_vals, (magnet_vals * weights).sum() / weights.sum())
+
+
+'''
+    Least squares fit of a top hat: efficiency is one level across a contiguous top and another
+    level outside it. The fit alternates between putting the top wherever the scan is above the
+    midpoint of the two levels and refitting the levels as the means inside and outside, which
+    settles in a few passes. Returns the center of the fitted top
+'''
+def topHatCenter(magnet_vals, injection_efficiencies, max_passes=20):
+    low = injection_efficiencies.min()
+    high = injection_efficiencies.max()
+    # running sums, so the means inside and outside the top are two lookups a pass instead of a copy and a sum
+    sums = np.concatenate(([0.0], np.cumsum(injection_efficiencies)))
+    n = len(injection_efficiencies)
+
+    for i in range(max_passes):
+        above = np.nonzero(injection_efficiencies >= (low + high) / 2)[0]
+        first = above[0]
+        last = above[-1]
+
+        inside = sums[last + 1] - sums[first]
+        new_high = inside / (last + 1 - first)
+        outside = n - (last + 1 - first)
+        new_low = (sums[n] - inside) / outside if outside > 0 else low
+
+        if new_high == high and new_low == low:
+            break
+        high = new_high
+        low = new_low
+
+    return nearestScanned(magnet_vals, (magnet_vals[first] + magnet_vals[last]) / 2)
+
+
+#Savitzky-Golay smoothing coefficients from a least squares polynomial fit over the window. Cached, the fit takes
+#longer than the filter
+@functools.lru_cache(maxsize=None)
+def savitzkyGolayCoefficients(window, order):
+    offsets = np.arange(window) - window // 2
+    return np.linalg.pinv(np.vander(offsets, order + 1, increasing=True))[0]
+
+
+'''
+    Smooths the scan with a Savitzky-Golay filter and finds the two points where efficiency crosses
+    half way between its minimum and maximum, interpolating between scan points. The center is
+    halfway between those edges
+    window - the number of points the filter fits over, odd
+    order - the order of the polynomial it fits
+'''
+def savitzkyGolayCenter(magnet_vals, injection_efficiencies, window=5, order=2):
+    window = min(window, len(injection_efficiencies) - (len(injection_efficiencies) + 1) % 2)
+    if window <= order:
+        return midpointCenter(magnet_vals, injection_efficiencies)
+
+    padded = padEdges(injection_efficiencies, window // 2)
+    smoothed = np.convolve(padded, savitzkyGolayCoefficients(window, order)[::-1], mode="valid")
+
+    half_max = (smoothed.max() + smoothed.min()) / 2
+    above = np.nonzero(smoothed >= half_max)[0]
+    first = above[0]
+    last = above[-1]
+
+    # interpolate where the smoothed curve crosses half max on each side
+    left_edge = magnet_vals[first]
+    if first > 0:
+        fraction = (half_max - smoothed[first - 1]) / (smoothed[first] - smoothed[first - 1])
+        left_edge = magnet_vals[first - 1] + fraction * (magnet_vals[first] - magnet_vals[first - 1])
+    right_edge = magnet_vals[last]
+    if last < len(smoothed) - 1:
+        fraction = (smoothed[last] - half_max) / (smoothed[last] - smoothed[last + 1])
+        right_edge = magnet_vals[last] + fraction * (magnet_vals[last + 1] - magnet_vals[last])
+
+    return nearestScanned(magnet_vals, (left_edge + right_edge) / 2)
+
+
+'''
+    Median filters the scan, which throws out single noisy shots without rounding off the edges of
+    the flat top, then returns the middle of the points within threshold of the filtered maximum
+    window - the number of points in the median filter, odd
+'''
+def medianFilterCenter(magnet_vals, injection_efficiencies, window=3, threshold=0.9):
+    padded = padEdges(injection_efficiencies, window // 2)
+    if window == 3:
+        #the middle of three is the larger of the smaller pair and the smaller of the rest, without sorting every window
+        left = padded[:-2]
+        middle = padded[1:-1]
+        right = padded[2:]
+        filtered = np.maximum(np.minimum(left, middle), np.minimum(np.maximum(left, middle), right))
+    else:
+        filtered = np.median(np.lib.stride_tricks.sliding_window_view(padded, window), axis=1)
+
+    on_top = np.nonzero(filtered >= filtered.max() * threshold)[0]
+    return nearestScanned(magnet_vals, (magnet_vals[on_top[0]] + magnet_vals[on_top[-1]]) / 2)
+
+
+#the flat top center estimators that can be picked by name
+ESTIMATORS = {"midpoint": midpointCenter,
+              "centroid": weightedCentroidCenter,
+              "tophat": topHatCenter,
+              "savgol": savitzkyGolayCenter,
+              "median": medianFilterCenter}
+
+
+'''
+    Finds the center of the flat top of a scan
+    magnet_vals, injection_efficiencies - the scan points, in any order
+    estimator - one of the names in ESTIMATORS
+    returns the scanned magnet value at (or closest to) the center
+'''
+def findFlatTopCenter(magnet_vals, injection_efficiencies, estimator="centroid"):
+    if estimator not in ESTIMATORS:
+        raise ValueError("unknown estimator " + str(estimator) + ", expected one of " + ", ".join(ESTIMATORS))
+
+    magnet_vals, injection_efficiencies = sortScan(magnet_vals, injection_efficiencies)
+    magnet_vals, injection_efficiencies = clipTail(magnet_vals, injection_efficiencies)
+    return ESTIMATORS[estimator](magnet_vals, injection_efficiencies)
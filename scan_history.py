@@ -0,0 +1,76 @@
+import os
+import sqlite3
+import time
+
+
+#where the tuning scripts keep their history unless told otherwise
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scan_history.sqlite")
+
+
+'''
+    On-disk history of every (magnet value, injection efficiency) point measured while tuning a
+    steering magnet, so a later run can start from what was learned before instead of rescanning.
+    The database is only opened when it is first used
+    path - the SQLite file, or ":memory:" for a history that only lasts as long as the process
+'''
+class ScanHistory:
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scan_points (magnet TEXT NOT NULL, magnet_val NUMERIC NOT NULL, "
+                                    "injection_efficiency REAL NOT NULL, timestamp REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS scan_points_by_magnet ON scan_points (magnet, timestamp)")
+        return self.connection
+
+    def record(self, magnet, magnet_val, injection_efficiency, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.connect() as connection:
+            connection.execute("INSERT INTO scan_points VALUES (?, ?, ?, ?)", (magnet, magnet_val, injection_efficiency, timestamp))
+
+    '''
+        Returns the points measured for a magnet, oldest first, as (timestamp, magnet value, injection efficiency)
+        max_age - only points from the last this many seconds, None for all of them
+    '''
+    def recent(self, magnet, max_age=None):
+        oldest = 0.0 if max_age is None else time.time() - max_age
+        cursor = self.connect().execute("SELECT timestamp, magnet_val, injection_efficiency FROM scan_points "
+                                        "WHERE magnet = ? AND timestamp >= ? ORDER BY timestamp", (magnet, oldest))
+        return cursor.fetchall()
+
+    '''
+        Predicts the flat top of a magnet from recent history by averaging the efficiency measured at
+        each magnet value. The edges are the outermost values still within threshold of the best average,
+        and the prediction is only made if history has points beyond both edges, so both were seen
+        returns (left edge, center, right edge) or None if there isn't enough history
+    '''
+    def predictFlatTop(self, magnet, max_age=3 * 24 * 3600, threshold=0.8):
+        sums = {}
+        for timestamp, magnet_val, injection_efficiency in self.recent(magnet, max_age):
+            total, count = sums.get(magnet_val, (0.0, 0))
+            sums[magnet_val] = (total + injection_efficiency, count + 1)
+
+        if len(sums) < 3:
+            return None
+
+        averages = sorted((magnet_val, total / count) for magnet_val, (total, count) in sums.items())
+        max_injection_efficiency = max(average for magnet_val, average in averages)
+        on_top = [magnet_val for magnet_val, average in averages if average > max_injection_efficiency * threshold]
+
+        left_edge = on_top[0]
+        right_edge = on_top[-1]
+        if left_edge == averages[0][0] or right_edge == averages[-1][0]:
+            return None
+
+        return left_edge, (left_edge + right_edge) / 2, right_edge
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
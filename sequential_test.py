@@ -0,0 +1,111 @@
+import collections
+import math
+
+
+#the outcome of one adaptive comparison, kept so a run can be reviewed afterwards
+Decision = collections.namedtuple("Decision", ["accepted", "samples", "confidence", "incumbent_mean", "candidate_mean"])
+
+
+'''
+    Running mean and variance with Welford's update, so nothing but three numbers is stored
+'''
+class RunningStats:
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def variance(self):
+        if self.n < 2:
+            return math.inf
+        return self.m2 / (self.n - 1)
+
+
+def normalCdf(z):
+    return 0.5 * (1.0 + math.erf(z / math.sqrt(2)))
+
+
+'''
+    Decides whether a new knob value is better than the current one using as few shots as it can.
+    After every shot of the new value it puts a confidence bound on the difference of the two means,
+    using a noise level pooled over every value measured so far in the run, and stops as soon as the
+    difference is significant either way. If it is still ambiguous after max_samples shots, it falls
+    back to comparing the means, which is what the fixed-measurements optimizers do.
+    Nothing is decided on fewer than min_samples shots of the new value. One lucky shot would
+    otherwise be accepted and then carried as the value to beat, with its luck in the mean, so
+    every later move looked worse than it was
+    max_samples - the most shots to spend on one new value
+    confidence - how sure (0.5 - 1) the comparison must be before it stops early
+    min_samples - the fewest shots of a value before it can be accepted or rejected
+'''
+class SequentialComparator:
+
+    def __init__(self, max_samples, confidence=0.95, min_samples=2):
+        self.max_samples = max_samples
+        self.confidence = confidence
+        self.min_samples = min(min_samples, max_samples)
+        self.incumbent = None
+        self.pooled_m2 = 0.0
+        self.pooled_dof = 0
+
+    #shot-to-shot variance pooled over every value measured in this run
+    def noiseVariance(self):
+        if self.pooled_dof == 0:
+            return math.inf
+        return self.pooled_m2 / self.pooled_dof
+
+    def pool(self, stats):
+        if stats.n > 1:
+            self.pooled_m2 += stats.m2
+            self.pooled_dof += stats.n - 1
+
+    '''
+        Measures the starting value with max_samples shots, which also seeds the noise estimate.
+        measure - takes one shot and returns its fitness
+        returns the mean fitness
+    '''
+    def measureIncumbent(self, measure):
+        self.incumbent = RunningStats()
+        for i in range(self.max_samples):
+            self.incumbent.add(measure())
+        self.pool(self.incumbent)
+        return self.incumbent.mean
+
+    '''
+        Takes shots of the new value until it is clearly better or worse than the current one.
+        If it is accepted it becomes the value later candidates are compared against
+        measure - takes one shot and returns its fitness
+    '''
+    def compare(self, measure):
+        candidate = RunningStats()
+        confidence = 0.5
+
+        while candidate.n < self.max_samples:
+            candidate.add(measure())
+            if candidate.n < self.min_samples:
+                continue
+
+            difference = candidate.mean - self.incumbent.mean
+            variance = self.noiseVariance()
+            if variance == 0.0:
+                confidence = 1.0 if difference != 0.0 else 0.5
+            elif variance != math.inf:
+                standard_error = math.sqrt(variance / candidate.n + variance / self.incumbent.n)
+                confidence = normalCdf(abs(difference) / standard_error)
+
+            if confidence >= self.confidence:
+                break
+
+        decision = Decision(candidate.mean >= self.incumbent.mean, candidate.n, confidence, self.incumbent.mean, candidate.mean)
+
+        self.pool(candidate)
+        if decision.accepted:
+            self.incumbent = candidate
+        return decision
@@ -0,0 +1,194 @@
+'''
+    How long after a put completes the measurement belongs to the new setpoint, learned per PV from
+    the step responses the tunes make anyway. The measurement channel drops every sample whose
+    EPICS timestamp is older than the last put completion plus the settle time of the PV that was
+    put, so the first sample an optimizer reads after a move is already a valid shot.
+
+    After every put the samples of the channel are collected until the next put. If the measurement
+    moved by clearly more than its noise, the settle time of that step is how long after the put
+    the first sample came from which on every sample was within noise (or a small fraction of the
+    step) of where the measurement ended up. PVs put together, with no sample between their puts,
+    can't be told apart, so each of them learns the settle time of the whole move, which is on the
+    safe side. The settle time of a PV is the median of its last few steps, so one odd step (a beam
+    trip, a drifting output) doesn't move it much. A step is only learned from if its samples go on
+    for twice the settle time the PV already has. The samples of a shorter step may still be settling
+    at the end, which looks like noise and would teach an ever shorter settle time. The noise is
+    pooled from the ends of earlier steps, never just the step's own, and nothing is learned before
+    it has been pooled from min_noise_steps of them.
+
+    Most optimizers read one shot after each put and then put again, which leaves nothing to learn
+    from. So until a PV has learned a settle time, its first few steps wait for probe_time, or for
+    tail + 1 shots if that is longer, before the next shot is used. If none of those steps was big
+    enough to learn from, the transient of its steps is lost in the noise and the PV is left at a
+    settle time of 0.
+'''
+
+import collections
+import math
+import statistics
+
+
+'''
+    defaults - dictionary of PV name to the settle time to use until one has been learned, in seconds
+    max_settle - the longest settle time that can be learned, in seconds. Later samples aren't collected
+    max_samples - the most samples collected after one put
+    steps - how many of the latest steps of each PV its settle time is the median of
+    tail - how many of the last samples after a put are averaged for where the measurement ended up
+    probes - how many steps of a PV without a settle time wait for enough shots to learn one
+    probe_time - the shortest of those waits, in seconds
+    settled_fraction - a sample within this fraction of the step from the end counts as settled, however small the noise
+    min_noise_steps - how many earlier steps the noise has to be pooled from before a settle time is learned
+'''
+class SettleTimes:
+
+    def __init__(self, defaults=None, max_settle=30.0, max_samples=50, steps=5, tail=3, probes=3, probe_time=2.0, settled_fraction=0.05, min_noise_steps=2):
+        self.defaults = dict(defaults) if defaults is not None else {}
+        self.max_settle = max_settle
+        self.max_samples = max_samples
+        self.steps = steps
+        self.tail = tail
+        self.probes = probes
+        self.probe_time = probe_time
+        self.settled_fraction = settled_fraction
+        self.min_noise_steps = min_noise_steps
+
+        # PV name to the settle times of its latest steps
+        self.learned = {}
+        # PV name to how many of its steps have waited to learn a settle time
+        self.probed = collections.Counter()
+        # the variance of a single sample, pooled from the tails of the steps: their squared deviations and degrees of
+        # freedom, the older ones weighing less
+        self.noise_variance = None
+        self.noise_squares = 0.0
+        self.noise_dof = 0.0
+        # how many steps it has been pooled from
+        self.noise_steps = 0
+        # the time between samples, from their timestamps
+        self.shot_period = None
+        self.last_timestamp = None
+        # the latest samples, whose mean is where the measurement was before a step
+        self.recent = collections.deque(maxlen=tail)
+
+        # the step being collected: the PVs put, where the measurement was before them, when the last of their puts
+        # completed and the samples since
+        self.pv_names = set()
+        self.before = None
+        self.start = 0.0
+        self.times = []
+        self.values = []
+
+    #the settle time of pv_name in seconds
+    def settleTime(self, pv_name):
+        learned = self.learned.get(pv_name)
+        if learned:
+            return statistics.median(learned)
+        if pv_name in self.defaults:
+            return self.defaults[pv_name]
+        if self.probed[pv_name] <= self.probes and self.shot_period is not None:
+            return min(max((self.tail + 1) * self.shot_period, self.probe_time), self.max_settle)
+        return 0.0
+
+    #the settle time of pv_name learned or given, 0 if there is none yet
+    def learnedTime(self, pv_name):
+        learned = self.learned.get(pv_name)
+        if learned:
+            return statistics.median(learned)
+        return self.defaults.get(pv_name, 0.0)
+
+    #forgets everything learned, e.g. for a different machine
+    def reset(self):
+        self.learned = {}
+        self.probed = collections.Counter()
+        self.noise_variance = None
+        self.noise_squares = 0.0
+        self.noise_dof = 0.0
+        self.noise_steps = 0
+        self.shot_period = None
+        self.last_timestamp = None
+        self.recent.clear()
+        self.pv_names = set()
+
+    '''
+        A put to pv_name completed
+        completed_at - when, on the clock of the sample timestamps
+    '''
+    def stepped(self, pv_name, completed_at):
+        if not self.pv_names or len(self.times) > 0:
+            self.close()
+            self.before = sum(self.recent) / len(self.recent) if self.recent else None
+        #no sample since the last put: a slewed move carrying on, or several PVs moved together
+        self.pv_names.add(pv_name)
+        #the steps that only pool the noise don't use up a probe
+        if pv_name not in self.learned and pv_name not in self.defaults and self.noise_steps >= self.min_noise_steps:
+            self.probed[pv_name] += 1
+        self.start = completed_at
+
+    #a sample of the measurement, every one the channel gets, including those it drops
+    def observe(self, value, timestamp):
+        if self.last_timestamp is not None and timestamp > self.last_timestamp:
+            period = timestamp - self.last_timestamp
+            self.shot_period = period if self.shot_period is None else self.shot_period + 0.1 * (period - self.shot_period)
+        self.last_timestamp = timestamp
+        self.recent.append(value)
+
+        if not self.pv_names:
+            return
+        since = timestamp - self.start
+        if since < 0:
+            return
+        if since > self.max_settle:
+            self.close()
+            return
+        self.times.append(since)
+        self.values.append(value)
+        if len(self.times) >= self.max_samples:
+            self.close()
+
+    #learns from the step being collected, if it can, and stops collecting
+    def close(self):
+        known = max((self.learnedTime(pv_name) for pv_name in self.pv_names), default=0.0)
+        if self.pv_names and len(self.values) > self.tail and self.times[-self.tail] >= 2.0 * known:
+            settle_time = self.learn(self.times, self.values, self.before)
+            if settle_time is not None:
+                for pv_name in self.pv_names:
+                    self.learned.setdefault(pv_name, collections.deque(maxlen=self.steps)).append(settle_time)
+        self.pv_names = set()
+        self.times = []
+        self.values = []
+
+    '''
+        The settle time of one step, None if it can't be told
+        before - the mean of the last samples before the step, None if there were none
+    '''
+    def learn(self, times, values, before=None):
+        tail = values[-self.tail:]
+        final = sum(tail) / len(tail)
+        noise_variance = self.noise_variance
+        noise_steps = self.noise_steps
+
+        #the noise is pooled from the tails of earlier steps. From this step's own tail alone a few samples that happen
+        #to agree look like no noise, and every ordinary sample before them like the step still settling
+        self.noise_squares = 0.8 * self.noise_squares + sum((value - final) ** 2 for value in tail)
+        self.noise_dof = 0.8 * self.noise_dof + len(tail) - 1
+        self.noise_variance = max(self.noise_squares / self.noise_dof, 1e-12)
+        self.noise_steps += 1
+        if noise_steps < self.min_noise_steps:
+            return None
+
+        #a step no bigger than the noise says nothing about how long it took
+        noise = 3.0 * math.sqrt(noise_variance)
+        if abs(values[0] - final) <= noise:
+            return None
+
+        #a fraction of the whole step, from before the put. By the first sample most of it may be done
+        step = abs((before if before is not None else values[0]) - final)
+        threshold = max(noise, self.settled_fraction * step)
+        settled = len(values)
+        while settled > 0 and abs(values[settled - 1] - final) <= threshold:
+            settled -= 1
+        if settled >= len(values) - self.tail:
+            #still moving when the samples ran out
+            return None
+        #it settled between the last sample that wasn't (or the put) and the first that was. Halfway keeps the gate
+        #clear of both, where the time of the first settled sample itself would be a coin toss on the next step
+        return 0.5 * ((times[settled - 1] if settled > 0 else 0.0) + times[settled])
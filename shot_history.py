@@ -0,0 +1,175 @@
+'''
+    Fixed-size shot rate history. The optimizers only ever look at the last few shots, so nothing
+    older than the buffer's capacity is kept, and the rolling statistics are updated as shots are
+    added instead of being recomputed from a list every iteration
+'''
+
+import collections
+import math
+
+import numpy as np
+
+
+'''
+    Ring buffer of the last capacity values in a preallocated list (indexing a NumPy array one
+    element at a time costs more than the list does). Appending is O(1), and so are the mean,
+    minimum, maximum and the count of values within [low, high] over what the buffer holds (the
+    minimum and maximum are amortized O(1), kept in monotonic queues)
+    capacity - how many values to keep
+    low, high - the range in_range counts, by default everything
+'''
+class RingBuffer:
+
+    def __init__(self, capacity, low=-math.inf, high=math.inf):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1, got " + str(capacity))
+
+        self.capacity = capacity
+        self.low = low
+        self.high = high
+        self.data = [0.0] * capacity
+        self.clear()
+
+    def clear(self):
+        self.total = 0          # every value ever appended, including the ones that have been overwritten
+        self.size = 0
+        self.sum = 0.0
+        self.in_range = 0
+        # (append number, value) pairs, increasing for the minimum and decreasing for the maximum
+        self.minimums = collections.deque()
+        self.maximums = collections.deque()
+
+    def __len__(self):
+        return self.size
+
+    def full(self):
+        return self.size == self.capacity
+
+    def append(self, value):
+        i = self.total % self.capacity
+
+        if self.size == self.capacity:
+            oldest = self.data[i]
+            self.sum -= oldest
+            if self.low <= oldest <= self.high:
+                self.in_range -= 1
+        else:
+            self.size += 1
+
+        self.data[i] = value
+        self.sum += value
+        if self.low <= value <= self.high:
+            self.in_range += 1
+
+        # drop values that can no longer be the minimum or maximum, then the one that fell out of the window
+        while self.minimums and self.minimums[-1][1] >= value:
+            self.minimums.pop()
+        self.minimums.append((self.total, value))
+        while self.maximums and self.maximums[-1][1] <= value:
+            self.maximums.pop()
+        self.maximums.append((self.total, value))
+
+        self.total += 1
+        oldest_kept = self.total - self.size
+        if self.minimums[0][0] < oldest_kept:
+            self.minimums.popleft()
+        if self.maximums[0][0] < oldest_kept:
+            self.maximums.popleft()
+
+        # resum once per lap around the buffer so rounding errors in the running sum can't build up
+        if self.total % self.capacity == 0:
+            self.sum = math.fsum(self.data)
+
+    def last(self):
+        if self.size == 0:
+            raise IndexError("the buffer is empty")
+        return self.data[(self.total - 1) % self.capacity]
+
+    def mean(self):
+        if self.size == 0:
+            return math.nan
+        return self.sum / self.size
+
+    def min(self):
+        if self.size == 0:
+            return math.nan
+        return self.minimums[0][1]
+
+    def max(self):
+        if self.size == 0:
+            return math.nan
+        return self.maximums[0][1]
+
+    #the values held, oldest first
+    def values(self):
+        start = self.total - self.size
+        return np.array([self.data[i % self.capacity] for i in range(start, self.total)])
+
+
+'''
+    Converged once the last k shots were all within [low, high], which is the check the
+    optimizers have always made with k = 3
+'''
+class LastInRange:
+
+    def __init__(self, k, low, high):
+        self.window = RingBuffer(k, low, high)
+
+    def add(self, shot_rate):
+        self.window.append(shot_rate)
+
+    def converged(self):
+        return self.window.full() and self.window.in_range == self.window.capacity
+
+    def reset(self):
+        self.window.clear()
+
+
+'''
+    Converged once the mean of the last k shots is within tolerance of target, which is less
+    likely than LastInRange to stop on a lucky run of shots or miss the goal on one noisy shot
+'''
+class RollingMeanWithin:
+
+    def __init__(self, k, target, tolerance):
+        self.window = RingBuffer(k)
+        self.target = target
+        self.tolerance = tolerance
+
+    def add(self, shot_rate):
+        self.window.append(shot_rate)
+
+    def converged(self):
+        return self.window.full() and abs(self.window.mean() - self.target) <= self.tolerance
+
+    def reset(self):
+        self.window.clear()
+
+
+'''
+    The shots of one tuning run: the last capacity shot rates, how many shots the run has used and
+    the convergence criterion they are fed to. Each run makes its own, so nothing carries over
+    from one run to the next
+    convergence - a criterion with add(shot_rate), converged() and reset(), e.g. LastInRange
+    capacity - how many shot rates to keep
+'''
+class ShotHistory:
+
+    def __init__(self, convergence, capacity=1000):
+        self.shot_rates = RingBuffer(capacity)
+        self.convergence = convergence
+        self.convergence.reset()
+
+    def add(self, shot_rate):
+        self.shot_rates.append(shot_rate)
+        self.convergence.add(shot_rate)
+
+    def last(self):
+        return self.shot_rates.last()
+
+    #how many shots the run has used
+    def shots(self):
+        return self.shot_rates.total
+
+    def converged(self):
+        return self.convergence.converged()
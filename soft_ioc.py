@@ -0,0 +1,123 @@
+'''
+    A local Channel Access soft IOC that serves the PVs the tuning scripts use, so the unmodified
+    scripts can be run (and their CA overhead measured) without the machine. It needs caproto
+    (pip install caproto), which is only used here.
+
+    The physics is a pv_backend.SimulatedBackend whose virtual clock is kept in step with real
+    time: every CA put to a knob becomes a put on the model, and every shot the model fires is
+    written to the output PVs, which sends the monitor updates to the clients
+
+    usage: python soft_ioc.py [shot period in s] [noise] [put latency in s] [settling time in s]
+    Point pyepics at it with EPICS_CA_ADDR_LIST=127.0.0.1 and EPICS_CA_AUTO_ADDR_LIST=NO
+'''
+
+import asyncio
+import math
+import sys
+import time
+
+from caproto import ChannelDouble
+from caproto.server import run
+
+from pv_backend import SimulatedBackend, gaussianResponse, flatTop
+
+knob_pv = "PHS1032-06:degree"
+
+#the best shot rates are the ones in Automate_Phase_6.py's outputs dictionary
+shot_rate_bests = {"PCT1402-01:mAChange": 0.6, "PCT2403-01:mABR:fbk": 1.6}
+
+injection_efficiency_pv = "ICT1400-01:PCT1402-01:InjEff:fbk"
+
+#steering magnet PV to (center of its flat top, increment), the increments are the ones in Automate_Injection_Tuning.py
+magnet_flat_tops = {"STV1400-01:adc": (1330000, 10000), "STV1400-02:adc": (260000, 20000), "STV1400-03:adc": (240000, 20000),
+                    "STH1400-01:adc": (2300000, 100000), "STH1400-02:adc": (200000, 50000), "STH1400-03:adc": (700000, 50000)}
+
+#STV1400-01 starts 4 increments off its flat top and the other magnets start on theirs, so single magnet scans see a peak
+knob_start = 150.0
+magnet_starts = {"STV1400-01:adc": 1290000, "STV1400-02:adc": 280000, "STV1400-03:adc": 220000,
+                 "STH1400-01:adc": 2400000, "STH1400-02:adc": 200000, "STH1400-03:adc": 650000}
+
+
+#injection efficiency in percent, 97 with every steering magnet on its flat top
+def injectionEfficiency(values):
+    efficiency = 97.0
+    for pv_name, (center, increment) in magnet_flat_tops.items():
+        efficiency *= flatTop((values[pv_name] - center) / increment)
+    return efficiency
+
+
+'''
+    The model served by default: both Phase 6 shot rates peak at 117.25 degrees like the simulated
+    shot rate in Test_Phase_6.py, and the injection efficiency has a flat top in every steering magnet
+'''
+def defaultModel(shot_period=1.0, noise=0.0, put_latency=0.0, settling_time=0.0, seed=None):
+    responses = {pv_name: gaussianResponse(knob_pv, 117.25, best, math.sqrt(100 * best)) for pv_name, best in shot_rate_bests.items()}
+    responses[injection_efficiency_pv] = injectionEfficiency
+
+    initial_values = dict(magnet_starts)
+    initial_values[knob_pv] = knob_start
+    return SimulatedBackend(responses, initial_values, shot_period=shot_period, put_latency=put_latency,
+                            settling_time=settling_time, noise=noise, seed=seed)
+
+
+'''
+    A knob PV. A CA put is handed to the model and only completes once the model's put latency
+    has passed, so caput(wait=True) takes as long as it would on the machine
+'''
+class KnobChannel(ChannelDouble):
+
+    def __init__(self, ioc, pv_name, **kwargs):
+        super().__init__(**kwargs)
+        self.ioc = ioc
+        self.pv_name = pv_name
+
+    async def verify_value(self, value):
+        self.ioc.catchUp()
+        self.ioc.model.put(self.pv_name, float(value), wait=False)
+        await asyncio.sleep(self.ioc.model.setting(self.ioc.model.put_latency, self.pv_name))
+        return value
+
+
+'''
+    Serves every knob and output PV of model over Channel Access
+    model - a SimulatedBackend, e.g. defaultModel()
+'''
+class SoftIOC:
+
+    def __init__(self, model):
+        self.model = model
+        self.start = time.monotonic()
+        self.epoch = time.time()
+
+        self.pvdb = {}
+        for pv_name, value in model.values.items():
+            self.pvdb[pv_name] = KnobChannel(self, pv_name, value=float(value), precision=3)
+        for pv_name in model.responses:
+            self.pvdb[pv_name] = ChannelDouble(value=model.read(pv_name), precision=4)
+            model.subscribe(pv_name, self.onShot)
+
+    #called by the model on every shot, from inside the event loop, with the virtual time of the shot
+    def onShot(self, pvname=None, value=None, timestamp=None, **kw):
+        asyncio.get_running_loop().create_task(self.pvdb[pvname].write(value, timestamp=self.epoch + timestamp))
+
+    #runs the model's clock up to the real time since the IOC started
+    def catchUp(self):
+        self.model.clock.runUntil(time.monotonic() - self.start)
+
+    '''
+        Sleeps until each event the model has scheduled is due and runs it. Readings from shots are
+        written to their PVs as soon as the shot fires, with the shot's time as the CA timestamp
+    '''
+    async def runModel(self, async_lib):
+        while True:
+            next_time = self.model.clock.nextEventTime()
+            await asyncio.sleep(max(self.start + next_time - time.monotonic(), 0.0))
+            self.catchUp()
+
+    def run(self, interfaces=("127.0.0.1",)):
+        run(self.pvdb, interfaces=list(interfaces), log_pv_names=True, startup_hook=self.runModel)
+
+
+if __name__ == "__main__":
+    arguments = [float(arg) for arg in sys.argv[1:5]]
+    SoftIOC(defaultModel(*arguments)).run()
@@ -0,0 +1,124 @@
+'''
+    One command line for the tuning scripts, also run by python <this directory>:
+
+        python . phase6 <mode> [--simulate]
+        python . injection <magnet|all|spsa|dither> [variation] [estimator] [--simulate]
+        python . daemon [port] [--simulate]
+
+    Nothing but argparse and tuning_jobs is imported until a subcommand runs, so --help and
+    mistakes on the command line answer straight away. A tune goes to the tuning daemon if one is
+    running before the optimizers are imported, and pyepics is only loaded once a tune actually
+    talks to the machine. --simulate runs on the simulator instead, without connecting to anything.
+    python Automate_Phase_6.py <mode> and python Automate_Injection_Tuning.py <magnet> <variation>
+    still work the same.
+'''
+
+import argparse
+import sys
+
+
+#the simulated machine for phase6 --simulate: the shot rate peaks at 117.25 degrees, 20 degrees from where the knob starts
+def simulatePhase6():
+    import Automate_Phase_6 as phase6
+    from pv_backend import SimulatedBackend, gaussianResponse
+
+    best = phase6.outputs[phase6.shot_rate_pv]["best"]
+    return SimulatedBackend({pv_name: gaussianResponse(phase6.knob_pv, 117.25, output["best"], (100 * output["best"]) ** 0.5)
+                             for pv_name, output in phase6.outputs.items()},
+                            {phase6.knob_pv: 97.25}, put_latency=0.1, settling_time=0.2, monitor_delay=0.05, noise=0.01 * best, seed=0)
+
+
+#the simulated machine for injection --simulate: every magnet has a flat top a few increments from where it starts,
+#centered where the coupled model in Test_Injection_Tuning.py has them
+def simulateInjection():
+    import Automate_Injection_Tuning as injection
+    from pv_backend import SimulatedBackend, flatTop
+    from scan_history import ScanHistory
+
+    starts = {injection.stv1: 1290000, injection.stv2: 200000, injection.stv3: 300000,
+              injection.sth1: 2000000, injection.sth2: 300000, injection.sth3: 600000}
+    centers = {injection.stv1: 1330000, injection.stv2: 260000, injection.stv3: 240000,
+               injection.sth1: 2300000, injection.sth2: 200000, injection.sth3: 700000}
+
+    def efficiency(values):
+        result = 97.0
+        for pv_name, center in centers.items():
+            result *= flatTop((values[pv_name] - center) / injection.magnet_to_increment[pv_name])
+        return result
+
+    #simulated scans shouldn't end up in the real scan history
+    injection.scan_history = ScanHistory(":memory:")
+    return SimulatedBackend({injection.stage_2_injection_efficiency_pv: efficiency}, starts, put_latency=0.1,
+                            monitor_delay=0.05, poisson_counts=100, seed=0)
+
+
+#a running daemon gets the tune before the optimizers are imported, they and numpy take about 0.4 s
+def phase6Command(args):
+    if not args.simulate:
+        import tuning_client
+        from tuning_jobs import phase6Job
+        if tuning_client.handOff(phase6Job(args.mode)[1]):
+            return
+
+    import Automate_Phase_6 as phase6
+    if args.simulate:
+        phase6.backend = simulatePhase6()
+    phase6.main(args.mode, use_daemon=False)
+
+
+def injectionCommand(args):
+    if not args.simulate:
+        import tuning_client
+        from tuning_jobs import injectionJob
+        if tuning_client.handOff(injectionJob(args.magnet, args.variation, args.estimator)):
+            return
+
+    import Automate_Injection_Tuning as injection
+    if args.simulate:
+        injection.backend = simulateInjection()
+    injection.main(args.magnet, args.variation, args.estimator, use_daemon=False)
+
+
+def daemonCommand(args):
+    import tuning_daemon
+    tuning_daemon.main(args.port, simulatePhase6() if args.simulate else None)
+
+
+def parser():
+    from tuning_jobs import estimators
+
+    parser = argparse.ArgumentParser(prog="python .", description="Phase 6 and injection tuning")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    phase6 = commands.add_parser("phase6", help="tune the phase 6 knob on the shot rate")
+    phase6.add_argument("mode", type=int, choices=range(1, 9), help="1 standard, 2 multiple measurements, 3 decreasing step, "
+                        "4 multiple measurements and decreasing step, 5 Brent, 6 Bayesian, 7 adaptive multiple measurements, "
+                        "8 continuous feedback until Ctrl-C")
+    phase6.add_argument("--simulate", action="store_true", help="tune the simulator instead of the machine")
+    phase6.set_defaults(run=phase6Command)
+
+    injection = commands.add_parser("injection", help="tune the steering magnets on the injection efficiency")
+    injection.add_argument("magnet", help="the magnet to tune, e.g. stv1400-01, or all, spsa or dither to tune every magnet together")
+    injection.add_argument("variation", type=int, nargs="?", choices=[1, 2, 4, 5, 6],
+                           help="1 scan and midpoint, 2 scan and centroid, 4 Bayesian, 5 warm start, 6 extremum seeking, for a single magnet")
+    injection.add_argument("estimator", nargs="?", type=str.lower, choices=estimators,
+                           help="the flat top center estimator for variations 1 and 2")
+    injection.add_argument("--simulate", action="store_true", help="tune the simulator instead of the machine")
+    injection.set_defaults(run=injectionCommand)
+
+    daemon = commands.add_parser("daemon", help="run the tuning daemon, see tuning_daemon.py")
+    daemon.add_argument("port", type=int, nargs="?", default=8765)
+    daemon.add_argument("--simulate", action="store_true", help="run the jobs on the phase 6 simulator instead of the machine")
+    daemon.set_defaults(run=daemonCommand)
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.command == "injection" and args.magnet.upper() not in ("ALL", "SPSA", "DITHER") and args.variation is None:
+        parser().error("a single magnet needs a variation")
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
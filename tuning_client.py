@@ -0,0 +1,107 @@
+'''
+    Talks to tuning_daemon.py over HTTP on localhost. This is all the tuning scripts need to hand
+    a tune to a running daemon, so it only uses the standard library.
+    Set TUNING_DAEMON to host:port if the daemon isn't on the default address
+'''
+
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+default_address = "127.0.0.1:8765"
+
+
+#raised when there is no daemon listening
+class DaemonUnavailable(Exception):
+    pass
+
+
+def address():
+    return os.environ.get("TUNING_DAEMON", default_address)
+
+
+'''
+    Sends one request to the daemon
+    returns the decoded JSON reply
+'''
+def request(method, path, body=None, timeout=5.0):
+    data = json.dumps(body).encode() if body is not None else None
+    http_request = urllib.request.Request("http://" + address() + path, data=data, method=method,
+                                          headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as reply:
+            return json.loads(reply.read())
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.loads(error.read()).get("error", str(error)))
+    except (urllib.error.URLError, ConnectionError) as error:
+        raise DaemonUnavailable("no tuning daemon at " + address() + ": " + str(error))
+
+
+#queues a job and returns its id
+def submit(job):
+    return request("POST", "/jobs", job)["id"]
+
+def status(job_id):
+    return request("GET", "/jobs/" + str(job_id))
+
+def cancel(job_id):
+    return request("POST", "/jobs/" + str(job_id) + "/cancel")
+
+#holds or resumes the corrections of a running feedback job
+def hold(job_id):
+    return request("POST", "/jobs/" + str(job_id) + "/hold")
+
+def resume(job_id):
+    return request("POST", "/jobs/" + str(job_id) + "/resume")
+
+def jobs():
+    return request("GET", "/jobs")
+
+
+'''
+    Queues a job and follows it until it finishes, printing its output as it comes.
+    Ctrl-C cancels the job
+    returns the finished job, or None if no daemon is running so the caller can tune in its own process
+'''
+def runJob(job, poll=0.2):
+    try:
+        job_id = submit(job)
+    except DaemonUnavailable:
+        return None
+
+    printed = 0
+    try:
+        while True:
+            job = status(job_id)
+            output = job["output"]
+            if len(output) > printed:
+                sys.stdout.write(output[printed:])
+                sys.stdout.flush()
+                printed = len(output)
+            if job["status"] in ("done", "failed", "cancelled"):
+                return job
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        cancel(job_id)
+        print("Cancelled job " + str(job_id))
+        raise
+
+
+'''
+    Hands a tune to the daemon if one is running, follows it and says how it ended
+    job - the job, see tuning_jobs.py
+    returns False if no daemon is running, so the caller tunes in its own process
+'''
+def handOff(job):
+    job = runJob(job)
+    if job is None:
+        return False
+    if job["status"] != "done":
+        print("Tuning " + job["status"] + ": " + str(job["error"]))
+    elif "shots" in job["result"]:
+        print("Tuning complete, shots used: ", job["result"]["shots"])
+    return True
@@ -0,0 +1,309 @@
+'''
+    A long-running tuning process. It connects to every PV both scripts use and subscribes to their
+    outputs once, when it starts, then runs the tunes it is sent one after another on those warm
+    channels, so a tune starts in the time it takes to queue it rather than after a fresh process
+    has imported everything and connected again.
+
+    usage: python tuning_daemon.py [port]
+    It only listens on 127.0.0.1 (port 8765 by default) and speaks JSON over HTTP. A POST must say
+    Content-Type: application/json and mustn't carry an Origin header, so a web page open in a
+    browser on the same machine can't queue or cancel jobs: a browser sends Origin with every
+    cross-site POST, and can't send a JSON one without asking first, which the daemon doesn't answer.
+        POST /jobs                 queues a job, e.g. {"script": "phase6", "algorithm": "optimizePV_DecreasingStep",
+                                   "pv": "PCT1402-01:mAChange", "params": {"min_step": 0.5, "max_step": 2.0, "max_iterations": 100}}
+        GET  /jobs                 every job without its output
+        GET  /jobs/<id>            one job with what it has printed so far and its result once it's done
+        POST /jobs/<id>/cancel     cancels a queued job, or stops a running one at its next measurement
+        POST /jobs/<id>/hold       holds the knob corrections of a running optimizePV_Feedback job, /resume resumes them
+    Automate_Phase_6.py and Automate_Injection_Tuning.py hand their tunes to it through tuning_client.py
+    whenever it is running. TUNING_TRACE and TUNING_RECORD work the same as for the scripts.
+'''
+
+import collections
+import contextlib
+import http.server
+import json
+import sys
+import threading
+import time
+import traceback
+
+import Automate_Phase_6 as phase6
+import Automate_Injection_Tuning as injection
+from channel_manager import channels
+from measurement_channel import Cancelled
+from shot_history import ShotHistory
+from instrumentation import tracer
+from run_recorder import recorder
+
+
+scripts = {"phase6": phase6, "injection": injection}
+
+#the output PV of phase 6 jobs that don't name one, as Automate_Phase_6.py sets it. A job that names one changes
+#phase6.shot_rate_pv for the jobs after it, so it can't be read from there when the job runs
+default_shot_rate_pv = phase6.shot_rate_pv
+
+#the channel each script measures on, which cancelling a job interrupts
+channels_of = {"phase6": lambda: phase6.shot_rate_samples, "injection": lambda: injection.injection_efficiency_samples}
+
+
+'''
+    What sys.stdout is while a job runs: whatever the worker thread prints goes into the job's
+    output, anything printed by other threads still goes to the terminal
+'''
+class JobOutput:
+
+    def __init__(self, job, stdout):
+        self.job = job
+        self.stdout = stdout
+        self.thread = threading.current_thread()
+
+    def write(self, text):
+        if threading.current_thread() is self.thread:
+            self.job["output"] += text
+        else:
+            self.stdout.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+#what a finished job hands back, small enough to send as JSON. The joint steering tunes return each magnet's final value
+def summarize(returned):
+    if isinstance(returned, ShotHistory):
+        return {"shots": returned.shots(), "converged": returned.converged(), "last": returned.last(),
+                "knob": phase6.backend.get(phase6.knob_pv)}
+    if isinstance(returned, dict):
+        return {"values": {str(pv_name): summarize(value)["value"] for pv_name, value in returned.items()}}
+    if isinstance(returned, (int, float)):
+        return {"value": returned}
+    return {"value": None}
+
+
+'''
+    Runs queued jobs one at a time on a worker thread
+    backend - the backend both scripts tune on, an EpicsBackend for the machine. One backend for
+              both keeps the shared subscriptions open from one script's job to the other's
+'''
+class TuningDaemon:
+
+    def __init__(self, backend):
+        self.backend = backend
+        phase6.backend = backend
+        injection.backend = backend
+
+        self.condition = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.queue = collections.deque()
+        self.next_id = 1
+        self.worker = None
+
+    #connects to every PV and subscribes to both outputs before the first job comes in
+    def warmUp(self):
+        pv_names = [phase6.knob_pv] + list(phase6.outputs) + list(injection.magnet_to_increment)
+        if hasattr(self.backend, "pv"):
+            for pv_name in pv_names + [injection.stage_2_injection_efficiency_pv]:
+                self.backend.pv(pv_name)
+
+        channels.use(self.backend)
+        for pv_name in list(phase6.outputs) + [injection.stage_2_injection_efficiency_pv]:
+            channels.subscription(pv_name)
+
+    def start(self):
+        self.warmUp()
+        self.worker = threading.Thread(target=self.work, name="tuning worker", daemon=True)
+        self.worker.start()
+
+    '''
+        Queues a job
+        request - the decoded POST body: script, algorithm, pv and params
+        returns the job, raises ValueError if the request doesn't name a script and optimizer we have
+    '''
+    def submit(self, request):
+        if not isinstance(request, dict) or request.get("script") not in scripts:
+            raise ValueError("script must be one of " + str(list(scripts)))
+        algorithm = request.get("algorithm")
+        if not isinstance(algorithm, str) or not algorithm.startswith("optimize") or not hasattr(scripts[request["script"]], algorithm):
+            raise ValueError("no optimizer called " + str(algorithm) + " in " + request["script"])
+        params = request.get("params") or {}
+        if not isinstance(params, dict):
+            raise ValueError("params must be an object")
+
+        pv_name = request.get("pv")
+        if pv_name is None and request["script"] == "phase6":
+            pv_name = default_shot_rate_pv
+
+        with self.condition:
+            job = {"id": self.next_id, "script": request["script"], "algorithm": algorithm, "pv": pv_name,
+                   "params": params, "status": "queued", "queued": time.time(), "started": None, "finished": None,
+                   "output": "", "result": None, "error": None}
+            self.next_id += 1
+            self.jobs[job["id"]] = job
+            self.queue.append(job["id"])
+            self.condition.notify_all()
+        return job
+
+    #raises KeyError if there is no such job. A running feedback job also has its live metrics
+    def job(self, job_id):
+        job = self.jobs[job_id]
+        if job["status"] == "running" and job["algorithm"] == "optimizePV_Feedback" and phase6.feedback is not None:
+            return dict(job, feedback=phase6.feedback.metrics())
+        return job
+
+    '''
+        Holds or resumes the corrections of a running feedback job, which keeps taking shots meanwhile
+        returns the job, raises ValueError if the job isn't running the feedback
+    '''
+    def holdFeedback(self, job_id, hold):
+        job = self.jobs[job_id]
+        if job["status"] != "running" or job["algorithm"] != "optimizePV_Feedback" or phase6.feedback is None:
+            raise ValueError("job " + str(job_id) + " isn't running the feedback")
+        if hold:
+            phase6.feedback.hold()
+        else:
+            phase6.feedback.resume()
+        return self.job(job_id)
+
+    '''
+        Cancels a job. A queued job never runs, a running one raises Cancelled the next time it
+        waits for a measurement and its moves that haven't been put are dropped
+    '''
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs[job_id]
+            if job["status"] == "queued":
+                self.queue.remove(job_id)
+                job["status"] = "cancelled"
+                job["finished"] = time.time()
+            elif job["status"] == "running":
+                channels_of[job["script"]]().cancel()
+        return job
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.queue) > 0)
+                job = self.jobs[self.queue.popleft()]
+                job["status"] = "running"
+                job["started"] = time.time()
+            self.run(job)
+
+    def run(self, job):
+        script = scripts[job["script"]]
+        try:
+            with contextlib.redirect_stdout(JobOutput(job, sys.stdout)):
+                returned = script.runOptimizer(job["algorithm"], job["pv"], **job["params"])
+            job["result"] = summarize(returned)
+            if job["algorithm"] == "optimizePV_Feedback":
+                job["result"]["feedback"] = phase6.feedback.metrics()
+            job["status"] = "done"
+        except Cancelled:
+            script.moves.discard(script.backend)
+            job["status"] = "cancelled"
+        except Exception as error:
+            script.moves.discard(script.backend)
+            job["output"] += traceback.format_exc()
+            job["error"] = str(error)
+            job["status"] = "failed"
+        finally:
+            with self.condition:
+                channels_of[job["script"]]().resume()
+                job["finished"] = time.time()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    #the job id in /jobs/<id> or /jobs/<id>/<action>
+    def jobId(self, parts):
+        try:
+            return int(parts[1])
+        except ValueError:
+            raise KeyError(parts[1])
+
+    def do_GET(self):
+        daemon = self.server.tuning
+        parts = self.path.strip("/").split("/")
+        try:
+            if parts == ["jobs"]:
+                self.reply(200, [{key: value for key, value in job.items() if key != "output"} for job in list(daemon.jobs.values())])
+            elif len(parts) == 2 and parts[0] == "jobs":
+                self.reply(200, daemon.job(self.jobId(parts)))
+            else:
+                self.reply(404, {"error": "no such path " + self.path})
+        except KeyError:
+            self.reply(404, {"error": "no such job " + parts[1]})
+
+    def do_POST(self):
+        daemon = self.server.tuning
+        parts = self.path.strip("/").split("/")
+        if self.headers.get("Origin") is not None:
+            self.reply(403, {"error": "requests from web pages are refused"})
+            return
+        if self.headers.get_content_type() != "application/json":
+            self.reply(415, {"error": "Content-Type must be application/json"})
+            return
+        try:
+            if parts == ["jobs"]:
+                length = int(self.headers.get("Content-Length", 0))
+                self.reply(202, daemon.submit(json.loads(self.rfile.read(length) or b"null")))
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+                self.reply(200, daemon.cancel(self.jobId(parts)))
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] in ("hold", "resume"):
+                self.reply(200, daemon.holdFeedback(self.jobId(parts), parts[2] == "hold"))
+            else:
+                self.reply(404, {"error": "no such path " + self.path})
+        except KeyError:
+            self.reply(404, {"error": "no such job " + parts[1]})
+        except ValueError as error:
+            self.reply(400, {"error": str(error)})
+
+    #the clients poll, so logging every request would bury everything else
+    def log_message(self, format, *args):
+        pass
+
+
+'''
+    Starts the daemon's worker and an HTTP server for it on a background thread
+    port - 0 picks a free one
+    returns the server, whose server_address is where it is listening and whose tuning is the TuningDaemon
+'''
+def serve(backend, port=8765):
+    daemon = TuningDaemon(backend)
+    daemon.start()
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), RequestHandler)
+    server.daemon_threads = True
+    server.tuning = daemon
+    threading.Thread(target=server.serve_forever, name="tuning api", daemon=True).start()
+    return server
+
+
+'''
+    Runs the daemon until Ctrl-C
+    backend - what to tune on, the scripts' EpicsBackend if None
+'''
+def main(port=8765, backend=None):
+    tracer.enableFromEnvironment()
+    recorder.enableFromEnvironment()
+
+    server = serve(backend if backend is not None else phase6.backend, port)
+    print("Tuning daemon listening on " + server.server_address[0] + ":" + str(server.server_address[1]))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        channels.close()
+        recorder.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8765)
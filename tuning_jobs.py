@@ -0,0 +1,75 @@
+'''
+    The command line modes of Automate_Phase_6.py and Automate_Injection_Tuning.py, as the jobs
+    the tuning daemon runs. This only uses the standard library, so python . phase6 and python .
+    injection can hand a tune to a running daemon without importing the optimizers first, which
+    with numpy takes about 0.4 s. They are imported only when the tune runs in the process itself.
+'''
+
+
+#the phase 6 modes: what each one is, the optimizer and its arguments apart from the goal window
+phase6_modes = {1: ("standard tuning algorithm", "optimizePV_Standard", {"step": 0.5, "max_iterations": 100}),
+                2: ("tuning algorithm with multiple measurements", "optimizePV_MultipleMeasurements",
+                    {"step": 0.5, "max_iterations": 300, "measurements": 3}),
+                3: ("tuning algorithm with decreasing step", "optimizePV_DecreasingStep", {"min_step": 0.5, "max_step": 2.0, "max_iterations": 100}),
+                4: ("tuning algorithm with multiple measurements and decreasing step", "optimizePV_MultipleMeasureMentsDecreasingStep",
+                    {"min_step": 0.5, "max_step": 1.5, "step_decrease": 0.5, "max_iterations": 200, "measurements": 3}),
+                5: ("Brent line search tuning algorithm", "optimizePV_Brent", {"initial_step": 0.5, "tolerance": 0.05, "max_iterations": 100}),
+                6: ("Bayesian optimization tuning algorithm", "optimizePV_Bayesian", {"search_width": 20.0, "max_iterations": 50}),
+                7: ("tuning algorithm with adaptive multiple measurements", "optimizePV_MultipleMeasurements",
+                    {"step": 0.5, "max_iterations": 300, "measurements": 3, "adaptive_confidence": 0.8}),
+                8: ("continuous drift tracking feedback, Ctrl-C to stop", "optimizePV_Feedback", {"step": 0.5})}
+
+#the variations for one magnet: the optimizer and its arguments apart from the magnet and step
+variations = {1: ("optimizeSteeringMagnetVariation1", {"max_iterations": 100}),
+              2: ("optimizeSteeringMagnetVariation2", {"max_iterations": 100}),
+              4: ("optimizeSteeringMagnetBayesian", {"max_iterations": 30}),
+              5: ("optimizeSteeringMagnetWarmStart", {"max_iterations": 100}),
+              6: ("optimizeSteeringMagnetDither", {"max_iterations": 300})}
+
+#'all', 'spsa' and 'dither' tune every steering magnet together, so they don't need a variation
+joint_modes = {"ALL": ("optimizeAllSteeringMagnets", {"max_iterations": 300}),
+               "SPSA": ("optimizeSteeringMagnetsSPSA", {"iterations": 20}),
+               "DITHER": ("optimizeSteeringMagnetsDither", {"max_shots": 500})}
+
+#the flat top center estimators of scan_analysis.ESTIMATORS, which variations 1 and 2 can be given
+estimators = ["midpoint", "centroid", "tophat", "savgol", "median"]
+
+
+#the magnet PV for a name typed on the command line, with or without the :adc and in any case, e.g. stv1400-01
+def magnetName(name):
+    name = name.upper()
+    if name[-4:] == ":ADC":
+        name = name[:-4]
+    return name + ":adc"
+
+
+'''
+    The job for a phase 6 mode
+    mode - the number of the mode, see phase6_modes
+    pv_name - the output PV to tune on, the one Automate_Phase_6.shot_rate_pv is set to if None
+    returns the description of the mode and the job
+'''
+def phase6Job(mode, pv_name=None):
+    description, algorithm, params = phase6_modes[mode]
+    return description, {"script": "phase6", "algorithm": algorithm, "pv": pv_name, "params": dict(params)}
+
+
+'''
+    The job for tuning one magnet with a variation, or every magnet together
+    magnet - the magnet to tune, or "all", "spsa" or "dither" to tune them all together
+    variation - the number of the variation for a single magnet, see variations
+    estimator - the flat top center estimator for variations 1 and 2, their own default if None
+'''
+def injectionJob(magnet, variation=None, estimator=None):
+    if magnet.upper() in joint_modes:
+        algorithm, params = joint_modes[magnet.upper()]
+        return {"script": "injection", "algorithm": algorithm, "pv": None, "params": dict(params)}
+
+    algorithm, params = variations[variation]
+    params = dict(params)
+    #the optional estimator only applies to variations 1 and 2
+    if variation == 2:
+        params["estimator"] = estimator if estimator is not None else "centroid"
+    elif variation == 1:
+        params["estimator"] = estimator if estimator is not None else "midpoint"
+    return {"script": "injection", "algorithm": algorithm, "pv": magnetName(magnet), "params": params}
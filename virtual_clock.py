@@ -0,0 +1,92 @@
+'''
+    Discrete-event scheduler with a virtual clock. Events are callbacks due at a virtual time and
+    the clock jumps straight from one event to the next, so simulating an hour of injection shots
+    and magnet settling takes however long the callbacks themselves take
+'''
+
+import heapq
+
+
+'''
+    A scheduled callback. cancel() stops it from running if it hasn't already
+'''
+class Event:
+
+    def __init__(self, time, callback, args):
+        self.time = time
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class VirtualClock:
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.events = []
+        self.sequence = 0       # breaks ties so events due at the same time run in the order they were scheduled
+
+    def now(self):
+        return self.time
+
+    #runs callback(*args) delay seconds from now
+    def schedule(self, delay, callback, *args):
+        return self.scheduleAt(self.time + max(delay, 0.0), callback, *args)
+
+    def scheduleAt(self, time, callback, *args):
+        event = Event(max(time, self.time), callback, args)
+        heapq.heappush(self.events, (event.time, self.sequence, event))
+        self.sequence += 1
+        return event
+
+    #when the next event is due, or None if nothing is scheduled
+    def nextEventTime(self):
+        while self.events and self.events[0][2].cancelled:
+            heapq.heappop(self.events)
+        if not self.events:
+            return None
+        return self.events[0][0]
+
+    '''
+        Moves the clock to the next event and runs it
+        returns False if there was nothing left to run
+    '''
+    def step(self):
+        if self.nextEventTime() is None:
+            return False
+
+        time, sequence, event = heapq.heappop(self.events)
+        self.time = time
+        event.callback(*event.args)
+        return True
+
+    #runs every event due up to time and leaves the clock at time
+    def runUntil(self, time):
+        while True:
+            next_time = self.nextEventTime()
+            if next_time is None or next_time > time:
+                break
+            self.step()
+        self.time = max(self.time, time)
+
+    def sleep(self, seconds):
+        self.runUntil(self.time + seconds)
+
+    '''
+        Runs events until condition() is true
+        timeout - give up after this many virtual seconds, None keeps going while there are events
+        returns whether the condition was met
+    '''
+    def runUntilTrue(self, condition, timeout=None):
+        deadline = None if timeout is None else self.time + timeout
+        while not condition():
+            next_time = self.nextEventTime()
+            if next_time is None or (deadline is not None and next_time > deadline):
+                if deadline is not None:
+                    self.time = max(self.time, deadline)
+                return False
+            self.step()
+        return True